@@ -1,21 +1,84 @@
+import logging
+
 from flask import Flask
 from waitress import serve
 
+from app import transport, tracing
+from app.circuit_breaker import init_circuit_breakers
 from app.config import Config
-from app.services.service_manager import init_target_api_backend
+from app.embeddings import init_embedding_batcher
+from app.idempotency import init_idempotency_store
+from app.rate_limits import init_client_keys
+from app.response_cache import init_response_cache
+from app.sessions import init_session_store
+from app.services.race_service import parse_race_groups
+from app.services.service_manager import init_target_api_backend, init_model_refresher
+from app.usage import init_usage_ledger
 
 
 def create_app(config: Config | None = None):
     app = Flask(__name__)
 
     # load the configuration from the provided Config object or the default Config object (env vars)
-    if config:
+    if config is not None:
         app.config.from_object(config)
     else:
         app.config.from_object(Config())
 
+    # record the upstream exchanges to a cassette or replay them from one
+    use_http2 = app.config.get("UPSTREAM_HTTP2")
+    if app.config.get("CASSETTE_MODE"):
+        from app.cassettes import init_cassettes
+        init_cassettes(app.config.get("CASSETTE_MODE"), app.config.get("CASSETTE_PATH"))
+        # only the synchronous HTTP/1.1 transports are intercepted
+        use_http2 = False
+
+    # export the spans of sampled requests, before the upstream clients are created so they propagate the traces
+    tracing.init_tracing(app.config.get("TRACING_EXPORT"), app.config.get("TRACING_SAMPLE_RATE"),
+                         app.config.get("TRACING_FILE_MAX_BYTES"), app.config.get("TRACING_FILE_BACKUPS"))
+
+    # configure the shared upstream connections
+    transport.init_transport(use_http2, app.config.get("UPSTREAM_MAX_CONNECTIONS"),
+                             app.config.get("UPSTREAM_CONNECT_TIMEOUT"), app.config.get("UPSTREAM_FIRST_BYTE_TIMEOUT"))
+
+    # client keys and their rate limits for CUSTOM_KEY mode
+    init_client_keys(app.config.get("CLIENT_KEYS_FILE"))
+
+    # fail fast on backends that are down
+    init_circuit_breakers(app.config.get("CIRCUIT_BREAKER_FAILURE_RATE"),
+                          app.config.get("CIRCUIT_BREAKER_MIN_REQUESTS"),
+                          app.config.get("CIRCUIT_BREAKER_SLOW_CALL_SECONDS"),
+                          app.config.get("CIRCUIT_BREAKER_OPEN_SECONDS"),
+                          app.config.get("CIRCUIT_BREAKER_PROBES"))
+
     # initialize the target API backend
-    init_target_api_backend(app.config.get("TARGET_API"))
+    init_target_api_backend(app.config.get("TARGET_API"), parse_race_groups(app.config.get("RACE_GROUPS")),
+                            app.config.get("AUTO_MODELS"), app.config.get("AUTO_LATENCY_SLO_MS"),
+                            app.config.get("AUTO_EXPLORATION"))
+
+    # keep the model catalogs up to date with the providers in the background
+    if app.config.get("MODEL_REFRESH_INTERVAL") > 0:
+        init_model_refresher(app.config.get("MODEL_REFRESH_INTERVAL"))
+
+    # record token and latency accounting of every request
+    if app.config.get("USAGE_DB_PATH"):
+        init_usage_ledger(app.config.get("USAGE_DB_PATH"), app.config.get("USAGE_BATCH_SIZE"),
+                          app.config.get("USAGE_FLUSH_INTERVAL"))
+
+    # answer repeated requests from the response cache
+    init_response_cache(app.config.get("RESPONSE_CACHE"), app.config.get("RESPONSE_CACHE_MAX_BYTES"),
+                        app.config.get("RESPONSE_CACHE_SIMILARITY"), app.config.get("RESPONSE_CACHE_MODELS"),
+                        app.config.get("RESPONSE_CACHE_KEYS"), app.config.get("RESPONSE_CACHE_PATH"),
+                        app.config.get("RESPONSE_CACHE_SLOT_SIZE"))
+
+    # let retries sent with an Idempotency-Key header share the response of the original request
+    init_idempotency_store(app.config.get("IDEMPOTENCY_TTL"), app.config.get("IDEMPOTENCY_MAX_BYTES"))
+
+    # keep the histories of chat sessions, so their turns only send the new messages
+    init_session_store(app.config.get("SESSION_TTL"), app.config.get("SESSION_MAX_BYTES"))
+
+    # merge concurrent embedding requests into shared upstream calls
+    init_embedding_batcher(app.config.get("EMBEDDING_BATCH_WINDOW_MS"))
 
     # set the log level
     app.logger.setLevel(app.config.get("LOG_LEVEL"))
@@ -24,10 +87,35 @@ def create_app(config: Config | None = None):
     from app import routes
     routes.init_app(app)
 
+    # negotiate response compression and accept compressed request bodies
+    from app import compression
+    compression.init_app(app)
+
     return app
 
 
 if __name__ == '__main__':
-    app = create_app()
-    print(f"Running server on port {app.config.get('SERVER_PORT')}")
-    serve(app, listen=f'*:{app.config.get("SERVER_PORT")}')
+    config = Config()
+    if config.WORKERS > 1 or config.UNIX_SOCKET:
+        from app.workers import run_workers, create_listen_sockets, remove_unix_socket, serve as serve_sockets
+        logging.basicConfig(level=config.LOG_LEVEL)
+        listen_sockets = create_listen_sockets(config.SERVER_PORT, config.UNIX_SOCKET, config.UNIX_SOCKET_PERMS)
+        addresses = [f"port {config.SERVER_PORT}"] if config.SERVER_PORT or not config.UNIX_SOCKET else []
+        if config.UNIX_SOCKET:
+            addresses.append(config.UNIX_SOCKET)
+        try:
+            if config.WORKERS > 1:
+                # the workers create their own app after forking, the supervisor only holds the listening sockets
+                print(f"Running server on {' and '.join(addresses)} with {config.WORKERS} workers")
+                run_workers(lambda: create_app(config), listen_sockets, config.WORKERS, config.WORKER_SHUTDOWN_TIMEOUT)
+            else:
+                app = create_app(config)
+                print(f"Running server on {' and '.join(addresses)}")
+                serve_sockets(app, listen_sockets)
+        finally:
+            if config.UNIX_SOCKET:
+                remove_unix_socket(config.UNIX_SOCKET)
+    else:
+        app = create_app(config)
+        print(f"Running server on port {app.config.get('SERVER_PORT')}")
+        serve(app, listen=f'*:{app.config.get("SERVER_PORT")}')
@@ -0,0 +1,200 @@
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Iterator
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RECORD = "record"
+# serve the recorded responses with their original timing
+REPLAY = "replay"
+# serve the recorded responses as fast as possible
+REPLAY_FAST = "replay-fast"
+
+# headers of the recorded responses that are not replayed
+_SKIPPED_HEADERS = {"set-cookie", "date"}
+
+
+def get_request_key(request: httpx.Request) -> str:
+    """Hash of the method, URL and body of an upstream request, independent of the headers (and API keys)."""
+
+    body = request.read()
+    try:
+        # JSON bodies are compared by their content, not the key order or whitespace the SDK produced
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode()
+    except ValueError:
+        pass
+    digest = hashlib.sha256()
+    digest.update(request.method.encode() + b" " + str(request.url).encode() + b"\n")
+    digest.update(body)
+    return digest.hexdigest()[:32]
+
+
+class Cassette:
+    """
+    Upstream exchanges recorded to (or replayed from) a gzip compressed JSONL file.
+
+    Every line is one exchange: the request key, method and URL, the response status and headers, the seconds until
+    the response headers arrived and the chunks of the response body with the seconds since the previous chunk.
+    """
+
+    def __init__(self, path: str, mode: str):
+        """
+        :param path: The cassette file.
+        :param mode: RECORD to append the exchanges sent upstream, REPLAY or REPLAY_FAST to answer them from the file.
+        """
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        # request key -> recorded exchanges, and the number of times the key has been replayed
+        self._exchanges: dict[str, list[dict]] = {}
+        self._replayed: dict[str, int] = {}
+
+        if mode != RECORD:
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    exchange = json.loads(line)
+                    self._exchanges.setdefault(exchange["key"], []).append(exchange)
+            logger.info("Loaded %d upstream exchanges from %s", sum(map(len, self._exchanges.values())), path)
+
+    def handle_request(self, send, request: httpx.Request) -> httpx.Response:
+        """
+        Record or replay an upstream request.
+
+        :param send: Sends the request upstream, only used when recording.
+        """
+        if self.mode == RECORD:
+            return self._record(send, request)
+        return self._replay(request)
+
+    def _record(self, send, request: httpx.Request) -> httpx.Response:
+        key = get_request_key(request)
+        started_at = time.monotonic()
+        response = send(request)
+        exchange = {
+            "key": key,
+            "method": request.method,
+            "url": str(request.url),
+            "status": response.status_code,
+            "headers": [[name, value] for name, value in response.headers.multi_items()
+                        if name.lower() not in _SKIPPED_HEADERS],
+            "delay": time.monotonic() - started_at,
+            "chunks": []
+        }
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_RecordingStream(response, exchange, self._write),
+                              extensions=response.extensions)
+
+    def _write(self, exchange: dict):
+        line = (json.dumps(exchange, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            # every exchange is a gzip member of its own, so the file stays readable if the process dies
+            with open(self.path, "ab") as f:
+                f.write(gzip.compress(line))
+
+    def _replay(self, request: httpx.Request) -> httpx.Response:
+        key = get_request_key(request)
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                raise httpx.ConnectError(f"No recorded exchange for {request.method} {request.url}", request=request)
+            # repeated requests get the recorded exchanges in order, the last one is repeated
+            index = self._replayed.get(key, 0)
+            self._replayed[key] = index + 1
+        exchange = exchanges[min(index, len(exchanges) - 1)]
+
+        realtime = self.mode == REPLAY
+        if realtime:
+            time.sleep(exchange["delay"])
+        return httpx.Response(exchange["status"], headers=exchange["headers"],
+                              stream=_ReplayStream(exchange["chunks"], realtime),
+                              extensions={"http_version": b"HTTP/1.1"})
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    """Passes the body of an upstream response through and records its chunks with their timing."""
+
+    def __init__(self, response: httpx.Response, exchange: dict, write):
+        self.response = response
+        self.exchange = exchange
+        self.write = write
+        self.written = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        last_chunk_at = time.monotonic()
+        for chunk in self.response.stream:
+            now = time.monotonic()
+            self.exchange["chunks"].append([round(now - last_chunk_at, 6), base64.b64encode(chunk).decode()])
+            last_chunk_at = now
+            yield chunk
+
+    def close(self):
+        self.response.close()
+        if not self.written:
+            self.written = True
+            self.write(self.exchange)
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    """Body of a replayed response, optionally with the recorded pauses between the chunks."""
+
+    def __init__(self, chunks: list, realtime: bool):
+        self.chunks = chunks
+        self.realtime = realtime
+
+    def __iter__(self) -> Iterator[bytes]:
+        for delay, data in self.chunks:
+            if self.realtime and delay > 0:
+                time.sleep(delay)
+            yield base64.b64decode(data)
+
+    def close(self):
+        pass
+
+
+cassette: Cassette | None = None
+_original_handle_request = None
+
+
+def init_cassettes(mode: str | None, path: str):
+    """
+    Record the upstream exchanges of the process to a cassette, or answer them from one without network access.
+
+    All synchronous httpx transports of the process are intercepted, including the ones the provider SDKs create for
+    themselves.
+
+    :param mode: RECORD, REPLAY, REPLAY_FAST or None to send requests upstream normally.
+    :param path: The cassette file.
+    """
+    global cassette, _original_handle_request
+    if mode not in (None, RECORD, REPLAY, REPLAY_FAST):
+        raise ValueError("Unknown cassette mode: " + mode)
+
+    if _original_handle_request is None:
+        _original_handle_request = httpx.HTTPTransport.handle_request
+    cassette = Cassette(path, mode) if mode else None
+    if cassette is None:
+        httpx.HTTPTransport.handle_request = _original_handle_request
+        return
+
+    send = _original_handle_request
+
+    def handle_request(transport: httpx.HTTPTransport, request: httpx.Request) -> httpx.Response:
+        current = cassette
+        if current is None:
+            return send(transport, request)
+        return current.handle_request(lambda upstream_request: send(transport, upstream_request), request)
+
+    httpx.HTTPTransport.handle_request = handle_request
+
+
+def get_cassette() -> Cassette | None:
+    """Get the cassette upstream exchanges are recorded to or replayed from, None if they are sent normally."""
+
+    return cassette
@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# seconds of outcomes the failure rate is computed over
+WINDOW_SECONDS = 60
+
+
+class CircuitOpenError(Exception):
+    """A call was rejected because the circuit of its backend is open."""
+
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"Circuit of {key} is open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a failing backend endpoint.
+
+    Counts the failed and slow calls of the last WINDOW_SECONDS. When their share reaches the threshold the circuit
+    opens and calls fail immediately. After `open_seconds` the circuit is half open and lets a few probe calls
+    through: if they all succeed it closes again, if one fails it reopens.
+    """
+
+    def __init__(self, key: str, failure_rate: float, min_requests: int, slow_call_seconds: float,
+                 open_seconds: float, probes: int):
+        """
+        :param key: Name of the backend endpoint, used in logs.
+        :param failure_rate: Share (0 to 1) of failed or slow calls opening the circuit.
+        :param min_requests: Calls needed in the window before the failure rate is evaluated.
+        :param slow_call_seconds: Calls taking longer count as failed, 0 to only count errors.
+        :param open_seconds: Seconds the circuit stays open before probing.
+        :param probes: Probe calls let through (and needed to succeed) while half open.
+        """
+        self.key = key
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.probes = probes
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+        # (time, failed) of the calls in the window
+        self._outcomes: deque[tuple[float, bool]] = deque()
+        self._failures = 0
+        self._probes_started = 0
+        self._probes_succeeded = 0
+
+    def before_call(self) -> bool:
+        """
+        Let a call through or reject it.
+
+        :return: Whether the call is a probe of a half open circuit, pass it on to after_call.
+        :raises CircuitOpenError: If the circuit is open or all probes are in flight.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                retry_after = self.opened_at + self.open_seconds - time.monotonic()
+                if retry_after > 0:
+                    raise CircuitOpenError(self.key, retry_after)
+                self.state = HALF_OPEN
+                self._probes_started = 0
+                self._probes_succeeded = 0
+                logger.info("Circuit of %s is half open", self.key)
+
+            if self.state == HALF_OPEN:
+                if self._probes_started >= self.probes:
+                    raise CircuitOpenError(self.key, self.open_seconds)
+                self._probes_started += 1
+                return True
+            return False
+
+    def is_open(self) -> bool:
+        """Whether calls are rejected right now, without taking a probe of a half open circuit."""
+
+        with self._lock:
+            return self.state == OPEN and time.monotonic() < self.opened_at + self.open_seconds
+
+    def after_call(self, probe: bool, failed: bool | None, seconds: float | None = None):
+        """
+        Record the outcome of a call let through by before_call.
+
+        :param probe: The value returned by before_call.
+        :param failed: Whether the call failed, None if it ended without an outcome (e.g. cancelled by the client).
+        :param seconds: Time the backend took to respond.
+        """
+        if failed is not None and seconds is not None and 0 < self.slow_call_seconds < seconds:
+            failed = True
+
+        with self._lock:
+            if probe:
+                if self.state != HALF_OPEN:
+                    return
+                if failed is None:
+                    # give the probe to another call
+                    self._probes_started -= 1
+                elif failed:
+                    self._open()
+                else:
+                    self._probes_succeeded += 1
+                    if self._probes_succeeded >= self.probes:
+                        self.state = CLOSED
+                        self._outcomes.clear()
+                        self._failures = 0
+                        logger.info("Circuit of %s is closed", self.key)
+                return
+
+            if failed is None or self.state != CLOSED:
+                return
+
+            now = time.monotonic()
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes[0][0] < now - WINDOW_SECONDS:
+                self._failures -= self._outcomes.popleft()[1]
+
+            if len(self._outcomes) >= self.min_requests and \
+                    self._failures >= self.failure_rate * len(self._outcomes):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._failures = 0
+        logger.warning("Circuit of %s is open for %g seconds", self.key, self.open_seconds)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            state = self.state
+            if state == OPEN and time.monotonic() >= self.opened_at + self.open_seconds:
+                state = HALF_OPEN
+            return {
+                "state": state,
+                "requests": len(self._outcomes),
+                "failures": self._failures,
+                "retry_after": max(self.opened_at + self.open_seconds - time.monotonic(), 0) if state == OPEN else None
+            }
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """
+    Whether an exception raised by a backend counts against its circuit: server errors, timeouts and connection
+    errors do, errors caused by the request itself (4xx responses) do not.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        # the errors of the mistral client
+        status_code = getattr(error, "http_status", None)
+    if status_code is None and getattr(error, "response", None) is not None:
+        status_code = getattr(error.response, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code >= 500
+    if error.__cause__ is not None:
+        return is_backend_failure(error.__cause__)
+    return True
+
+
+_settings: dict | None = None
+_breakers: dict[str, CircuitBreaker] = {}
+_lock = threading.Lock()
+
+
+def init_circuit_breakers(failure_rate: float, min_requests: int, slow_call_seconds: float, open_seconds: float,
+                          probes: int):
+    """
+    Configure the circuit breakers of the backends, resetting their state.
+
+    :param failure_rate: Share of failed or slow calls opening a circuit, 0 to disable the circuit breakers.
+    """
+    global _settings
+    with _lock:
+        _breakers.clear()
+        _settings = dict(failure_rate=failure_rate, min_requests=min_requests, slow_call_seconds=slow_call_seconds,
+                         open_seconds=open_seconds, probes=probes) if failure_rate > 0 else None
+
+
+def get_circuit_breaker(backend_name: str, endpoint: str) -> CircuitBreaker | None:
+    """Get the circuit breaker of a backend endpoint, None if circuit breakers are disabled."""
+
+    key = backend_name + "/" + endpoint
+    breaker = _breakers.get(key)
+    if breaker is not None or _settings is None:
+        return breaker
+
+    with _lock:
+        if _settings is None:
+            return None
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(key, **_settings)
+        return _breakers[key]
+
+
+def get_circuit_breakers() -> dict[str, CircuitBreaker]:
+    """Get the circuit breakers created so far, by backend endpoint."""
+
+    return dict(_breakers)
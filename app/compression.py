@@ -0,0 +1,187 @@
+import zlib
+from typing import Iterable, Iterator
+
+from flask import Flask, Response, request, jsonify, current_app
+
+# brotli and zstd are optional, the encodings are only offered when the packages are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression levels favour speed, responses are compressed on the request path
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+class StreamCompressor:
+    """Incremental compressor for a single response body in one of the supported encodings."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise ValueError("Unsupported encoding: " + encoding)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """
+        Compress a part of the body.
+
+        :param data: The data to compress.
+        :param flush: Whether to flush the compressor, so the client can decode everything written so far.
+        :return: The compressed data available so far.
+        """
+        if self.encoding == "gzip":
+            return self._compressor.compress(data) + (self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else b"")
+        elif self.encoding == "br":
+            return self._compressor.process(data) + (self._compressor.flush() if flush else b"")
+        else:
+            return self._compressor.compress(data) + \
+                (self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK) if flush else b"")
+
+    def finish(self) -> bytes:
+        """Finish the compressed stream."""
+
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def get_supported_encodings() -> list[str]:
+    """Get the supported content encodings, in order of preference."""
+
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate_encoding(accept_encoding: str | None, allowed_encodings: Iterable[str]) -> str | None:
+    """
+    Pick the response encoding based on the Accept-Encoding header.
+
+    :param accept_encoding: Value of the Accept-Encoding header.
+    :param allowed_encodings: Encodings that may be used, in order of preference.
+    :return: The best encoding accepted by the client or None to send the response uncompressed.
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in allowed_encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compress_stream(body: Iterable, encoding: str) -> Iterator[bytes]:
+    # every item of a streamed body is a complete event, flush after each of them so no token is held back
+    compressor = StreamCompressor(encoding)
+    try:
+        for item in body:
+            if isinstance(item, str):
+                item = item.encode()
+            data = compressor.compress(item, flush=True)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        # make sure the upstream stream is closed when the client goes away
+        if hasattr(body, "close"):
+            body.close()
+
+
+def decompress_request_body():
+    """Decompress request bodies sent with Content-Encoding: gzip."""
+
+    encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if not encoding or encoding == "identity":
+        return None
+
+    if encoding != "gzip":
+        return jsonify({"error": "Unsupported Content-Encoding: " + encoding}), 415
+
+    # limit the decompressed size, a small compressed body can expand to gigabytes
+    max_size = current_app.config.get("MAX_DECOMPRESSED_REQUEST_SIZE")
+    decompressor = zlib.decompressobj(31)
+    try:
+        body = decompressor.decompress(request.get_data(cache=False), max_size + 1)
+    except zlib.error as e:
+        return jsonify({"error": "Invalid gzip request body: " + str(e)}), 400
+
+    if len(body) > max_size:
+        return jsonify({"error": "Decompressed request body is too large"}), 413
+    if not decompressor.eof:
+        return jsonify({"error": "Invalid gzip request body: truncated data"}), 400
+
+    # replace the cached raw body, the request is then parsed as if it had been sent uncompressed
+    request._cached_data = body
+    request.environ["CONTENT_LENGTH"] = str(len(body))
+    del request.environ["HTTP_CONTENT_ENCODING"]
+    return None
+
+
+def compress_response(response: Response) -> Response:
+    """Compress the response if the client accepts a supported encoding."""
+
+    allowed_encodings = current_app.config.get("COMPRESSION_ENCODINGS")
+    if not allowed_encodings or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"),
+                                  [x for x in get_supported_encodings() if x in allowed_encodings])
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get("COMPRESSION_MIN_SIZE"):
+            return response
+
+        compressor = StreamCompressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+        # the compressed body is only semantically equivalent, weak ETags still match on conditional requests
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_app(app: Flask):
+    app.before_request(decompress_request_body)
+    app.after_request(compress_response)
@@ -19,6 +19,59 @@ class Config(dict):
         self.TARGET_API = os.environ.get("TARGET_API", None)
         self.AUTH_MODE = AuthMode(os.environ.get("AUTH_MODE", "PASS_API_KEY"))
         self.AUTH_KEY = os.environ.get("AUTH_KEY", None)
+        self.CLIENT_KEYS_FILE = os.environ.get("CLIENT_KEYS_FILE", None)
         self.SERVER_PORT = int(os.environ.get("SERVER_PORT", 8000))
+        self.UNIX_SOCKET = os.environ.get("UNIX_SOCKET", None)
+        self.UNIX_SOCKET_PERMS = int(os.environ.get("UNIX_SOCKET_PERMS", "600"), 8)
+        self.WORKERS = int(os.environ.get("WORKERS", 1))
+        self.WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get("WORKER_SHUTDOWN_TIMEOUT", 30))
         self.LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
         self.MODEL_NAME = os.environ.get("MODEL_NAME", None)
+        self.COMPRESSION_ENCODINGS = [
+            x.strip() for x in os.environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if x.strip()]
+        self.COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+        self.MAX_DECOMPRESSED_REQUEST_SIZE = int(os.environ.get("MAX_DECOMPRESSED_REQUEST_SIZE", 64 * 1024 * 1024))
+        self.SSE_FLUSH_WINDOW_MS = float(os.environ.get("SSE_FLUSH_WINDOW_MS", 0))
+        self.SSE_HEARTBEAT_INTERVAL = float(os.environ.get("SSE_HEARTBEAT_INTERVAL", 15))
+        self.UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "false").lower() == "true"
+        self.UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 100))
+        self.UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10))
+        self.UPSTREAM_FIRST_BYTE_TIMEOUT = float(os.environ.get("UPSTREAM_FIRST_BYTE_TIMEOUT", 300))
+        self.UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 600))
+        self.CASSETTE_MODE = os.environ.get("CASSETTE_MODE", None)
+        self.CASSETTE_PATH = os.environ.get("CASSETTE_PATH", "upstream.cassette.jsonl.gz")
+        self.IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+        self.IDEMPOTENCY_MAX_BYTES = int(os.environ.get("IDEMPOTENCY_MAX_BYTES", 64 * 1024 * 1024))
+        self.SESSION_TTL = float(os.environ.get("SESSION_TTL", 3600))
+        self.SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", 256 * 1024 * 1024))
+        self.ADMIN_KEY = os.environ.get("ADMIN_KEY", None)
+        self.USAGE_DB_PATH = os.environ.get("USAGE_DB_PATH", None)
+        self.USAGE_BATCH_SIZE = int(os.environ.get("USAGE_BATCH_SIZE", 500))
+        self.USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 1))
+        self.TRACING_EXPORT = os.environ.get("TRACING_EXPORT", None)
+        self.TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", 0.1))
+        self.TRACING_FILE_MAX_BYTES = int(os.environ.get("TRACING_FILE_MAX_BYTES", 100 * 1024 * 1024))
+        self.TRACING_FILE_BACKUPS = int(os.environ.get("TRACING_FILE_BACKUPS", 5))
+        self.MODEL_REFRESH_INTERVAL = float(os.environ.get("MODEL_REFRESH_INTERVAL", 0))
+        self.RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", None)
+        self.RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+        self.RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.9))
+        self.RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", None)
+        self.RESPONSE_CACHE_SLOT_SIZE = int(os.environ.get("RESPONSE_CACHE_SLOT_SIZE", 16384))
+        self.RESPONSE_CACHE_MODELS = [
+            x.strip() for x in os.environ.get("RESPONSE_CACHE_MODELS", "").split(",") if x.strip()]
+        self.RESPONSE_CACHE_KEYS = [
+            x.strip() for x in os.environ.get("RESPONSE_CACHE_KEYS", "").split(",") if x.strip()]
+        self.EMBEDDING_BATCH_WINDOW_MS = float(os.environ.get("EMBEDDING_BATCH_WINDOW_MS", 5))
+        self.CIRCUIT_BREAKER_FAILURE_RATE = float(os.environ.get("CIRCUIT_BREAKER_FAILURE_RATE", 0.5))
+        self.CIRCUIT_BREAKER_MIN_REQUESTS = int(os.environ.get("CIRCUIT_BREAKER_MIN_REQUESTS", 10))
+        self.CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", 0))
+        self.CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get("CIRCUIT_BREAKER_OPEN_SECONDS", 30))
+        self.CIRCUIT_BREAKER_PROBES = int(os.environ.get("CIRCUIT_BREAKER_PROBES", 3))
+        self.RACE_GROUPS = os.environ.get("RACE_GROUPS", None)
+        self.AUTO_MODELS = [x.strip() for x in os.environ.get(
+            "AUTO_MODELS", "claude-3-haiku-20240307,mistral-small-latest,command-r,gpt-3.5-turbo").split(",")
+            if x.strip()]
+        self.AUTO_LATENCY_SLO_MS = float(os.environ.get("AUTO_LATENCY_SLO_MS", 0))
+        self.AUTO_EXPLORATION = float(os.environ.get("AUTO_EXPLORATION", 0.05))
+        self.CONTEXT_TRUNCATION = os.environ.get("CONTEXT_TRUNCATION", "disabled")
@@ -0,0 +1,170 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, AnyStr, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class DeadlineExceeded(Exception):
+    """The total time allowed for a request has passed."""
+
+
+class Deadline:
+    """
+    Time limits of a request for the upstream calls made on its behalf, and the signal to abort them once the client
+    went away.
+    """
+
+    def __init__(self, total: float | None = None, connect: float | None = None, first_byte: float | None = None):
+        """
+        :param total: Seconds the whole upstream exchange, including a streamed response, may take.
+        :param connect: Seconds to wait for a connection to the upstream.
+        :param first_byte: Seconds to wait for the upstream to start responding (and between the chunks of a stream).
+        """
+        self.total = total
+        self.connect = connect
+        self.first_byte = first_byte
+        self.started_at = time.monotonic()
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._cancel_callbacks: list[Callable[[], None]] = []
+
+    @classmethod
+    def from_header(cls, header: str | None, total: float | None = None, connect: float | None = None,
+                    first_byte: float | None = None) -> 'Deadline':
+        """
+        Create the deadline of a request from its X-Request-Timeout header.
+
+        The header is either the total seconds ("30") or a list of limits ("total=30, connect=2, first_byte=10"). It
+        can only shorten the configured limits.
+
+        :param header: Value of the X-Request-Timeout header.
+        :param total: Configured total limit, None or 0 for no limit.
+        :param connect: Configured connect limit, None or 0 for no limit.
+        :param first_byte: Configured first byte limit, None or 0 for no limit.
+        :raises ValueError: If the header is malformed.
+        """
+        limits = {"total": total or None, "connect": connect or None, "first_byte": first_byte or None}
+        if header:
+            parts = [part.strip() for part in header.split(",") if part.strip()]
+            if len(parts) == 1 and "=" not in parts[0]:
+                parts = ["total=" + parts[0]]
+            for part in parts:
+                name, _, value = part.partition("=")
+                name = name.strip().replace("-", "_")
+                if name not in limits:
+                    raise ValueError("Unknown timeout: " + name)
+                seconds = float(value)
+                if not seconds > 0:
+                    raise ValueError("Timeouts must be positive")
+                limits[name] = min(seconds, limits[name]) if limits[name] is not None else seconds
+        return cls(**limits)
+
+    def remaining(self) -> float | None:
+        """Seconds left until the total limit, None if there is none."""
+
+        if self.total is None:
+            return None
+        return max(self.total - (time.monotonic() - self.started_at), 0)
+
+    def check(self):
+        """Raise DeadlineExceeded if the total limit has passed."""
+
+        if self.total is not None and self.remaining() <= 0:
+            raise DeadlineExceeded(f"Request exceeded its deadline of {self.total:g} seconds")
+
+    def get_seconds(self) -> float | None:
+        """Single timeout for SDKs that only take one value: the first byte limit, capped at the remaining time."""
+
+        return _min(self.first_byte, self.remaining())
+
+    def get_timeout(self) -> 'httpx.Timeout':
+        """Timeout for an httpx request or an SDK client using httpx, capped at the remaining time."""
+
+        import httpx
+
+        remaining = self.remaining()
+        return httpx.Timeout(connect=_min(self.connect, remaining), read=_min(self.first_byte, remaining),
+                             write=remaining, pool=remaining)
+
+    def child(self) -> 'Deadline':
+        """
+        Deadline of a part of the request, e.g. one of several concurrent upstream calls.
+
+        It has the remaining limits of this deadline and is cancelled with it, but can also be cancelled on its own.
+        """
+        child = Deadline(self.remaining(), self.connect, self.first_byte)
+        self.on_cancel(child.cancel)
+        return child
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Register a callback aborting an upstream call when the request is cancelled.
+
+        :return: Function unregistering the callback, call it once the upstream call is finished.
+        """
+        with self._lock:
+            if not self.cancelled:
+                self._cancel_callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._cancel_callbacks:
+                self._cancel_callbacks.remove(callback)
+
+    def cancel(self):
+        """Abort the upstream calls still running for the request, e.g. because the client disconnected."""
+
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def guard(self, frames: Iterator[AnyStr]) -> Iterator[AnyStr]:
+        """Pass a stream through until it ends, the total limit passes or the request is cancelled."""
+
+        try:
+            for frame in frames:
+                if self.cancelled:
+                    return
+                self.check()
+                yield frame
+        finally:
+            if hasattr(frames, "close"):
+                frames.close()
+
+
+@contextmanager
+def abort_on_cancel(deadline: Deadline | None, abort: Callable[[], None]):
+    """Call `abort` if the request is cancelled while the block runs."""
+
+    remove_callback = deadline.on_cancel(abort) if deadline is not None else None
+    try:
+        yield
+    finally:
+        if remove_callback is not None:
+            remove_callback()
+
+
+def _min(a: float | None, b: float | None) -> float | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def is_timeout_error(error: BaseException) -> bool:
+    """Whether an exception raised by a backend was caused by an upstream timeout."""
+
+    while error is not None:
+        if isinstance(error, (DeadlineExceeded, TimeoutError)) or "Timeout" in type(error).__name__:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
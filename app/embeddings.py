@@ -0,0 +1,151 @@
+import base64
+import sys
+import threading
+from array import array
+
+from app import fanout
+from app.deadline import Deadline
+from app.models import TargetApiBackend, Embeddings
+
+
+class _Caller:
+    """Inputs of one embedding request waiting in a batch, and the vectors scattered back to it."""
+
+    def __init__(self, inputs: list[str], deadline: Deadline | None):
+        self.inputs = inputs
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.vectors: list[list[float]] | None = None
+        self.prompt_tokens = 0
+        self.error: BaseException | None = None
+
+
+class _Batch:
+    def __init__(self):
+        self.callers: list[_Caller] = []
+        self.size = 0
+        # set once the batch reached the largest size the provider accepts
+        self.full = threading.Event()
+
+
+class EmbeddingBatcher:
+    """
+    Merges the inputs of concurrent embedding requests for the same model (and API key) into shared upstream calls.
+
+    The first request of a batch waits for the collection window (or until the batch is full) and then sends the
+    batch on behalf of all requests in it, the others wait for their vectors.
+    """
+
+    def __init__(self, window_ms: float):
+        """
+        :param window_ms: Milliseconds the first request of a batch waits for others, 0 to send every request alone.
+        """
+        self.window = window_ms / 1000
+        self._lock = threading.Lock()
+        # (backend, model, API key) -> batch still collecting inputs
+        self._batches: dict[tuple[str, str, str], _Batch] = {}
+
+    def embed(self, backend: TargetApiBackend, model: str, inputs: list[str], api_key: str,
+              deadline: Deadline | None = None) -> Embeddings:
+        """
+        Embed the inputs of a request, possibly together with the inputs of other requests.
+
+        :param deadline: Time limits of the request.
+        :return: One vector per input and the prompt tokens attributed to the request.
+        :raises DeadlineExceeded: If the total limit passed while waiting for the batch of another request.
+        """
+        if self.window <= 0:
+            return self._send(backend, model, inputs, api_key, deadline)
+
+        key = (backend.name, model, api_key)
+        caller = _Caller(inputs, deadline)
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = _Batch()
+            batch.callers.append(caller)
+            batch.size += len(inputs)
+            if batch.size >= backend.max_embedding_batch_size:
+                # later requests start a new batch
+                del self._batches[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            self._run(backend, model, api_key, batch.callers)
+
+        if not caller.done.wait(deadline.remaining() if deadline is not None else None):
+            deadline.check()
+        if caller.error is not None:
+            raise caller.error
+        return Embeddings(caller.vectors, caller.prompt_tokens)
+
+    def _run(self, backend: TargetApiBackend, model: str, api_key: str, callers: list[_Caller]):
+        inputs = [text for caller in callers for text in caller.inputs]
+        # the batch is sent on behalf of all of its requests, with the most generous limits among them
+        deadlines = [caller.deadline for caller in callers]
+        deadline = None if None in deadlines else max(
+            deadlines, key=lambda d: d.remaining() if d.remaining() is not None else float("inf"))
+        try:
+            embeddings = self._send(backend, model, inputs, api_key, deadline)
+        except BaseException as e:
+            for caller in callers:
+                caller.error = e
+                caller.done.set()
+            return
+
+        # the provider reports the tokens of the whole batch, split them by the length of the inputs
+        total_chars = sum(len(text) for text in inputs) or 1
+        start = 0
+        chars = 0
+        assigned_tokens = 0
+        for caller in callers:
+            end = start + len(caller.inputs)
+            chars += sum(len(text) for text in caller.inputs)
+            tokens = round(embeddings.prompt_tokens * chars / total_chars)
+            caller.vectors = embeddings.vectors[start:end]
+            caller.prompt_tokens = tokens - assigned_tokens
+            assigned_tokens = tokens
+            start = end
+            caller.done.set()
+
+    @staticmethod
+    def _send(backend: TargetApiBackend, model: str, inputs: list[str], api_key: str,
+              deadline: Deadline | None) -> Embeddings:
+        # inputs beyond the provider's batch size are sent in concurrent calls
+        size = backend.max_embedding_batch_size
+        chunks = [inputs[i:i + size] for i in range(0, len(inputs), size)]
+        if len(chunks) == 1:
+            return backend.create_embeddings(model, inputs, api_key, deadline)
+
+        results = list(fanout.get_executor().map(
+            lambda chunk: backend.create_embeddings(model, chunk, api_key, deadline), chunks))
+        return Embeddings([vector for result in results for vector in result.vectors],
+                          sum(result.prompt_tokens for result in results))
+
+
+def encode_base64(vector: list[float]) -> str:
+    """Encode a vector as a base64 string of little endian float32 values, as the OpenAI API does."""
+
+    values = array("f", vector)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode()
+
+
+embedding_batcher = EmbeddingBatcher(0)
+
+
+def init_embedding_batcher(window_ms: float):
+    """Configure the collection window of the embedding batcher."""
+
+    global embedding_batcher
+    embedding_batcher = EmbeddingBatcher(window_ms)
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    return embedding_batcher
@@ -0,0 +1,210 @@
+import copy
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from typing import Iterator, AnyStr
+
+from app import tracing
+from app.models import TargetApiBackend, OpenAICompletionRequest, OpenAICompletionResponse
+
+# largest n accepted, the same limit as the OpenAI API
+MAX_CHOICES = 128
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+END = object()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool running concurrent upstream calls."""
+
+    # created on first use, so worker processes forked by the supervisor each get their own threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="fanout")
+        return _executor
+
+
+def get_fanout(completionRequest: OpenAICompletionRequest, target_api_backend: TargetApiBackend) -> int:
+    """
+    Get the number of upstream calls needed to produce the choices of a request.
+
+    :return: n if the backend of the requested model cannot return several choices at once, otherwise 1.
+    """
+    if not completionRequest.n or completionRequest.n <= 1:
+        return 1
+    try:
+        backend = target_api_backend.get_backend(completionRequest.model)
+    except ValueError:
+        # unknown models are reported by the backend
+        return 1
+    return 1 if backend.supports_n else completionRequest.n
+
+
+def _clone(completionRequest: OpenAICompletionRequest) -> OpenAICompletionRequest:
+    # the clones share the deadline, so cancelling the request aborts all of their upstream calls
+    clone = copy.copy(completionRequest)
+    clone.n = None
+    clone.usage = None
+    return clone
+
+
+def handle_completion_request(target_api_backend: TargetApiBackend, completionRequest: OpenAICompletionRequest,
+                              pass_api_key: bool, choices: int) -> OpenAICompletionResponse:
+    """
+    Handle a (non-streamed) completion request with several choices by sending one request per choice upstream
+    concurrently.
+
+    :param choices: Number of upstream calls to make.
+    :return: A single response with the choices of all calls and their summed token usage.
+    """
+    executor = get_executor()
+    call = tracing.propagate(target_api_backend.handle_completion_request)
+    futures = [executor.submit(call, _clone(completionRequest), pass_api_key) for _ in range(choices)]
+
+    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in done:
+        if future.exception() is not None:
+            # the request failed, drop the calls not started yet and abort the running ones that can be aborted
+            # (streams and HTTP/2 requests), blocking calls finish in the background
+            for other in futures:
+                other.cancel()
+            if completionRequest.deadline is not None:
+                completionRequest.deadline.cancel()
+            raise future.exception()
+
+    responses = [future.result() for future in futures]
+    merged_choices = []
+    for response in responses:
+        for choice in response.choices:
+            merged_choices.append(dict(choice, index=len(merged_choices)))
+
+    return OpenAICompletionResponse(
+        completion_id=responses[0].id,
+        model=responses[0].model,
+        choices=merged_choices,
+        completionTokens=sum(response.completionTokens or 0 for response in responses),
+        promptTokens=sum(response.promptTokens or 0 for response in responses),
+        system_fingerprint=responses[0].system_fingerprint
+    )
+
+
+class StreamReader(threading.Thread):
+    """Reads a stream on a background thread and passes its frames to a queue as (index, frame), followed by
+    (index, END) or (index, exception)."""
+
+    def __init__(self, frames: Iterator[AnyStr], index: int, output: queue.Queue, stopped: threading.Event):
+        # a thread per stream instead of the shared pool, a stream occupies its thread until it ends
+        super().__init__(name="stream-reader", daemon=True)
+        self.frames = tracing.bind(frames)
+        self.index = index
+        self.output = output
+        self.stopped = stopped
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                if not self._put((self.index, frame)):
+                    break
+            else:
+                self._put((self.index, END))
+        except BaseException as e:
+            self._put((self.index, e))
+        finally:
+            if hasattr(self.frames, "close"):
+                self.frames.close()
+
+    def _put(self, item) -> bool:
+        # bounded queue: a slow client slows the upstream reads down instead of buffering the whole completions
+        while not self.stopped.is_set():
+            try:
+                self.output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def parse_frame(frame: AnyStr) -> dict | str | None:
+    """Parse an SSE frame: "[DONE]" for the end marker, the chunk of a data frame, None for anything else."""
+
+    if isinstance(frame, bytes):
+        frame = frame.decode()
+    if not frame.startswith("data:"):
+        return None
+    data = frame[5:].strip()
+    if data == "[DONE]":
+        return data
+    return json.loads(data)
+
+
+def handle_streamed_completion_request(target_api_backend: TargetApiBackend,
+                                       completionRequest: OpenAICompletionRequest, pass_api_key: bool,
+                                       choices: int) -> Iterator[AnyStr]:
+    """
+    Handle a streamed completion request with several choices by streaming one request per choice from upstream
+    concurrently.
+
+    The chunks of the streams are interleaved as they arrive, each with the index of its choice and all with the id
+    of the first chunk. The usage chunk and the end marker are sent once after all streams ended.
+
+    :param choices: Number of upstream streams.
+    """
+    clones = [_clone(completionRequest) for _ in range(choices)]
+    output: queue.Queue = queue.Queue(maxsize=256)
+    stopped = threading.Event()
+    streams = [StreamReader(target_api_backend.handle_streamed_completion_request(clone, pass_api_key), index,
+                             output, stopped)
+               for index, clone in enumerate(clones)]
+    for stream in streams:
+        stream.start()
+
+    completion_id = None
+    # usage chunks and end markers of the upstream streams, replaced by a single one each
+    usage_chunks = []
+    done = False
+    running = choices
+    try:
+        while running:
+            index, item = output.get()
+            if item is END:
+                running -= 1
+                continue
+            if isinstance(item, BaseException):
+                raise item
+
+            chunk = parse_frame(item)
+            if chunk is None:
+                continue
+            if chunk == "[DONE]":
+                done = True
+                continue
+            if not chunk.get("choices") and chunk.get("usage"):
+                usage_chunks.append(chunk)
+                continue
+
+            completion_id = completion_id or chunk.get("id")
+            chunk["id"] = completion_id
+            for choice in chunk.get("choices") or []:
+                choice["index"] = index
+            yield "data:" + json.dumps(chunk) + "\n\n"
+    finally:
+        stopped.set()
+        if running and completionRequest.deadline is not None:
+            # the client went away or a stream failed, abort the streams still reading
+            completionRequest.deadline.cancel()
+
+    if all(clone.usage is not None for clone in clones):
+        completionRequest.usage = {key: sum(clone.usage[key] for clone in clones)
+                                   for key in ("prompt_tokens", "completion_tokens")}
+
+    if usage_chunks and completionRequest.usage is not None:
+        usage = completionRequest.usage
+        chunk = dict(usage_chunks[-1], id=completion_id,
+                     usage=dict(usage, total_tokens=usage["prompt_tokens"] + usage["completion_tokens"]))
+        yield "data:" + json.dumps(chunk) + "\n\n"
+    if done:
+        yield "data: [DONE]\n\n"
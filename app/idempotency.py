@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, AnyStr
+
+logger = logging.getLogger(__name__)
+
+# approximate bytes used by an entry besides its frames
+ENTRY_OVERHEAD = 300
+
+
+class IdempotentStreamError(Exception):
+    """Raised to the clients following a stream whose original request failed."""
+
+
+class IdempotentEntry:
+    """The response to a request sent with an Idempotency-Key header, shared with the retries of the request."""
+
+    def __init__(self, key: bytes, fingerprint: bytes, streamed: bool):
+        """
+        :param key: The key of the entry in the store.
+        :param fingerprint: Digest of the request body, a key may only be reused with the same body.
+        :param streamed: Whether the frames are SSE frames of a stream or a single JSON body.
+        """
+        self.key = key
+        self.fingerprint = fingerprint
+        self.streamed = streamed
+        self.frames: list[bytes] = []
+        self.size = ENTRY_OVERHEAD
+        self.done = False
+        self.failed = False
+        # monotonic time the entry is removed from the store, set once it is done
+        self.expires_at = 0.0
+        self._condition = threading.Condition()
+
+    def append(self, frame: AnyStr):
+        frame = frame.encode() if isinstance(frame, str) else frame
+        with self._condition:
+            self.frames.append(frame)
+            self.size += len(frame)
+            self._condition.notify_all()
+
+    def finish(self, failed: bool):
+        with self._condition:
+            self.done = True
+            self.failed = failed
+            self._condition.notify_all()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait until the original request finished, returns False on a timeout."""
+
+        with self._condition:
+            return self._condition.wait_for(lambda: self.done, timeout)
+
+    def wait_started(self, timeout: float | None = None) -> bool:
+        """Wait until the original stream sent its first frame or finished, returns False on a timeout."""
+
+        with self._condition:
+            return self._condition.wait_for(lambda: bool(self.frames) or self.done, timeout)
+
+    def get_body(self) -> bytes:
+        return b"".join(self.frames)
+
+    def follow(self) -> Iterator[bytes]:
+        """
+        Replay the frames buffered so far and then the live ones until the original stream ends.
+
+        :raises IdempotentStreamError: If the original stream failed.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: index < len(self.frames) or self.done)
+                frames = self.frames[index:]
+                done, failed = self.done, self.failed
+            index += len(frames)
+            yield from frames
+            if done:
+                if failed:
+                    raise IdempotentStreamError("The original stream failed")
+                return
+
+
+class IdempotencyStore:
+    """
+    Responses of requests sent with an Idempotency-Key header, so retries of a request attach to the running request
+    or get its stored response instead of calling the upstream again.
+
+    Keys are scoped to the API key of the client. Completed responses are kept for `ttl` seconds, the oldest ones are
+    evicted to stay within the memory budget. Only successful responses are kept, a retry of a failed request is sent
+    upstream again.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int):
+        """
+        :param ttl: Seconds a completed response is kept.
+        :param max_bytes: Memory budget of the completed responses.
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.replays = 0
+
+        self._lock = threading.Lock()
+        # entries of running requests
+        self._pending: dict[bytes, IdempotentEntry] = {}
+        # entries of completed requests, in the order they completed
+        self._completed: OrderedDict[bytes, IdempotentEntry] = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending) + len(self._completed)
+
+    def begin(self, api_key: str | None, idempotency_key: str, request_json: dict, streamed: bool) \
+            -> tuple[IdempotentEntry | None, bool]:
+        """
+        Look up the entry of a request or start a new one.
+
+        :param request_json: The request body, retries have to send the same body.
+        :return: The entry (None if the key was used with a different body) and whether the caller created it and has
+            to complete or release it.
+        """
+        key = hashlib.blake2b(
+            (api_key or "").encode() + b"\0" + idempotency_key.encode(), digest_size=16).digest()
+        fingerprint = hashlib.blake2b(
+            json.dumps(request_json, sort_keys=True, default=str).encode(), digest_size=16).digest()
+
+        with self._lock:
+            self._expire()
+            entry = self._pending.get(key) or self._completed.get(key)
+            if entry is not None:
+                if entry.fingerprint != fingerprint:
+                    return None, False
+                self.replays += 1
+                return entry, False
+
+            entry = IdempotentEntry(key, fingerprint, streamed)
+            self._pending[key] = entry
+            return entry, True
+
+    def complete(self, entry: IdempotentEntry, body: bytes | None = None):
+        """
+        Store the response of a request that succeeded.
+
+        :param body: The body of a non-streamed response, the frames of streams are appended as they arrive.
+        """
+        if body is not None:
+            entry.append(body)
+        entry.finish(False)
+
+        with self._lock:
+            if self._pending.get(entry.key) is not entry:
+                return
+            del self._pending[entry.key]
+            if entry.size > self.max_bytes:
+                return
+            entry.expires_at = time.monotonic() + self.ttl
+            self._completed[entry.key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._evict()
+
+    def release(self, entry: IdempotentEntry):
+        """Drop the entry of a request that failed, the next retry is sent upstream again."""
+
+        with self._lock:
+            if self._pending.get(entry.key) is entry:
+                del self._pending[entry.key]
+        # waiting retries start over once the entry is gone
+        entry.finish(True)
+
+    def record(self, entry: IdempotentEntry, frames: Iterator[AnyStr]) -> Iterator[bytes]:
+        """
+        Read a stream into an entry on a background thread, so it runs to completion for the retries even if the
+        client that started it goes away.
+
+        :return: The frames of the entry, followed live.
+        """
+        def run():
+            try:
+                for frame in frames:
+                    entry.append(frame)
+            except Exception:
+                logger.warning("Recording the stream of an idempotent request failed", exc_info=True)
+                self.release(entry)
+                return
+            finally:
+                if hasattr(frames, "close"):
+                    frames.close()
+            self.complete(entry)
+
+        threading.Thread(target=run, name="idempotent-stream", daemon=True).start()
+        return entry.follow()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._completed:
+            entry = next(iter(self._completed.values()))
+            if entry.expires_at > now:
+                break
+            self._evict()
+
+    def _evict(self):
+        _, entry = self._completed.popitem(last=False)
+        self.size -= entry.size
+
+
+idempotency_store: IdempotencyStore | None = None
+
+
+def init_idempotency_store(ttl: float, max_bytes: int):
+    """Honor Idempotency-Key headers, keeping completed responses for `ttl` seconds. A ttl of 0 disables them."""
+
+    global idempotency_store
+    idempotency_store = IdempotencyStore(ttl, max_bytes) if ttl > 0 else None
+
+
+def get_idempotency_store() -> IdempotencyStore | None:
+    """Get the idempotency store, None if Idempotency-Key headers are ignored."""
+
+    return idempotency_store
@@ -1,24 +1,30 @@
 import json
+import threading
 import time
-from typing import Iterator, AnyStr, Iterable
-from openai.types.chat import ChatCompletionToolParam
+from typing import Iterator, AnyStr, Iterable, Callable, TYPE_CHECKING
 
 from app.config import Config
+from app.deadline import Deadline
+
+if TYPE_CHECKING:
+    # only needed for type hints, importing the openai package at runtime would load the whole SDK
+    from openai.types.chat import ChatCompletionToolParam
 
 
 class OpenAICompletionRequest:
     """An OpenAI compatible completion request."""
 
     def __init__(self, api_key: str, model: str, max_tokens: int | None, messages,
-                 tools: Iterable[ChatCompletionToolParam] | None = None, stream: bool = False,
+                 tools: Iterable['ChatCompletionToolParam'] | None = None, stream: bool = False,
                  temperature: float | None = None, top_p: float | None = None, frequency_penalty: float | None = None,
                  presence_penalty: float | None = None, tool_choice: str | None = None,
-                 stop: str | list[str] | None = None, **kwargs):
+                 stop: str | list[str] | None = None, stream_options: dict | None = None,
+                 truncation: str | None = None, n: int | None = None, latency_slo_ms: float | None = None, **kwargs):
         self.api_key: str | None = api_key
         self.model: str = model
         self.messages = messages
         self.max_tokens: int | None = max_tokens
-        self.tools: Iterable[ChatCompletionToolParam] | None = tools
+        self.tools: Iterable['ChatCompletionToolParam'] | None = tools
         self.streamed: bool | None = stream
         self.temperature: float | None = temperature
         self.top_p: float | None = top_p
@@ -26,6 +32,23 @@ class OpenAICompletionRequest:
         self.presence_penalty: float | None = presence_penalty
         self.tool_choice: str = tool_choice
         self.stop: str | list[str] | None = stop
+        self.stream_options: dict | None = stream_options
+        # number of choices to generate
+        self.n: int | None = n
+        # "auto" to drop the oldest messages if the request does not fit the context window, not sent upstream
+        self.truncation: str | None = truncation
+        # latency target in milliseconds (time to first token for streams) for the auto-cheap model, not sent upstream
+        self.latency_slo_ms: float | None = latency_slo_ms
+
+        # time limits of the upstream calls, set by the route
+        self.deadline: Deadline | None = None
+
+        # token usage of a streamed request, {"prompt_tokens": int, "completion_tokens": int}, set by the backend
+        # once the stream has finished
+        self.usage: dict | None = None
+
+        # converted history of the chat session the request continues, None for requests outside of a session
+        self.conversions: ConversionCache | None = None
 
     @classmethod
     def from_request(cls, request, config: Config) -> 'OpenAICompletionRequest':
@@ -37,13 +60,22 @@ class OpenAICompletionRequest:
         :return: OpenAICompletionRequest object
         """
 
-        request_json = request.json
-
         # extract api key from request headers
         header_api_key = request.headers.get("Authorization")
         api_key: str = header_api_key.split("Bearer ")[1]
 
-        args = request_json
+        return cls.from_args(api_key, request.json, config)
+
+    @classmethod
+    def from_args(cls, api_key: str, args: dict, config: Config) -> 'OpenAICompletionRequest':
+        """
+        Create an OpenAI completion request from the fields of a request body.
+
+        :param api_key: API key of the request
+        :param args: the request body, the defaults are filled in
+        :param config: app config object
+        :return: OpenAICompletionRequest object
+        """
 
         # override max tokens if not specified
         if args.get("max_tokens") is None:
@@ -75,9 +107,44 @@ class OpenAICompletionRequest:
             request_args["tools"] = self.tools
         if self.stop:
             request_args["stop"] = self.stop
+        if self.n and self.n > 1:
+            request_args["n"] = self.n
         return request_args
 
 
+class OpenAIEmbeddingRequest:
+    """An OpenAI compatible embedding request."""
+
+    def __init__(self, api_key: str | None, model: str, input: str | list[str], encoding_format: str = "float",
+                 **kwargs):
+        self.api_key: str | None = api_key
+        self.model: str = model
+        self.inputs: list[str] = [input] if isinstance(input, str) else input
+        # "float" for lists of floats, "base64" for base64 encoded little endian float32 buffers
+        self.encoding_format: str = encoding_format or "float"
+
+    @classmethod
+    def from_request(cls, request) -> 'OpenAIEmbeddingRequest':
+        """
+        Create an OpenAI embedding request from a request object.
+
+        :param request: flask request object
+        :return: OpenAIEmbeddingRequest object
+        """
+        header_api_key = request.headers.get("Authorization")
+        api_key = header_api_key.split("Bearer ")[1] if header_api_key else None
+
+        return cls(api_key=api_key, **request.json)
+
+
+class Embeddings:
+    """Embedding vectors returned by a backend."""
+
+    def __init__(self, vectors: list[list[float]], prompt_tokens: int):
+        self.vectors = vectors
+        self.prompt_tokens = prompt_tokens
+
+
 class OpenAICompletionResponse:
     """A non streamed completion response."""
 
@@ -124,27 +191,179 @@ class OpenAICompletionChunkResponse:
         })
 
 
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+class ChunkEncoder:
+    """
+    Encodes the single choice chunks of one stream as SSE frames.
+
+    The fields that stay the same for the whole stream (id, object, created, model and fingerprint) are serialized once,
+    every chunk only escapes its delta. The frames are identical to the ones built from OpenAICompletionChunkResponse,
+    except that all chunks of a stream share the created timestamp as they do in the OpenAI API.
+    """
+
+    def __init__(self, model: str, completion_id: str | None = None):
+        self.model = model
+        self.created = int(time.time())
+        self.completion_id = None
+        self._prefix = b""
+        self._set_id(completion_id)
+
+    def _set_id(self, completion_id: str | None):
+        self.completion_id = completion_id
+        self._prefix = (
+            'data:{"id": ' + json.dumps(completion_id) + ', "object": "chat.completion.chunk", "created": ' +
+            str(self.created) + ', "model": ' + json.dumps(self.model) +
+            ', "system_fingerprint": "static_fingerprint", "choices": [{"index": 0, "delta": {'
+        ).encode()
+
+    def encode(self, content: str | None, role: str | None = None, completion_id: str | None = None) -> bytes:
+        """
+        Encode a chunk with a text delta.
+
+        :param content: The text of the delta, None for a null content.
+        :param role: The role sent with the delta, usually only in the first chunk.
+        :param completion_id: The id of the completion if it changed since the last chunk.
+        """
+        if completion_id is not None and completion_id != self.completion_id:
+            self._set_id(completion_id)
+        content_json = _encode_string(content) if content is not None else "null"
+        if role is None:
+            return self._prefix + b'"content": ' + content_json.encode() + b'}, "finish_reason": null}]}\n\n'
+        return self._prefix + b'"content": ' + content_json.encode() + b', "role": ' + \
+            _encode_string(role).encode() + b'}, "finish_reason": null}]}\n\n'
+
+    def finish(self, finish_reason: str, completion_id: str | None = None) -> bytes:
+        """Encode the last chunk of the choice, with an empty delta and the finish reason."""
+
+        if completion_id is not None and completion_id != self.completion_id:
+            self._set_id(completion_id)
+        return self._prefix + b'}, "finish_reason": ' + _encode_string(finish_reason).encode() + b'}]}\n\n'
+
+
+class MessageConverter:
+    """
+    Converts the messages of a conversation to the format of a provider one message at a time, so the converted
+    history of a chat session is kept and only the messages added since the last turn are converted.
+    """
+
+    def __init__(self):
+        # number of messages converted so far and the last of them
+        self.count = 0
+        self.last_message: dict | None = None
+
+    def add(self, message: dict):
+        """Convert the next message of the conversation."""
+        pass
+
+    def build(self):
+        """Get the converted conversation, without changing the state of the converter."""
+        pass
+
+    def continues(self, messages: list[dict]) -> bool:
+        """Whether the converted messages are the start of `messages`, i.e. none of them was dropped or replaced."""
+
+        return self.count == 0 or (self.count <= len(messages) and messages[self.count - 1] is self.last_message)
+
+    def extend(self, messages: list[dict]):
+        """Convert the messages following the ones converted so far."""
+
+        for message in messages[self.count:]:
+            self.add(message)
+        self.count = len(messages)
+        self.last_message = messages[-1] if messages else None
+
+
+class ConversionCache:
+    """The message converters of a chat session, by backend."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._converters: dict[str, MessageConverter] = {}
+
+    def convert(self, name: str, messages: list[dict], factory: Callable[[], MessageConverter]):
+        """
+        Convert a conversation, resuming the converter of the backend if it converted the start of the conversation.
+
+        :param name: Name of the backend.
+        :param factory: Creates a converter for the format of the backend.
+        :return: The result of MessageConverter.build.
+        """
+        with self._lock:
+            converter = self._converters.get(name)
+            if converter is None or not converter.continues(messages):
+                converter = factory()
+            converter.extend(messages)
+            self._converters[name] = converter
+            return converter.build()
+
+
+def convert_messages(completionRequest: OpenAICompletionRequest, name: str, factory: Callable[[], MessageConverter]):
+    """
+    Convert the messages of a request, reusing the converted history of its chat session.
+
+    :param name: Name of the backend.
+    :param factory: Creates a converter for the format of the backend.
+    :return: The result of MessageConverter.build.
+    """
+    if completionRequest.conversions is not None:
+        return completionRequest.conversions.convert(name, completionRequest.messages, factory)
+    converter = factory()
+    converter.extend(completionRequest.messages)
+    return converter.build()
+
+
 class AvailableModel:
     """A model available for completion requests."""
 
-    def __init__(self, id: str, object: str, created: int, owned_by: str):
+    def __init__(self, id: str, object: str, created: int, owned_by: str, context_window: int | None = None,
+                 prompt_price: float | None = None, completion_price: float | None = None):
+        """
+        :param context_window: Maximum number of prompt and completion tokens, None if unknown.
+        :param prompt_price: USD per million prompt tokens, None if unknown. Not part of the model list response.
+        :param completion_price: USD per million completion tokens, None if unknown.
+        """
         self.id = id
         self.object = object
         self.created = created
         self.owned_by = owned_by
+        self.context_window = context_window
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
 
     def to_dict(self) -> dict[str, str]:
-        return {
+        model = {
             "id": self.id,
             "object": self.object,
             "created": self.created,
             "owned_by": self.owned_by
         }
+        if self.context_window is not None:
+            model["context_window"] = self.context_window
+        return model
 
 
 class TargetApiBackend:
     """Base class for all API backends."""
 
+    # name of the backend, e.g. "anthropic"
+    name: str = ""
+
+    # upper limit the backend clamps max_tokens to, None if the requested max_tokens is passed on as is
+    max_output_tokens: int | None = None
+
+    # largest number of inputs the provider embeds in one call, None if the backend does not support embeddings
+    max_embedding_batch_size: int | None = None
+
+    # whether the provider generates several choices in one call (the n parameter), otherwise the choices are
+    # requested concurrently one call each
+    supports_n: bool = False
+
+    # whether the backend answers with the models of other backends, guarding every call with the circuit breaker of
+    # the backend serving the model instead of a breaker of its own
+    virtual: bool = False
+
     def __init__(self, base_url: str, api_key: str, models: list[AvailableModel]):
         self.base_url = base_url
         self.api_key = api_key
@@ -171,6 +390,53 @@ class TargetApiBackend:
         """
         pass
 
+    def get_backend(self, model_id: str) -> 'TargetApiBackend':
+        """
+        Get the backend that handles requests for a model.
+
+        :param model_id: The requested model.
+        :return: This backend, or for routing backends the backend the request is routed to.
+        """
+        return self
+
+    def get_embedding_backend(self, model_id: str) -> 'TargetApiBackend':
+        """
+        Get the backend that handles embedding requests for a model.
+
+        :param model_id: The requested embedding model.
+        :return: This backend, or for routing backends the backend the request is routed to.
+        """
+        return self
+
+    def create_embeddings(self, model: str, inputs: list[str], api_key: str, deadline: Deadline | None = None) \
+            -> Embeddings | None:
+        """
+        Embed a batch of inputs.
+
+        :param model: The embedding model.
+        :param inputs: Texts to embed, at most max_embedding_batch_size of them.
+        :param api_key: The API key to use.
+        :param deadline: Time limits of the upstream call.
+        :return: One vector per input, in the order of the inputs, or None if the backend does not support embeddings.
+        """
+        return None
+
+    def get_model(self, model_id: str) -> AvailableModel | None:
+        """Get a model of the backend's catalog, None if the backend does not list it."""
+
+        for model in self.models:
+            if model.id == model_id:
+                return model
+        return None
+
+    def list_upstream_models(self) -> list[AvailableModel] | None:
+        """
+        Fetch the live list of models from the provider, using the server's API key.
+
+        :return: The models offered by the provider or None if the backend does not support model discovery.
+        """
+        return None
+
     def get_api_key(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) -> str:
         """
         Get the API key to use for a completion request.
@@ -0,0 +1,248 @@
+import cProfile
+import functools
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+from typing import Iterable, Iterator, AnyStr, Callable
+
+from flask import Flask, Response
+
+# views whose requests are profiled, from parsing the request to the last byte of the response
+PROFILED_ENDPOINTS = ("routes.completions",)
+
+# orders of the text report
+SORT_KEYS = tuple(pstats.Stats.sort_arg_dict_default)
+
+# before Python 3.12 a profiler only sees the thread that enabled it, since 3.12 it is built on sys.monitoring and
+# sees every thread, with only one profiler active in the interpreter at a time
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+class ProfileSession:
+    """Profiles the next `requests` completion requests, or the ones started within `seconds`, merging the results."""
+
+    def __init__(self, requests: int | None = None, seconds: float | None = None):
+        """
+        :param requests: Number of requests to profile, None for no limit.
+        :param seconds: Seconds to profile requests for, None for no limit.
+        """
+        self.max_requests = requests
+        self.seconds = seconds
+        self.started_at = time.time()
+        self.ends_at = time.monotonic() + seconds if seconds else None
+        self.stopped = False
+        self.started = 0
+        self.finished = 0
+        self._stats: pstats.Stats | None = None
+        self._lock = threading.Lock()
+
+    def claim(self) -> bool:
+        """Count a request against the session, False once the session is over."""
+
+        with self._lock:
+            if not self.stopped and (self.ends_at is not None and time.monotonic() >= self.ends_at or
+                                     self.max_requests is not None and self.started >= self.max_requests):
+                self.stopped = True
+            if self.stopped:
+                return False
+            self.started += 1
+            return True
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+
+    def add(self, profile: cProfile.Profile, finished: bool = True):
+        """
+        Merge the profile of a request.
+
+        :param finished: Whether the request ended, False for the profile of a helper thread of the request.
+        """
+        profile.create_stats()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.finished += finished
+
+    def dump(self) -> bytes:
+        """The merged profile in the pstats file format, as written by `pstats.Stats.dump_stats`."""
+
+        with self._lock:
+            return marshal.dumps(self._stats.stats if self._stats is not None else {})
+
+    def format(self, sort: str, limit: int) -> str:
+        """The merged profile as the text report of `pstats.Stats.print_stats`."""
+
+        stream = io.StringIO()
+        with self._lock:
+            if self._stats is None:
+                return ""
+            stats = pstats.Stats(stream=stream)
+            stats.add(self._stats)
+        stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "active": not self.stopped,
+                "requests": self.max_requests,
+                "seconds": self.seconds,
+                "started_at": self.started_at,
+                "started_requests": self.started,
+                "finished_requests": self.finished
+            }
+
+
+session: ProfileSession | None = None
+_lock = threading.Lock()
+# held while a request is profiled, requests are profiled one at a time so their profilers never overlap
+_profiler_lock = threading.Lock()
+# session of the request being profiled on the current thread
+_local = threading.local()
+
+
+def start_profiling(app: Flask, new_session: ProfileSession):
+    """
+    Profile the requests of the profiled endpoints until the session is over.
+
+    The views are only wrapped while a session is active, otherwise requests run without any profiling overhead.
+    """
+    global session
+    with _lock:
+        if session is not None:
+            session.stop()
+        session = new_session
+        for endpoint in PROFILED_ENDPOINTS:
+            view = app.view_functions[endpoint]
+            if hasattr(view, "profile_session"):
+                view = view.__wrapped__
+            app.view_functions[endpoint] = _profiled_view(app, view, new_session)
+
+
+def stop_profiling(app: Flask, ended_session: ProfileSession):
+    """End a session and restore the original views, the results of the session stay available."""
+
+    ended_session.stop()
+    with _lock:
+        for endpoint in PROFILED_ENDPOINTS:
+            view = app.view_functions[endpoint]
+            if getattr(view, "profile_session", None) is ended_session:
+                app.view_functions[endpoint] = view.__wrapped__
+
+
+def get_profile_session() -> ProfileSession | None:
+    """Get the current (or last) profiling session, None if nothing has been profiled."""
+
+    return session
+
+
+def _profiled_view(app: Flask, view, profile_session: ProfileSession):
+    @functools.wraps(view)
+    def profiled_view(*args, **kwargs):
+        # requests arriving while another one is profiled are neither profiled nor counted
+        if not _profiler_lock.acquire(blocking=False):
+            return view(*args, **kwargs)
+        release = _release_once(_profiler_lock)
+        if not profile_session.claim():
+            release()
+            stop_profiling(app, profile_session)
+            return view(*args, **kwargs)
+
+        # every request has its own profile, they are merged once the request ends
+        profile = cProfile.Profile()
+        try:
+            _local.session = profile_session
+            profile.enable()
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            finally:
+                profile.disable()
+                _local.session = None
+        except BaseException:
+            release()
+            raise
+
+        if response.is_streamed:
+            # the body of a stream is produced while it is sent, after the view returned
+            response.response = _profiled_iterable(response.response, profile, profile_session, release=release)
+            # a body that is never iterated does not run the cleanup of the generator
+            response.call_on_close(release)
+        else:
+            profile_session.add(profile)
+            release()
+        return response
+
+    profiled_view.profile_session = profile_session
+    return profiled_view
+
+
+def profile_frames(frames: Iterator[AnyStr]) -> Iterator[AnyStr]:
+    """
+    Profile the frames of a stream if they are read on another thread than the profiled request (the SSE pump).
+
+    :return: The frames as they are if the request is not profiled.
+    """
+    profile_session = getattr(_local, "session", None)
+    if profile_session is None:
+        return frames
+    return _profiled_frames(frames, profile_session, threading.get_ident())
+
+
+def _profiled_frames(frames: Iterator[AnyStr], profile_session: ProfileSession,
+                     request_thread: int) -> Iterator[AnyStr]:
+    if threading.get_ident() == request_thread or not PER_THREAD_PROFILES:
+        # already covered by the profile of the request
+        yield from frames
+    else:
+        yield from _profiled_iterable(frames, cProfile.Profile(), profile_session, finished=False)
+
+
+def _release_once(lock: threading.Lock) -> Callable[[], None]:
+    # the stream cleanup and the close of the response both release, only the first one counts
+    guard = threading.Lock()
+
+    def release():
+        if guard.acquire(blocking=False):
+            lock.release()
+
+    return release
+
+
+def _profiled_iterable(iterable: Iterable[AnyStr], profile: cProfile.Profile, profile_session: ProfileSession,
+                       finished: bool = True, release: Callable[[], None] | None = None) -> Iterator[AnyStr]:
+    iterator = iter(iterable)
+    try:
+        while True:
+            profile.enable()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+            yield item
+    finally:
+        if hasattr(iterable, "close"):
+            profile.enable()
+            try:
+                iterable.close()
+            finally:
+                profile.disable()
+        profile_session.add(profile, finished)
+        if release is not None:
+            release()
+
+
+def profile_response(profile_session: ProfileSession, output_format: str, sort: str, limit: int) -> Response:
+    """Create a response with the merged profile of a session, `pstats` for the binary stats file or `text`."""
+
+    if output_format == "pstats":
+        return Response(profile_session.dump(), mimetype="application/octet-stream",
+                        headers={"Content-Disposition": "attachment; filename=proxy.pstats"})
+    return Response(profile_session.format(sort, limit), mimetype="text/plain")
@@ -0,0 +1,137 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+
+class TokenBucket:
+    """A bucket refilling continuously at `per_minute` units per minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_wait(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken, 0 if it can be taken right away."""
+
+        self._refill(now)
+        # requests larger than the bucket are let through once it is full, leaving it in debt
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def give(self, amount: float):
+        """Return units taken in excess, or take more for a negative amount."""
+
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ClientLimits:
+    """A client key and its request-rate and token-rate limits."""
+
+    def __init__(self, name: str, key_digest: bytes, requests_per_minute: float | None = None,
+                 tokens_per_minute: float | None = None):
+        """
+        :param name: Name of the client, used in logs.
+        :param key_digest: SHA-256 digest of the client's key.
+        :param requests_per_minute: Request rate limit, None for no limit.
+        :param tokens_per_minute: Prompt and completion token rate limit, None for no limit.
+        """
+        self.name = name
+        self.key_digest = key_digest
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens: int) -> float:
+        """
+        Count a request and its estimated tokens against the limits.
+
+        :return: 0 if the request is allowed, otherwise the seconds until it would be (nothing is counted then).
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.get_wait(1, now) if self.requests is not None else 0,
+                       self.tokens.get_wait(estimated_tokens, now) if self.tokens is not None else 0)
+            if wait > 0:
+                return wait
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(estimated_tokens)
+            return 0
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the tokens counted up front by acquire with the tokens the request actually used."""
+
+        if self.tokens is None:
+            return
+        with self._lock:
+            self.tokens.give(estimated_tokens - actual_tokens)
+
+
+def hash_client_key(key: str) -> bytes:
+    return hashlib.sha256(key.encode()).digest()
+
+
+class ClientKeyTable:
+    """The client keys accepted in CUSTOM_KEY mode, looked up by the hash of the key."""
+
+    def __init__(self, clients: list[ClientLimits]):
+        self._clients = {client.key_digest: client for client in clients}
+
+    def __len__(self):
+        return len(self._clients)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'ClientKeyTable':
+        """
+        Load the client keys from a JSON file.
+
+        :param path: JSON list of {"name", "key" or "key_sha256" (hex), "requests_per_minute", "tokens_per_minute"}
+            objects, the limits are optional.
+        """
+        with open(path) as f:
+            entries = json.load(f)
+
+        clients = []
+        for entry in entries:
+            key_digest = bytes.fromhex(entry["key_sha256"]) if "key_sha256" in entry else hash_client_key(entry["key"])
+            clients.append(ClientLimits(entry.get("name") or key_digest.hex()[:8], key_digest,
+                                        entry.get("requests_per_minute"), entry.get("tokens_per_minute")))
+        return cls(clients)
+
+    def lookup(self, key: str) -> ClientLimits | None:
+        """Get the client of a key, None if the key is unknown."""
+
+        key_digest = hash_client_key(key)
+        client = self._clients.get(key_digest)
+        # the hash lookup only finds candidates, the final comparison is constant time
+        if client is None or not hmac.compare_digest(client.key_digest, key_digest):
+            return None
+        return client
+
+
+client_keys: ClientKeyTable | None = None
+
+
+def init_client_keys(path: str | None):
+    """Load the client keys from `path`, None to only accept AUTH_KEY."""
+
+    global client_keys
+    client_keys = ClientKeyTable.from_file(path) if path else None
+
+
+def get_client_keys() -> ClientKeyTable | None:
+    """Get the client keys, None if no client keys are configured."""
+
+    return client_keys
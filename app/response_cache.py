@@ -0,0 +1,428 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+
+from app.models import OpenAICompletionRequest
+from app.rate_limits import hash_client_key
+
+# byte range locks of the shared memory cache, only available on unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# number of minimum hash values in a signature
+SIGNATURE_SIZE = 64
+
+# approximate bytes used by an entry besides its payload: the signature, the index bookkeeping and one bucket per band
+ENTRY_OVERHEAD = 8 * SIGNATURE_SIZE + 300
+BUCKET_OVERHEAD = 100
+
+_MASK = (1 << 64) - 1
+# added per bin of distance when an empty bin borrows the value of a neighbour
+_DENSIFY_OFFSET = 0x9E3779B97F4A7C15
+
+# uuids, ISO timestamps and long hex ids embedded in prompts, replaced so they do not affect the similarity (applied
+# to the lowercased text), other numbers are kept as they usually change the answer
+_VOLATILE_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+                               r"|\d{4}-\d{2}-\d{2}[t ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:z|[+-]\d{2}:?\d{2})?"
+                               r"|\b(?=[0-9a-f]*\d)[0-9a-f]{16,}\b")
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# header of the shared memory cache file: magic, slot size, slots
+_FILE_HEADER = struct.Struct("8sII")
+_FILE_MAGIC = b"LLMCACH1"
+_FILE_HEADER_SIZE = 64
+# slots of a hash bucket, a request can only be cached in one of the slots of its bucket
+SHARED_CACHE_WAYS = 8
+# header of a slot: version (odd while written) at 0, key at 8, payload length at 24, referenced flag at 28 and, in the
+# first slot of a bucket, the clock hand of the bucket at 29
+_SLOT_HEADER_SIZE = 32
+# process local locks guarding the buckets, the buckets are spread over them
+_LOCK_STRIPES = 64
+
+
+class ResponseCache:
+    """Cache of serialized completion responses."""
+
+    def __init__(self, models: list[str] | None = None, api_keys: list[str] | None = None):
+        """
+        :param models: Models whose responses may be cached, all models if empty.
+        :param api_keys: API keys whose requests may be answered from the cache, all keys if empty.
+        """
+        self.models = set(models or [])
+        self.api_keys = set(api_keys or [])
+
+    def allows(self, completionRequest: OpenAICompletionRequest) -> bool:
+        """Whether the cache may be used for a request."""
+
+        return (not self.models or completionRequest.model in self.models) and \
+            (not self.api_keys or completionRequest.api_key in self.api_keys)
+
+    def get(self, completionRequest: OpenAICompletionRequest) -> str | None:
+        """
+        Look up the response to a request.
+
+        :return: The serialized OpenAICompletionResponse or None on a miss.
+        """
+        pass
+
+    def put(self, completionRequest: OpenAICompletionRequest, payload: str):
+        """
+        Store the response to a request.
+
+        :param payload: The serialized OpenAICompletionResponse.
+        """
+        pass
+
+
+def get_request_scope(completionRequest: OpenAICompletionRequest) -> bytes:
+    """
+    Digest of the API key and everything but the messages of a request, cached responses are only shared within a
+    scope.
+    """
+    request_args = completionRequest.to_dict()
+    del request_args["messages"]
+    # callers only get the responses to their own requests back, so a key is only answered from the cache after the
+    # upstream accepted it
+    request_args["api_key"] = hash_client_key(completionRequest.api_key or "").hex()
+    return hashlib.blake2b(json.dumps(request_args, sort_keys=True, default=str).encode(), digest_size=16).digest()
+
+
+def get_shingles(messages) -> set[str]:
+    """Word trigrams of the normalized message contents."""
+
+    words = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text") or "" for part in content if part.get("type") == "text")
+        words.append("<" + message.get("role", "") + ">")
+        words.extend(_WORD_PATTERN.findall(_VOLATILE_PATTERN.sub("0", str(content or "").lower())))
+        for tool_call in message.get("tool_calls") or []:
+            words.append(tool_call["function"]["name"])
+            words.extend(_WORD_PATTERN.findall(_VOLATILE_PATTERN.sub("0", tool_call["function"]["arguments"].lower())))
+
+    if len(words) < 3:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def minhash_signature(shingles: set[str]) -> array:
+    """
+    MinHash signature of a set of shingles.
+
+    Uses one permutation hashing: every shingle is hashed once and the hash picks the bin it competes for, empty bins
+    borrow the value of the next non-empty bin. Estimates the Jaccard similarity like SIGNATURE_SIZE independent
+    permutations at the cost of one.
+    """
+    bins = [_MASK] * SIGNATURE_SIZE
+    for shingle in shingles:
+        value = hash(shingle) & _MASK
+        index = value % SIGNATURE_SIZE
+        value //= SIGNATURE_SIZE
+        if value < bins[index]:
+            bins[index] = value
+
+    if _MASK in bins and len(bins) != bins.count(_MASK):
+        filled = list(bins)
+        for index in range(SIGNATURE_SIZE):
+            distance = 1
+            while filled[index] == _MASK:
+                neighbour = bins[(index + distance) % SIGNATURE_SIZE]
+                if neighbour != _MASK:
+                    filled[index] = (neighbour + distance * _DENSIFY_OFFSET) & _MASK
+                distance += 1
+        bins = filled
+    return array("Q", bins)
+
+
+def _get_band_rows(threshold: float) -> int:
+    # with b bands of r rows, pairs with a similarity above about (1 / b) ** (1 / r) share a band, pick the most
+    # selective banding that still finds pairs somewhat below the threshold
+    rows = 1
+    while rows * 2 < SIGNATURE_SIZE and (rows * 2 / SIGNATURE_SIZE) ** (1 / (rows * 2)) <= threshold * 0.95:
+        rows *= 2
+    return rows
+
+
+class SimilarityCache(ResponseCache):
+    """
+    Response cache that also answers requests whose messages are nearly identical to a cached one, e.g. differing
+    only in whitespace, timestamps or ids.
+
+    Requests are indexed by the MinHash signature of their message shingles, split into bands that are looked up in
+    a hash table (locality-sensitive hashing), so a lookup costs a fixed number of dict accesses regardless of the
+    number of entries. The least recently used entries are evicted to stay within the memory budget.
+    """
+
+    def __init__(self, threshold: float, max_bytes: int, models: list[str] | None = None,
+                 api_keys: list[str] | None = None):
+        """
+        :param threshold: Minimum estimated similarity (0 to 1) of the messages for a cached response to be returned.
+        :param max_bytes: Memory budget of the payloads and the index.
+        """
+        super().__init__(models, api_keys)
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.band_rows = _get_band_rows(threshold)
+        self.bands = SIGNATURE_SIZE // self.band_rows
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # entry id -> (scope, signature, payload, bucket keys), in least recently used order
+        self._entries: OrderedDict[int, tuple[bytes, array, str, list[int]]] = OrderedDict()
+        # bucket key -> id of the latest entry in the bucket
+        self._buckets: dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_bucket_keys(self, scope: bytes, signature: array) -> list[int]:
+        rows = self.band_rows
+        return [hash((scope, band, signature[band * rows:(band + 1) * rows].tobytes())) for band in range(self.bands)]
+
+    def get(self, completionRequest: OpenAICompletionRequest) -> str | None:
+        scope = get_request_scope(completionRequest)
+        signature = minhash_signature(get_shingles(completionRequest.messages))
+        return self.lookup(scope, signature)
+
+    def lookup(self, scope: bytes, signature: array) -> str | None:
+        """Look up the cached payload most similar to a signature."""
+
+        bucket_keys = self._get_bucket_keys(scope, signature)
+        with self._lock:
+            best_id, best_similarity = None, self.threshold
+            for entry_id in {self._buckets.get(key) for key in bucket_keys}:
+                if entry_id is None:
+                    continue
+                entry_scope, entry_signature, _, _ = self._entries[entry_id]
+                if entry_scope != scope:
+                    continue
+                similarity = sum(a == b for a, b in zip(signature, entry_signature)) / SIGNATURE_SIZE
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def put(self, completionRequest: OpenAICompletionRequest, payload: str):
+        scope = get_request_scope(completionRequest)
+        signature = minhash_signature(get_shingles(completionRequest.messages))
+        self.insert(scope, signature, payload)
+
+    def insert(self, scope: bytes, signature: array, payload: str):
+        """Store a payload under a signature."""
+
+        entry_size = self._get_entry_size(payload)
+        if entry_size > self.max_bytes:
+            return
+
+        bucket_keys = self._get_bucket_keys(scope, signature)
+        with self._lock:
+            while self._entries and self.size + entry_size > self.max_bytes:
+                self._evict()
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, signature, payload, bucket_keys)
+            for key in bucket_keys:
+                self._buckets[key] = entry_id
+            self.size += entry_size
+
+    def _evict(self):
+        entry_id, (_, _, payload, bucket_keys) = self._entries.popitem(last=False)
+        for key in bucket_keys:
+            # newer entries may have taken over the bucket
+            if self._buckets.get(key) == entry_id:
+                del self._buckets[key]
+        self.size -= self._get_entry_size(payload)
+
+    def _get_entry_size(self, payload: str) -> int:
+        return len(payload) + ENTRY_OVERHEAD + self.bands * BUCKET_OVERHEAD
+
+
+class SharedMemoryCache(ResponseCache):
+    """
+    Response cache in a memory mapped file, shared by all worker processes of a node, answering requests with exactly
+    the same messages and parameters.
+
+    The file is a hash table of fixed size slots, grouped into buckets of SHARED_CACHE_WAYS slots. Writers lock the
+    bucket (a thread lock and a byte range lock of the file), readers do not lock: every slot has a version that is odd
+    while the slot is written, a read is only used if the version was even and did not change while reading. Payloads
+    are only copied out of the mapping once the key of the slot matched. A full bucket evicts with the clock algorithm,
+    skipping slots read since the hand last passed them.
+    """
+
+    def __init__(self, path: str, max_bytes: int, slot_size: int = 16384, models: list[str] | None = None,
+                 api_keys: list[str] | None = None):
+        """
+        :param path: File backing the cache, created if needed. Processes using the same file share the cache.
+        :param max_bytes: Size of the file.
+        :param slot_size: Bytes per slot, responses larger than a slot are not cached.
+        """
+        super().__init__(models, api_keys)
+        if fcntl is None:
+            raise RuntimeError("The shared memory response cache requires fcntl")
+        self.path = path
+        self.slot_size = slot_size
+        self.buckets = max(1, max_bytes // (slot_size * SHARED_CACHE_WAYS))
+        self.hits = 0
+        self.misses = 0
+
+        size = _FILE_HEADER_SIZE + self.buckets * SHARED_CACHE_WAYS * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # the first process to open the file lays it out, the others wait for it
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            header = _FILE_HEADER.pack(_FILE_MAGIC, slot_size, self.buckets * SHARED_CACHE_WAYS)
+            if os.fstat(self._fd).st_size != size or os.pread(self._fd, _FILE_HEADER.size, 0) != header:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, header, 0)
+            self._memory = mmap.mmap(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._view = memoryview(self._memory)
+        self._locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+    def __len__(self):
+        empty = bytes(16)
+        return sum(self._view[offset + 8:offset + 24] != empty
+                   for offset in range(_FILE_HEADER_SIZE, len(self._memory), self.slot_size))
+
+    def close(self):
+        self._view.release()
+        self._memory.close()
+        os.close(self._fd)
+
+    def _get_key(self, completionRequest: OpenAICompletionRequest) -> tuple[bytes, int]:
+        # the scope includes the API key, the messages are hashed as sent without normalizing anything
+        digest = hashlib.blake2b(get_request_scope(completionRequest), digest_size=16)
+        digest.update(json.dumps(completionRequest.messages, sort_keys=True, default=str).encode())
+        key = digest.digest()
+        return key, int.from_bytes(key[:8], "little") % self.buckets
+
+    def _get_bucket_offset(self, bucket: int) -> int:
+        return _FILE_HEADER_SIZE + bucket * SHARED_CACHE_WAYS * self.slot_size
+
+    def get(self, completionRequest: OpenAICompletionRequest) -> str | None:
+        key, bucket = self._get_key(completionRequest)
+        offset = self._get_bucket_offset(bucket)
+        for _ in range(SHARED_CACHE_WAYS):
+            # retry a slot that is written to while it is read
+            for _ in range(3):
+                version = struct.unpack_from("Q", self._memory, offset)[0]
+                if version & 1:
+                    continue
+                # compares in place, the payload of another request is never copied
+                if self._view[offset + 8:offset + 24] != key:
+                    break
+                length = struct.unpack_from("I", self._memory, offset + 24)[0]
+                if length > self.slot_size - _SLOT_HEADER_SIZE:
+                    continue
+                payload = self._memory[offset + _SLOT_HEADER_SIZE:offset + _SLOT_HEADER_SIZE + length]
+                if struct.unpack_from("Q", self._memory, offset)[0] != version:
+                    continue
+                self._memory[offset + 28] = 1
+                self.hits += 1
+                return payload.decode()
+            offset += self.slot_size
+
+        self.misses += 1
+        return None
+
+    def put(self, completionRequest: OpenAICompletionRequest, payload: str):
+        data = payload.encode()
+        if len(data) > self.slot_size - _SLOT_HEADER_SIZE:
+            return
+
+        key, bucket = self._get_key(completionRequest)
+        offset = self._get_bucket_offset(bucket)
+        with self._locks[bucket % _LOCK_STRIPES]:
+            # threads of other processes, the byte range of the bucket index in the file is its lock
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, bucket)
+            try:
+                slot_offset = self._find_slot(offset, key)
+                version = struct.unpack_from("Q", self._memory, slot_offset)[0]
+                # an odd version was left by a process that died while writing
+                version |= 1
+                struct.pack_into("Q", self._memory, slot_offset, version)
+                struct.pack_into("16sIB", self._memory, slot_offset + 8, key, len(data), 0)
+                self._memory[slot_offset + _SLOT_HEADER_SIZE:slot_offset + _SLOT_HEADER_SIZE + len(data)] = data
+                struct.pack_into("Q", self._memory, slot_offset, version + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, bucket)
+
+    def _find_slot(self, offset: int, key: bytes) -> int:
+        # the slot holding the key, else an empty slot, else the slot the clock hand stops at
+        empty = None
+        for way in range(SHARED_CACHE_WAYS):
+            slot_key = self._view[offset + way * self.slot_size + 8:offset + way * self.slot_size + 24]
+            if slot_key == key:
+                return offset + way * self.slot_size
+            if empty is None and not any(slot_key):
+                empty = offset + way * self.slot_size
+        if empty is not None:
+            return empty
+
+        # the hand of the bucket is kept in its first slot
+        hand = self._memory[offset + 29]
+        while True:
+            slot_offset = offset + hand * self.slot_size
+            hand = (hand + 1) % SHARED_CACHE_WAYS
+            if not self._memory[slot_offset + 28]:
+                self._memory[offset + 29] = hand
+                return slot_offset
+            self._memory[slot_offset + 28] = 0
+
+
+def get_shared_cache_path() -> str:
+    """Default file of the shared memory cache, in memory backed /dev/shm where available."""
+
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "llm-converter-response-cache")
+
+
+response_cache: ResponseCache | None = None
+
+
+def init_response_cache(cache_type: str | None, max_bytes: int, similarity: float, models: list[str],
+                        api_keys: list[str], path: str | None = None, slot_size: int = 16384):
+    """
+    Configure the response cache.
+
+    :param cache_type: "similarity" to also answer near-duplicate requests from the cache, "shared" to share the
+        cache of exact matches between the worker processes, None to disable caching.
+    :param path: File of the shared cache, a file in /dev/shm if None.
+    :param slot_size: Maximum size of a response in the shared cache.
+    """
+    global response_cache
+    if not cache_type:
+        response_cache = None
+    elif cache_type == "similarity":
+        response_cache = SimilarityCache(similarity, max_bytes, models, api_keys)
+    elif cache_type == "shared":
+        response_cache = SharedMemoryCache(path or get_shared_cache_path(), max_bytes, slot_size, models, api_keys)
+    else:
+        raise ValueError("Unknown response cache: " + cache_type)
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Get the response cache, None if caching is disabled."""
+
+    return response_cache
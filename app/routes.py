@@ -1,11 +1,59 @@
-from flask import request, jsonify, Blueprint, current_app
+import hashlib
+import hmac
+import json
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterator, Callable
+
+from flask import request, jsonify, Blueprint, current_app, Response
 
 from app.config import AuthMode
-from app.models import OpenAICompletionRequest
+from app import fanout, tracing
+from app.circuit_breaker import CircuitBreaker, CircuitOpenError, get_circuit_breaker, get_circuit_breakers, \
+    is_backend_failure
+from app.deadline import Deadline, is_timeout_error
+from app.rate_limits import ClientLimits, get_client_keys
+from app.embeddings import get_embedding_batcher, encode_base64
+from app.idempotency import IdempotentEntry, get_idempotency_store
+from app.profiling import SORT_KEYS, ProfileSession, start_profiling, stop_profiling, get_profile_session, \
+    profile_frames, profile_response
+from app.models import OpenAICompletionRequest, OpenAICompletionResponse, TargetApiBackend, OpenAIEmbeddingRequest
 from app.services.service_manager import get_current_target_api_backend
+from app.response_cache import get_response_cache
+from app.sessions import get_session_store, collect_reply
+from app.streaming import event_stream_response
+from app.tokens import token_estimator, PromptEstimate, ESTIMATE_TOLERANCE
+from app.workers import get_worker_stats
+from app.usage import UsageRecord, get_usage_ledger, track_stream, GROUP_BY_COLUMNS
 
 routes_blueprint = Blueprint('routes', __name__)
 
+# (model list, body, ETag, last modified) of the serialized /v1/models payload, rebuilt only when the model list of
+# the backend is replaced
+_models_response: tuple | None = None
+
+
+def _get_models_response() -> tuple:
+    """Get the serialized model list with its ETag and last modification time."""
+
+    global _models_response
+
+    models = get_current_target_api_backend().models
+
+    # the tuple is replaced at once, concurrent readers see either the old or the new payload
+    cached = _models_response
+    if cached is None or cached[0] is not models:
+        body = json.dumps({
+            "object": "list",
+            "data": [x.to_dict() for x in models]
+        }).encode()
+        cached = (models, body, hashlib.sha1(body).hexdigest(), datetime.now(timezone.utc).replace(microsecond=0))
+        _models_response = cached
+
+    return cached
+
 
 @routes_blueprint.route("/v1/models", methods=["GET"])
 def models():
@@ -13,27 +61,78 @@ def models():
 
     current_app.logger.info("Received model list request")
 
-    # return the list of models
-    return jsonify({
-        "object": "list",
-        "data": [x.to_dict() for x in get_current_target_api_backend().models]
-    })
+    # return the cached list of models, or 304 if the client's copy is still current
+    _, body, etag, last_modified = _get_models_response()
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(request)
 
 
 @routes_blueprint.route("/v1/chat/completions", methods=["POST"])
 def completions():
+    return _trace_completion("POST /v1/chat/completions", _handle_completions)
+
+
+def _trace_completion(name: str, handle: Callable[[tracing.Span], Response | tuple]) -> Response | tuple:
+    # trace the request, continuing the trace of the client if it sent a traceparent header
+    span = tracing.start_trace(name, request.headers.get("traceparent"))
+    with tracing.use_span(span):
+        try:
+            response = handle(span)
+        except Exception as e:
+            span.set_error(repr(e))
+            span.end()
+            raise
+
+    if isinstance(response, Response):
+        span.set_attribute("http.status_code", response.status_code)
+        # the span of a stream ends once the stream has been sent
+        if not response.is_streamed:
+            span.end()
+    else:
+        span.set_attribute("http.status_code", response[1])
+        span.end()
+    return response
+
+
+def _handle_completions(span: tracing.Span):
     current_app.logger.info("Received completion request")
 
     # make sure the request has the correct API key
-    header_api_key = request.headers.get("Authorization")
-    if current_app.config.get("AUTH_MODE") == AuthMode.PASS_API_KEY and header_api_key is None:
-        return jsonify({"error": "No API key provided"}), 401
-    if current_app.config.get("AUTH_MODE") == AuthMode.CUSTOM_KEY and header_api_key.split("Bearer ")[1] != current_app.config.get("AUTH_KEY"):
-        return jsonify({"error": "Invalid API key provided"}), 401
+    client, error = _authenticate()
+    if error is not None:
+        return error
 
     # parse the request
     completionRequest = OpenAICompletionRequest.from_request(request, current_app.config)
 
+    return _handle_completion_request(span, client, completionRequest, request.json)
+
+
+def _handle_completion_request(span: tracing.Span, client: ClientLimits | None,
+                               completionRequest: OpenAICompletionRequest, request_json: dict):
+    """
+    Answer a parsed completion request.
+
+    :param request_json: The body identifying the request, retries with an Idempotency-Key have to send the same one.
+    """
+    n = completionRequest.n
+    if n is not None and (not isinstance(n, int) or not 1 <= n <= fanout.MAX_CHOICES):
+        return jsonify({"error": f"n must be an integer between 1 and {fanout.MAX_CHOICES}"}), 400
+
+    # limit the time spent on the upstream calls, the X-Request-Timeout header can shorten the configured limits
+    try:
+        completionRequest.deadline = Deadline.from_header(
+            request.headers.get("X-Request-Timeout"),
+            total=current_app.config.get("UPSTREAM_TIMEOUT"),
+            connect=current_app.config.get("UPSTREAM_CONNECT_TIMEOUT"),
+            first_byte=current_app.config.get("UPSTREAM_FIRST_BYTE_TIMEOUT"))
+    except ValueError as e:
+        return jsonify({"error": "Invalid X-Request-Timeout header: " + str(e)}), 400
+
+    span.set_attributes({"model": completionRequest.model, "streamed": completionRequest.streamed, "n": n})
+
     current_app.logger.debug("Address: " + request.remote_addr)
     current_app.logger.debug("Model: " + completionRequest.model)
     current_app.logger.debug("Max tokens: " + str(completionRequest.max_tokens))
@@ -50,18 +149,720 @@ def completions():
 
     current_app.logger.debug("Received request with body: " + str(request.json))
 
+    # retries sent with the same Idempotency-Key attach to the running request or get its stored response
+    idempotency_key = request.headers.get("Idempotency-Key")
+    idempotency_store = get_idempotency_store()
+    if not idempotency_key or idempotency_store is None:
+        return _complete(span, client, completionRequest, None)
+
+    while True:
+        entry, created = idempotency_store.begin(completionRequest.api_key, idempotency_key, request_json,
+                                                 bool(completionRequest.streamed))
+        if entry is None:
+            return jsonify({"error": "Idempotency-Key was already used with a different request"}), 422
+        if created:
+            break
+        span.set_attribute("idempotency.replayed", True)
+        if entry.streamed:
+            # only follow a stream that started, an original rejected before streaming (e.g. rate limited) is retried
+            if not entry.wait_started(completionRequest.deadline.remaining()):
+                return jsonify({"error": "Upstream request timed out"}), 504
+            if not (entry.failed and not entry.frames):
+                return _replay_stream(entry.follow())
+        else:
+            if not entry.wait(completionRequest.deadline.remaining()):
+                return jsonify({"error": "Upstream request timed out"}), 504
+            if not entry.failed:
+                return Response(entry.get_body(), mimetype="application/json",
+                                headers={"Idempotent-Replayed": "true"})
+        # the original request failed, the retry is sent upstream itself
+
+    try:
+        response = _complete(span, client, completionRequest, entry)
+    except BaseException:
+        idempotency_store.release(entry)
+        raise
+    if entry.streamed:
+        # a successful stream is recorded into the entry
+        if not (isinstance(response, Response) and response.is_streamed):
+            idempotency_store.release(entry)
+    elif isinstance(response, Response) and response.status_code == 200:
+        idempotency_store.complete(entry, response.get_data())
+    else:
+        idempotency_store.release(entry)
+    return response
+
+
+def _replay_stream(frames: Iterator[bytes]) -> Response:
+    response = event_stream_response(
+        frames,
+        flush_window_ms=current_app.config.get("SSE_FLUSH_WINDOW_MS"),
+        heartbeat_interval=current_app.config.get("SSE_HEARTBEAT_INTERVAL"))
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _complete(span: tracing.Span, client: ClientLimits | None, completionRequest: OpenAICompletionRequest,
+              entry: IdempotentEntry | None):
     # handle the request
     target_api_backend = get_current_target_api_backend()
     current_app.logger.info("Handling completion request with backend: " + target_api_backend.__class__.__name__)
 
+    # reject (or trim) requests that cannot fit the model's context window before anything is sent upstream
+    prompt_estimate, error = _fit_context_window(completionRequest, target_api_backend)
+    if error is not None:
+        return error
+
+    # backends without native support for n get one upstream call per choice
+    choices = fanout.get_fanout(completionRequest, target_api_backend)
+    span.set_attributes({"backend": target_api_backend.name, "fanout.calls": choices if choices > 1 else None})
+
+    # count the request against the client's limits up front, settled with the actual usage once it is known
+    estimated_tokens = (prompt_estimate.tokens if prompt_estimate is not None else 0) * choices + \
+        (completionRequest.max_tokens or 0) * (completionRequest.n or 1)
+    error = _acquire_rate_limit(client, estimated_tokens)
+    if error is not None:
+        return error
+
+    pass_api_key = current_app.config.get("AUTH_MODE") == AuthMode.PASS_API_KEY
+    started_at = time.perf_counter()
+    usage_ledger = get_usage_ledger()
+    breaker = _get_circuit_breaker(target_api_backend, completionRequest.model)
+
     if completionRequest.streamed:
-        return target_api_backend.handle_streamed_completion_request(
-            completionRequest, current_app.config.get("AUTH_MODE") == AuthMode.PASS_API_KEY)
+        # fail fast while the backend is down
+        try:
+            probe = breaker.before_call() if breaker is not None else False
+        except CircuitOpenError as e:
+            _settle_rate_limit(client, estimated_tokens, 0)
+            return _circuit_open_response(e)
+
+        try:
+            if choices > 1:
+                frames = fanout.handle_streamed_completion_request(target_api_backend, completionRequest,
+                                                                   pass_api_key, choices)
+            else:
+                frames = target_api_backend.handle_streamed_completion_request(completionRequest, pass_api_key)
+        except CircuitOpenError as e:
+            # the circuits of all the models a virtual model chooses from are open
+            if breaker is not None:
+                breaker.after_call(probe, None)
+            _settle_rate_limit(client, estimated_tokens, 0)
+            return _circuit_open_response(e)
+        frames = completionRequest.deadline.guard(frames)
+
+        # account for the stream once it has been fully sent (or abandoned by the client)
+        def on_finish(status: str, first_frame_at: float | None):
+            if first_frame_at is not None:
+                span.add_event("first_chunk", timestamp_ns=time.time_ns() -
+                               int((time.perf_counter() - first_frame_at) * 1e9))
+                span.add_event("last_chunk")
+            span.set_attributes({"status": status, **(completionRequest.usage or {})})
+            if status == "error":
+                span.set_error("The stream failed")
+            span.end()
+            if breaker is not None:
+                breaker.after_call(probe, {"ok": False, "error": True}.get(status),
+                                   first_frame_at - started_at if first_frame_at is not None else None)
+            if completionRequest.usage is not None:
+                _calibrate(completionRequest, target_api_backend, prompt_estimate,
+                           (completionRequest.usage.get("prompt_tokens") or 0) // choices)
+                _settle_rate_limit(client, estimated_tokens, sum(completionRequest.usage.values()))
+            elif first_frame_at is None:
+                # nothing was generated
+                _settle_rate_limit(client, estimated_tokens, 0)
+            if usage_ledger is not None:
+                usage_ledger.record(_usage_record(
+                    completionRequest, target_api_backend, status, started_at, first_frame_at))
+
+        frames = track_stream(frames, on_finish)
+        # the frames may be read on a background thread, which a profiled request has to cover as well
+        frames = profile_frames(frames)
+        frames = tracing.bind(frames)
+
+        if entry is not None:
+            # the stream runs to completion for the retries, even if this client goes away
+            return event_stream_response(
+                get_idempotency_store().record(entry, frames),
+                flush_window_ms=current_app.config.get("SSE_FLUSH_WINDOW_MS"),
+                heartbeat_interval=current_app.config.get("SSE_HEARTBEAT_INTERVAL"))
+
+        response = event_stream_response(
+            frames,
+            flush_window_ms=current_app.config.get("SSE_FLUSH_WINDOW_MS"),
+            heartbeat_interval=current_app.config.get("SSE_HEARTBEAT_INTERVAL"))
+        # abort the upstream stream right away if the client goes away before it ends
+        response.call_on_close(completionRequest.deadline.cancel)
+        return response
     else:
-        response = target_api_backend.handle_completion_request(
-            completionRequest, current_app.config.get("AUTH_MODE") == AuthMode.PASS_API_KEY).to_json()
+        response_cache = get_response_cache()
+        if response_cache is not None and response_cache.allows(completionRequest):
+            cached_response = response_cache.get(completionRequest)
+            if cached_response is not None:
+                current_app.logger.debug("Returning cached response")
+                span.set_attribute("cache.hit", True)
+                _settle_rate_limit(client, estimated_tokens, 0)
+                return Response(cached_response, mimetype="application/json", headers={"X-Cache": "HIT"})
+        else:
+            response_cache = None
+
+        # fail fast while the backend is down, cached responses are still served
+        try:
+            probe = breaker.before_call() if breaker is not None else False
+        except CircuitOpenError as e:
+            _settle_rate_limit(client, estimated_tokens, 0)
+            return _circuit_open_response(e)
+
+        try:
+            if choices > 1:
+                completionResponse = fanout.handle_completion_request(target_api_backend, completionRequest,
+                                                                      pass_api_key, choices)
+            else:
+                completionResponse = target_api_backend.handle_completion_request(completionRequest, pass_api_key)
+        except Exception as e:
+            if breaker is not None:
+                breaker.after_call(probe, is_backend_failure(e))
+            _settle_rate_limit(client, estimated_tokens, 0)
+            if usage_ledger is not None:
+                usage_ledger.record(_usage_record(completionRequest, target_api_backend, "error", started_at))
+            if isinstance(e, CircuitOpenError):
+                # the circuits of all the models a virtual model chooses from are open
+                return _circuit_open_response(e)
+            if is_timeout_error(e):
+                current_app.logger.warning("Upstream request timed out: " + str(e))
+                return jsonify({"error": "Upstream request timed out"}), 504
+            raise
+
+        if breaker is not None:
+            breaker.after_call(probe, False, time.perf_counter() - started_at)
+        _settle_rate_limit(client, estimated_tokens,
+                           (completionResponse.promptTokens or 0) + (completionResponse.completionTokens or 0))
+
+        span.set_attributes({"prompt_tokens": completionResponse.promptTokens,
+                             "completion_tokens": completionResponse.completionTokens})
+        with tracing.start_span("format_response"):
+            response = completionResponse.to_json()
+        # the prompt of a fanned out request is counted once per upstream call
+        _calibrate(completionRequest, target_api_backend, prompt_estimate,
+                   (completionResponse.promptTokens or 0) // choices)
+        if response_cache is not None:
+            response_cache.put(completionRequest, response)
+        if usage_ledger is not None:
+            usage_ledger.record(_usage_record(completionRequest, target_api_backend, "ok", started_at,
+                                              response=completionResponse))
+
         current_app.logger.debug("Returning response: " + str(response))
-        return response
+        return Response(response, mimetype="application/json")
+
+
+def _authenticate() -> tuple[ClientLimits | None, tuple | None]:
+    """
+    Check the API key of a request against the auth mode.
+
+    :return: The client of the key in CUSTOM_KEY mode with client keys (None otherwise) and an error response if the
+        key is rejected.
+    """
+    header_api_key = request.headers.get("Authorization")
+    if current_app.config.get("AUTH_MODE") == AuthMode.PASS_API_KEY and header_api_key is None:
+        return None, (jsonify({"error": "No API key provided"}), 401)
+    if current_app.config.get("AUTH_MODE") == AuthMode.CUSTOM_KEY:
+        api_key = (header_api_key or "").removeprefix("Bearer ")
+        client_keys = get_client_keys()
+        client = client_keys.lookup(api_key) if client_keys is not None else None
+        if client is not None:
+            return client, None
+        # the AUTH_KEY is accepted besides the client keys, without limits
+        auth_key = current_app.config.get("AUTH_KEY")
+        # compared as bytes, compare_digest rejects strings with non-ASCII characters
+        if not auth_key or not hmac.compare_digest(api_key.encode(), auth_key.encode()):
+            return None, (jsonify({"error": "Invalid API key provided"}), 401)
+    return None, None
+
+
+def _acquire_rate_limit(client: ClientLimits | None, estimated_tokens: int) -> tuple | None:
+    """Count a request against the limits of its client, returns a 429 error response if they are exceeded."""
+
+    if client is None:
+        return None
+    wait = client.acquire(estimated_tokens)
+    if wait <= 0:
+        return None
+    current_app.logger.info("Rate limited client %s for %.1f seconds", client.name, wait)
+    return jsonify({"error": "Rate limit exceeded, retry later"}), 429, {"Retry-After": str(max(math.ceil(wait), 1))}
+
+
+def _settle_rate_limit(client: ClientLimits | None, estimated_tokens: int, actual_tokens: int):
+    if client is not None:
+        client.settle(estimated_tokens, actual_tokens)
+
+
+def _get_request_api_key() -> str:
+    return (request.headers.get("Authorization") or "").removeprefix("Bearer ")
+
+
+@routes_blueprint.route("/v1/sessions", methods=["POST"])
+def create_session():
+    """Starts a chat session whose history is kept by the server. The body holds the fields of the completion requests
+    of the session (model, max_tokens, tools, ...) and optionally the first messages."""
+
+    client, error = _authenticate()
+    if error is not None:
+        return error
+
+    session_store = get_session_store()
+    if session_store is None:
+        return jsonify({"error": "Chat sessions are disabled"}), 404
+
+    params = dict(request.json or {})
+    messages = params.pop("messages", None) or []
+    if not isinstance(messages, list):
+        return jsonify({"error": "messages must be a list"}), 400
+    params.pop("stream", None)
+
+    session = session_store.create(_get_request_api_key(), params, messages)
+    current_app.logger.info("Created chat session " + session.id)
+    return jsonify(session.to_dict())
+
+
+@routes_blueprint.route("/v1/sessions/<session_id>", methods=["GET"])
+def get_session(session_id: str):
+    """Returns a chat session with its history."""
+
+    client, error = _authenticate()
+    if error is not None:
+        return error
+
+    session_store = get_session_store()
+    session = session_store.get(_get_request_api_key(), session_id) if session_store is not None else None
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify(session.to_dict(include_messages=True))
+
+
+@routes_blueprint.route("/v1/sessions/<session_id>", methods=["DELETE"])
+def delete_session(session_id: str):
+    """Ends a chat session."""
+
+    client, error = _authenticate()
+    if error is not None:
+        return error
+
+    session_store = get_session_store()
+    if session_store is None or not session_store.delete(_get_request_api_key(), session_id):
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"id": session_id, "object": "chat.session.deleted", "deleted": True})
+
+
+@routes_blueprint.route("/v1/sessions/<session_id>/completions", methods=["POST"])
+def session_completions(session_id: str):
+    """Continues a chat session with the new messages of a turn, answered like /v1/chat/completions."""
+
+    return _trace_completion("POST /v1/sessions/{id}/completions",
+                             lambda span: _handle_session_completions(span, session_id))
+
+
+def _handle_session_completions(span: tracing.Span, session_id: str):
+    current_app.logger.info("Received session completion request")
+
+    client, error = _authenticate()
+    if error is not None:
+        return error
+
+    session_store = get_session_store()
+    session = session_store.get(_get_request_api_key(), session_id) if session_store is not None else None
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+
+    body = request.json
+    new_messages = body.get("messages")
+    if not isinstance(new_messages, list) or not new_messages:
+        return jsonify({"error": "messages must be a non-empty list of the new messages"}), 400
+
+    # turns are answered in order, each continues the history of the previous one
+    if not session.turn_lock.acquire(blocking=False):
+        return jsonify({"error": "The previous turn of the session is still running"}), 409
+
+    finished = threading.Event()
+
+    def on_done(message: dict | None):
+        # called once with the reply, and again when the response is closed in case the stream never started
+        if finished.is_set():
+            return
+        finished.set()
+        if message is not None:
+            session_store.append(session, new_messages + [message])
+        session.turn_lock.release()
+
+    try:
+        # the fields of the turn override the ones of the session
+        args = {**session.params, **body, "messages": session.messages + new_messages}
+        completionRequest = OpenAICompletionRequest.from_args(_get_request_api_key(), args, current_app.config)
+        # only the new messages are converted to the format of the backend
+        completionRequest.conversions = session.conversions
+        span.set_attribute("session.messages", len(completionRequest.messages))
+
+        response = _handle_completion_request(span, client, completionRequest, dict(body, session=session_id))
+    except BaseException:
+        session.turn_lock.release()
+        raise
+
+    # add the turn to the history once it succeeded, replayed responses were added by the original request
+    if not isinstance(response, Response) or response.status_code != 200 or \
+            response.headers.get("Idempotent-Replayed"):
+        session.turn_lock.release()
+    elif response.is_streamed:
+        response.response = collect_reply(response.response, on_done)
+        response.call_on_close(lambda: on_done(None))
+    else:
+        on_done(json.loads(response.get_data())["choices"][0]["message"])
+    return response
+
+
+@routes_blueprint.route("/v1/embeddings", methods=["POST"])
+def embeddings():
+    current_app.logger.info("Received embedding request")
+
+    client, error = _authenticate()
+    if error is not None:
+        return error
+
+    embeddingRequest = OpenAIEmbeddingRequest.from_request(request)
+    if not embeddingRequest.inputs or not all(isinstance(text, str) for text in embeddingRequest.inputs):
+        return jsonify({"error": "input must be a non-empty string or list of strings"}), 400
+    if embeddingRequest.encoding_format not in ("float", "base64"):
+        return jsonify({"error": "encoding_format must be float or base64"}), 400
+
+    # the same time limits as completions, the X-Request-Timeout header can shorten the configured limits
+    try:
+        deadline = Deadline.from_header(
+            request.headers.get("X-Request-Timeout"),
+            total=current_app.config.get("UPSTREAM_TIMEOUT"),
+            connect=current_app.config.get("UPSTREAM_CONNECT_TIMEOUT"),
+            first_byte=current_app.config.get("UPSTREAM_FIRST_BYTE_TIMEOUT"))
+    except ValueError as e:
+        return jsonify({"error": "Invalid X-Request-Timeout header: " + str(e)}), 400
+
+    try:
+        backend = get_current_target_api_backend().get_embedding_backend(embeddingRequest.model)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if backend.max_embedding_batch_size is None:
+        return jsonify({"error": f"The {backend.name} backend does not support embeddings"}), 400
+
+    # count the request against the client's limits, about four characters per token
+    estimated_tokens = sum(len(text) for text in embeddingRequest.inputs) // 4
+    error = _acquire_rate_limit(client, estimated_tokens)
+    if error is not None:
+        return error
+
+    # fail fast while the backend is down
+    breaker = get_circuit_breaker(backend.name, "embeddings")
+    try:
+        probe = breaker.before_call() if breaker is not None else False
+    except CircuitOpenError as e:
+        _settle_rate_limit(client, estimated_tokens, 0)
+        return _circuit_open_response(e)
+
+    pass_api_key = current_app.config.get("AUTH_MODE") == AuthMode.PASS_API_KEY
+    started_at = time.perf_counter()
+    usage_ledger = get_usage_ledger()
+    status = "error"
+    try:
+        # concurrent requests for the same model are sent upstream together
+        result = get_embedding_batcher().embed(backend, embeddingRequest.model, embeddingRequest.inputs,
+                                               backend.get_api_key(embeddingRequest, pass_api_key), deadline)
+        status = "ok"
+        if breaker is not None:
+            breaker.after_call(probe, False, time.perf_counter() - started_at)
+        _settle_rate_limit(client, estimated_tokens, result.prompt_tokens)
+    except Exception as e:
+        if breaker is not None:
+            breaker.after_call(probe, is_backend_failure(e))
+        _settle_rate_limit(client, estimated_tokens, 0)
+        if is_timeout_error(e):
+            current_app.logger.warning("Upstream request timed out: " + str(e))
+            return jsonify({"error": "Upstream request timed out"}), 504
+        raise
+    finally:
+        if usage_ledger is not None:
+            usage_ledger.record(UsageRecord(
+                api_key=embeddingRequest.api_key, model=embeddingRequest.model, backend=backend.name,
+                prompt_tokens=result.prompt_tokens if status == "ok" else 0, completion_tokens=0,
+                latency_ms=(time.perf_counter() - started_at) * 1000, streamed=False, status=status))
+
+    encode = encode_base64 if embeddingRequest.encoding_format == "base64" else None
+    return Response(json.dumps({
+        "object": "list",
+        "data": [{"object": "embedding", "index": index, "embedding": encode(vector) if encode else vector}
+                 for index, vector in enumerate(result.vectors)],
+        "model": embeddingRequest.model,
+        "usage": {"prompt_tokens": result.prompt_tokens, "total_tokens": result.prompt_tokens}
+    }), mimetype="application/json")
+
+
+def _get_circuit_breaker(target_api_backend: TargetApiBackend, model: str) -> CircuitBreaker | None:
+    """
+    Get the circuit breaker of the completions endpoint of the backend serving a model, None for virtual models whose
+    backends use the breakers of the models they choose.
+    """
+    try:
+        backend = target_api_backend.get_backend(model)
+    except ValueError:
+        # unknown models are reported by the backend
+        return None
+    if backend.virtual:
+        return None
+    return get_circuit_breaker(backend.name, "completions")
+
+
+def _circuit_open_response(error: CircuitOpenError) -> tuple:
+    current_app.logger.warning(str(error))
+    return jsonify({"error": "The upstream provider is unavailable, retry later"}), 503, \
+        {"Retry-After": str(max(math.ceil(error.retry_after), 1))}
+
+
+def _fit_context_window(completionRequest: OpenAICompletionRequest, target_api_backend: TargetApiBackend) \
+        -> tuple[PromptEstimate | None, tuple | None]:
+    """
+    Check the estimated prompt and max_tokens fit the context window of the requested model, dropping the oldest
+    messages of the request if truncation is enabled.
+
+    :return: The prompt estimate (None if the model is unknown) and an error response if the request does not fit.
+    """
+    try:
+        backend = target_api_backend.get_backend(completionRequest.model)
+    except ValueError:
+        # unknown models are reported by the backend
+        return None, None
+
+    estimate = token_estimator.estimate(backend.name, completionRequest.messages, completionRequest.tools)
+    model = backend.get_model(completionRequest.model)
+    if model is None or model.context_window is None:
+        return estimate, None
+
+    max_tokens = completionRequest.max_tokens or 0
+    if backend.max_output_tokens is not None:
+        max_tokens = min(max_tokens, backend.max_output_tokens)
+    max_prompt_tokens = model.context_window - max_tokens
+    if estimate.tokens <= max_prompt_tokens:
+        return estimate, None
+
+    truncation = completionRequest.truncation or current_app.config.get("CONTEXT_TRUNCATION")
+    if truncation == "auto":
+        # shorten the completion to the room the messages leave before dropping messages, messages are only dropped to
+        # make room for up to half the context window, a large max_tokens would otherwise leave hardly any prompt
+        max_prompt_tokens = model.context_window - min(max_tokens, model.context_window // 2)
+        messages = completionRequest.messages
+        if estimate.tokens > max_prompt_tokens:
+            messages = token_estimator.trim(backend.name, messages, completionRequest.tools, max_prompt_tokens)
+        if messages is not None:
+            if messages is not completionRequest.messages:
+                current_app.logger.info("Dropped %d messages to fit the context window of %s",
+                                        len(completionRequest.messages) - len(messages), model.id)
+                completionRequest.messages = messages
+                estimate = token_estimator.estimate(backend.name, messages, completionRequest.tools)
+            if completionRequest.max_tokens is not None:
+                completionRequest.max_tokens = min(max_tokens, model.context_window - estimate.tokens)
+            return estimate, None
+    elif estimate.tokens * (1 - ESTIMATE_TOLERANCE) <= max_prompt_tokens:
+        # too close to call for an estimate, leave the decision to the provider
+        return estimate, None
+
+    return estimate, (jsonify({
+        "error": f"This model's maximum context length is {model.context_window} tokens, the request needs about "
+                 f"{estimate.tokens + max_tokens} tokens ({estimate.tokens} in the messages, {max_tokens} for the "
+                 f"completion). Reduce the length of the messages or max_tokens."
+    }), 400)
+
+
+def _calibrate(completionRequest: OpenAICompletionRequest, target_api_backend: TargetApiBackend,
+               prompt_estimate: PromptEstimate | None, prompt_tokens: int | None):
+    # refine the token estimator with the prompt tokens counted by the provider
+    if prompt_estimate is None or not prompt_tokens:
+        return
+    try:
+        backend_name = target_api_backend.get_backend(completionRequest.model).name
+    except ValueError:
+        return
+    token_estimator.calibrate(backend_name, prompt_estimate, prompt_tokens)
+
+
+def _usage_record(completionRequest: OpenAICompletionRequest, target_api_backend: TargetApiBackend, status: str,
+                  started_at: float, first_frame_at: float | None = None,
+                  response: OpenAICompletionResponse | None = None) -> UsageRecord:
+    if response is not None:
+        prompt_tokens, completion_tokens = response.promptTokens, response.completionTokens
+    else:
+        usage = completionRequest.usage or {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+    try:
+        backend_name = target_api_backend.get_backend(completionRequest.model).name
+    except ValueError:
+        backend_name = target_api_backend.name
+
+    return UsageRecord(
+        api_key=completionRequest.api_key,
+        model=completionRequest.model,
+        backend=backend_name,
+        prompt_tokens=prompt_tokens or 0,
+        completion_tokens=completion_tokens or 0,
+        latency_ms=(time.perf_counter() - started_at) * 1000,
+        ttft_ms=(first_frame_at - started_at) * 1000 if first_frame_at is not None else None,
+        streamed=completionRequest.streamed,
+        status=status
+    )
+
+
+def _is_admin_request() -> bool:
+    """Check the request is authorized with the admin key, admin endpoints are disabled if no key is configured."""
+
+    admin_key = current_app.config.get("ADMIN_KEY")
+    header_api_key = request.headers.get("Authorization") or ""
+    return bool(admin_key) and hmac.compare_digest(header_api_key.removeprefix("Bearer ").encode(), admin_key.encode())
+
+
+@routes_blueprint.route("/admin/usage", methods=["GET"])
+def usage():
+    """Returns usage aggregates from the usage ledger."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    usage_ledger = get_usage_ledger()
+    if usage_ledger is None:
+        return jsonify({"error": "Usage accounting is disabled"}), 404
+
+    group_by = [x for x in request.args.get("group_by", "").split(",") if x]
+    if any(column not in GROUP_BY_COLUMNS for column in group_by):
+        return jsonify({"error": "group_by must be a comma separated list of: " + ", ".join(GROUP_BY_COLUMNS)}), 400
+
+    return jsonify({
+        "object": "list",
+        "data": usage_ledger.summarize(since=request.args.get("since", type=float),
+                                       until=request.args.get("until", type=float),
+                                       group_by=group_by)
+    })
+
+
+@routes_blueprint.route("/admin/workers", methods=["GET"])
+def workers():
+    """Returns the request counters of every worker process."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    worker_stats = get_worker_stats()
+    if worker_stats is None:
+        return jsonify({"error": "The server is not running with multiple workers"}), 404
+
+    return jsonify(worker_stats.summarize())
+
+
+@routes_blueprint.route("/admin/races", methods=["GET"])
+def races():
+    """Returns how often each member of the race groups won."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    race_backends = getattr(get_current_target_api_backend(), "race_backends", None)
+    if not race_backends:
+        return jsonify({"error": "No race groups are configured"}), 404
+
+    return jsonify({
+        "object": "list",
+        "data": [dict(race_backend.stats.to_dict(), model=model_id) for model_id, race_backend in race_backends.items()]
+    })
+
+
+@routes_blueprint.route("/admin/model-selection", methods=["GET"])
+def model_selection():
+    """Returns the recent latency, error rate and price of the models auto-fast and auto-cheap choose from."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    selector_backend = getattr(get_current_target_api_backend(), "selector_backend", None)
+    if selector_backend is None:
+        return jsonify({"error": "Automatic model selection is disabled"}), 404
+
+    return jsonify(selector_backend.to_dict())
+
+
+@routes_blueprint.route("/admin/circuit-breakers", methods=["GET"])
+def circuit_breakers():
+    """Returns the state of the circuit breaker of every backend endpoint."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    return jsonify({
+        "object": "list",
+        "data": [dict(breaker.to_dict(), endpoint=key) for key, breaker in sorted(get_circuit_breakers().items())]
+    })
+
+
+@routes_blueprint.route("/debug/profile", methods=["POST"])
+def start_profile():
+    """Starts profiling the next `requests` completion requests or the ones within `seconds`, replacing the last
+    profile."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    body = request.get_json(silent=True) or {}
+    requests_limit = body.get("requests")
+    seconds = body.get("seconds")
+    if requests_limit is None and seconds is None:
+        return jsonify({"error": "requests or seconds must be provided"}), 400
+    if requests_limit is not None and (not isinstance(requests_limit, int) or requests_limit < 1) or \
+            seconds is not None and (not isinstance(seconds, (int, float)) or seconds <= 0):
+        return jsonify({"error": "requests must be a positive integer and seconds a positive number"}), 400
+
+    profile_session = ProfileSession(requests_limit, seconds)
+    start_profiling(current_app._get_current_object(), profile_session)
+    current_app.logger.info("Started profiling: " + str(profile_session.to_dict()))
+    return jsonify(profile_session.to_dict())
+
+
+@routes_blueprint.route("/debug/profile", methods=["GET"])
+def get_profile():
+    """Returns the merged profile of the profiled requests, as a pstats file (format=pstats) or a text report."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    profile_session = get_profile_session()
+    if profile_session is None:
+        return jsonify({"error": "Nothing has been profiled"}), 404
+
+    output_format = request.args.get("format", "text")
+    if output_format == "json":
+        return jsonify(profile_session.to_dict())
+    if output_format not in ("text", "pstats"):
+        return jsonify({"error": "format must be one of: text, pstats, json"}), 400
+
+    sort = request.args.get("sort", "cumulative")
+    if sort not in SORT_KEYS:
+        return jsonify({"error": "sort must be one of: " + ", ".join(SORT_KEYS)}), 400
+
+    return profile_response(profile_session, output_format, sort, request.args.get("limit", 50, type=int))
+
+
+@routes_blueprint.route("/debug/profile", methods=["DELETE"])
+def stop_profile():
+    """Stops profiling, the profile of the requests so far stays available."""
+
+    if not _is_admin_request():
+        return jsonify({"error": "Invalid admin key provided"}), 401
+
+    profile_session = get_profile_session()
+    if profile_session is None:
+        return jsonify({"error": "Nothing has been profiled"}), 404
+
+    stop_profiling(current_app._get_current_object(), profile_session)
+    return jsonify(profile_session.to_dict())
 
 
 def init_app(app):
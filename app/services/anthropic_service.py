@@ -1,15 +1,25 @@
 import json
 import os
+from datetime import datetime
 from typing import Iterator, AnyStr
 
 import anthropic
-import requests
-from dotenv import load_dotenv
 
 from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse, \
-    OpenAICompletionChunkResponse
+    ChunkEncoder, MessageConverter, convert_messages
+from app import transport, tracing
+from app.deadline import Deadline, abort_on_cancel
+from app.services.registry import load_models
+
+
+class AnthropicApiError(Exception):
+    """An error response of the Anthropic API."""
+
+    def __init__(self, message: str, status_code: int | None = None):
+        """:param status_code: HTTP status code of the response."""
+        super().__init__(message)
+        self.status_code = status_code
 
-load_dotenv()
 
 class AnthropicCompletionRequest:
     def __init__(self, model: str, max_tokens: int | None, tools, messages, system_prompt: str | None = None,
@@ -23,17 +33,17 @@ class AnthropicCompletionRequest:
         self.top_p = top_p
 
     @classmethod
+    @tracing.traced("anthropic.from_openai_request")
     def from_openai_request(cls, completionRequest: OpenAICompletionRequest) -> 'AnthropicCompletionRequest':
         openai_tools = completionRequest.tools
-        openai_messages = completionRequest.messages
 
         # convert tools from OpenAI to Anthropic format
         anthropic_tools = None
         if openai_tools is not None:
             anthropic_tools = [_format_openai_tool_to_anthropic_tool(tool) for tool in openai_tools]
 
-        # convert messages from OpenAI to Anthropic format
-        anthropic_chat = _format_openai_messages_to_anthropic_chat(openai_messages)
+        # convert messages from OpenAI to Anthropic format, only the new messages of a chat session
+        anthropic_chat = convert_messages(completionRequest, "anthropic", AnthropicMessageConverter)
 
         anthropic_request = AnthropicCompletionRequest(
             model=completionRequest.model,
@@ -46,22 +56,17 @@ class AnthropicCompletionRequest:
         )
         return anthropic_request
 
-    def make_api_request(self, base_url: str, api_key: str):
+    @tracing.traced("anthropic.make_api_request", tracing.KIND_CLIENT)
+    def make_api_request(self, base_url: str, api_key: str, deadline: Deadline | None = None):
         url = base_url + "/v1/messages"
 
-        # Anthropic API version and beta (required for tools)
-        ANTHROPIC_VERSION = "2023-06-01"
-        ANTHROPIC_BETA = "tools-2024-04-04"
-        headers = {
-            "content-type": "application/json",
-            "x-api-key": api_key,
-            "anthropic-version": ANTHROPIC_VERSION,
-            "anthropic-beta": ANTHROPIC_BETA,
-        }
+        headers = _get_api_headers(api_key)
 
         # send the request
         data = self.to_dict()
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        response = transport.post(url, deadline=deadline, headers=headers, content=json.dumps(data))
+        if response.is_error:
+            raise AnthropicApiError("Anthropic API returned an error: " + response.text, response.status_code)
         return response.json()
 
     def to_dict(self) -> dict:
@@ -83,6 +88,18 @@ class AnthropicCompletionRequest:
         return args
 
 
+def _get_api_headers(api_key: str) -> dict:
+    # Anthropic API version and beta (required for tools)
+    ANTHROPIC_VERSION = "2023-06-01"
+    ANTHROPIC_BETA = "tools-2024-04-04"
+    return {
+        "content-type": "application/json",
+        "x-api-key": api_key,
+        "anthropic-version": ANTHROPIC_VERSION,
+        "anthropic-beta": ANTHROPIC_BETA,
+    }
+
+
 class AnthropicChat:
     """Anthropic chat object."""
 
@@ -92,49 +109,35 @@ class AnthropicChat:
         self.system_prompt = system_prompt
 
 
-def _format_openai_messages_to_anthropic_chat(openai_messages) -> AnthropicChat:
-    system_prompt: str | None = None
-
-    anthropic_messages = []
-
-    tool_result_messages = []
+class AnthropicMessageConverter(MessageConverter):
+    """Converts OpenAI messages to an AnthropicChat."""
 
-    functions = []
+    def __init__(self):
+        super().__init__()
+        self.system_prompt: str | None = None
+        self.anthropic_messages = []
+        # tool results not followed by another message yet, sent together in one user message
+        self.tool_result_messages = []
+        self.functions = []
 
-    index = 0
-    for message in openai_messages:
+    def add(self, message: dict):
         if message["role"] == "system":
-            if system_prompt is None:
-                system_prompt = ""
-            system_prompt += message["content"] + "\n"
+            if self.system_prompt is None:
+                self.system_prompt = ""
+            self.system_prompt += message["content"] + "\n"
         elif message["role"] == "tool":
-            tool_result_messages.append(
+            self.tool_result_messages.append(
                 {
                     "tool_call_id": message["tool_call_id"],
-                    "content": message["content"],
-                    "append_id": index
+                    "content": message["content"]
                 }
             )
         elif message["role"] == "function":
-            functions.append(_format_openai_function_to_anthropic_tool(message["content"]))
+            self.functions.append(_format_openai_function_to_anthropic_tool(message["content"]))
         else:
-            if len(tool_result_messages) != 0:
-                content = []
-                for tool_result_message in tool_result_messages:
-                    content.append({
-                        "type": "tool_result",
-                        "tool_use_id": tool_result_message["tool_call_id"],
-                        "content": tool_result_message["content"]
-                    })
-
-                result_message = {
-                    "role": "user",
-                    "content": content
-                }
-
-                anthropic_messages.append(result_message)
-
-                tool_result_messages = []
+            if len(self.tool_result_messages) != 0:
+                self.anthropic_messages.append(_format_tool_results(self.tool_result_messages))
+                self.tool_result_messages = []
 
             if message.get("tool_calls"):
                 new_content = []
@@ -149,45 +152,56 @@ def _format_openai_messages_to_anthropic_chat(openai_messages) -> AnthropicChat:
                     "role": "assistant",
                     "content": new_content
                 }
-                anthropic_messages.append(new_message)
+                self.anthropic_messages.append(new_message)
 
             else:
-                anthropic_messages.append(message)
-        index += 1
-
-    if len(tool_result_messages) != 0:
-        content = []
-        for tool_result_message in tool_result_messages:
-            content.append({
-                "type": "tool_result",
-                "tool_use_id": tool_result_message["tool_call_id"],
-                "content": tool_result_message["content"]
-            })
+                self.anthropic_messages.append(message)
 
-        result_message = {
-            "role": "user",
-            "content": content
-        }
+    def build(self) -> AnthropicChat:
+        anthropic_messages = list(self.anthropic_messages)
+        system_prompt = self.system_prompt
 
-        anthropic_messages.append(result_message)
+        if len(self.tool_result_messages) != 0:
+            anthropic_messages.append(_format_tool_results(self.tool_result_messages))
 
-    if len(anthropic_messages) == 0:
-        anthropic_messages.append(
-            {
+        if len(anthropic_messages) == 0:
+            anthropic_messages.append(
+                {
+                    "role": "user",
+                    "content": [{"type": "text", "text": system_prompt}]
+                }
+            )
+            system_prompt = None
+
+        # Anthropic requires a user message at the start
+        if anthropic_messages[0]["role"] == "assistant":
+            anthropic_messages.insert(0, {
                 "role": "user",
-                "content": [{"type": "text", "text": system_prompt}]
-            }
-        )
-        system_prompt = None
+                "content": [{"type": "text", "text": "<no input>"}]
+            })
+
+        return AnthropicChat(messages=anthropic_messages, functions=list(self.functions), system_prompt=system_prompt)
+
 
-    # Anthropic requires a user message at the start
-    if anthropic_messages[0]["role"] == "assistant":
-        anthropic_messages.insert(0, {
-            "role": "user",
-            "content": [{"type": "text", "text": "<no input>"}]
+def _format_tool_results(tool_result_messages) -> dict:
+    content = []
+    for tool_result_message in tool_result_messages:
+        content.append({
+            "type": "tool_result",
+            "tool_use_id": tool_result_message["tool_call_id"],
+            "content": tool_result_message["content"]
         })
 
-    return AnthropicChat(messages=anthropic_messages, functions=functions, system_prompt=system_prompt)
+    return {
+        "role": "user",
+        "content": content
+    }
+
+
+def _format_openai_messages_to_anthropic_chat(openai_messages) -> AnthropicChat:
+    converter = AnthropicMessageConverter()
+    converter.extend(openai_messages)
+    return converter.build()
 
 
 def _format_openai_tool_to_anthropic_tool(input_json: dict) -> dict:
@@ -274,64 +288,76 @@ def _format_anthropic_message_to_openai_response(message) -> OpenAICompletionRes
 def _stream_request(completionRequest: OpenAICompletionRequest, client) -> Iterator[AnyStr]:
     sent_role = False
 
-    last_id = None
+    encoder = ChunkEncoder(completionRequest.model)
 
     stream_args = AnthropicCompletionRequest.from_openai_request(completionRequest).to_dict()
+    deadline = completionRequest.deadline
+    if deadline is not None:
+        stream_args["timeout"] = deadline.get_timeout()
 
-    with client.messages.stream(**stream_args) as stream:
+    with client.messages.stream(**stream_args) as stream, \
+            abort_on_cancel(deadline, lambda: transport.abort_response(stream.response)):
         for text in stream.text_stream:
-            delta = {"content": text}
+            role = None
             if not sent_role:
-                delta["role"] = "assistant"
+                role = "assistant"
                 sent_role = True
-            last_id = stream.current_message_snapshot.id
-            chunk_message = str(OpenAICompletionChunkResponse(
-                completion_id=last_id,
-                model=completionRequest.model,
-                choices=[{"index": 0, "delta": delta, "finish_reason": None}]
-            ).to_json())
-
-            yield "data:" + chunk_message + "\n\n"
+            yield encoder.encode(text, role, stream.current_message_snapshot.id)
 
-    chunk_message = str(OpenAICompletionChunkResponse(
-        completion_id=last_id,
-        model=completionRequest.model,
-        choices=[
-            {"index": 0, "delta": {}, "finish_reason": "stop"}]
-    ).to_json())
+        usage = stream.current_message_snapshot.usage
+        completionRequest.usage = {"prompt_tokens": usage.input_tokens, "completion_tokens": usage.output_tokens}
 
-    yield "data:" + chunk_message + "\n\n"
+    yield encoder.finish("stop")
 
 
 class AnthropicApiBackend(TargetApiBackend):
-    def __init__(self, base_url: str = os.environ.get("ANTHROPIC_API_URL", "https://api.anthropic.com"),
-                 api_key: str = os.environ.get("ANTHROPIC_API_KEY")):
+    name = "anthropic"
+
+    def __init__(self, base_url: str | None = None, api_key: str | None = None):
         """Load the available models from data/anthropic_models.json."""
 
-        models = []
-        with open('data/anthropic_models.json') as f:
-            data = json.load(f)
-            for model in data:
-                models.append(AvailableModel(**model))
-        super().__init__(base_url, api_key, models)
+        super().__init__(base_url or os.environ.get("ANTHROPIC_API_URL", "https://api.anthropic.com"),
+                         api_key or os.environ.get("ANTHROPIC_API_KEY"), load_models("anthropic"))
 
     def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> OpenAICompletionResponse:
         anthropic_request = AnthropicCompletionRequest.from_openai_request(completionRequest)
 
         anthropic_response = anthropic_request.make_api_request(
-            self.base_url, self.get_api_key(completionRequest, pass_api_key))
+            self.base_url, self.get_api_key(completionRequest, pass_api_key), completionRequest.deadline)
 
         if anthropic_response["type"] == "error":
-            raise Exception("Anthropic API returned an error: " + str(anthropic_response))
+            raise AnthropicApiError("Anthropic API returned an error: " + str(anthropic_response))
 
         return _format_anthropic_message_to_openai_response(anthropic_response)
 
+    def list_upstream_models(self) -> list[AvailableModel] | None:
+        models = []
+        params = {"limit": 1000}
+        while True:
+            response = transport.get_http_client(self.base_url).get(
+                self.base_url + "/v1/models", headers=_get_api_headers(self.api_key), params=params, timeout=30)
+            response.raise_for_status()
+            page = response.json()
+
+            for model in page["data"]:
+                models.append(AvailableModel(
+                    id=model["id"],
+                    object="model",
+                    created=int(datetime.fromisoformat(model["created_at"].replace("Z", "+00:00")).timestamp()),
+                    owned_by="anthropic"
+                ))
+
+            if not page.get("has_more"):
+                return models
+            params["after_id"] = page["last_id"]
+
     def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> Iterator[AnyStr]:
         client = anthropic.Anthropic(
             base_url=self.base_url,
             api_key=self.get_api_key(completionRequest, pass_api_key),
+            http_client=transport.get_http_client(self.base_url)
         )
 
         return _stream_request(completionRequest, client)
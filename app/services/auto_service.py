@@ -1,28 +1,123 @@
 from typing import Iterator, AnyStr
-from app.models import TargetApiBackend, OpenAICompletionRequest, OpenAICompletionResponse
+
+from app import tracing
+from app.models import TargetApiBackend, OpenAICompletionRequest, OpenAICompletionResponse, AvailableModel
+from app.services import registry
+from app.services.race_service import RaceApiBackend
+from app.services.registry import load_models, load_backend, EMBEDDING_MODELS
+from app.services.selector_service import SelectorApiBackend, POLICIES
 
 
 class AutoApiBackend(TargetApiBackend):
     """A backend that automatically selects the correct backend based on the model ID."""
 
-    def __init__(self, supported_backends: list[TargetApiBackend]):
+    name = "auto"
+
+    def __init__(self, supported_backends: list[str], race_groups: dict[str, list[str]] | None = None,
+                 auto_models: list[str] | None = None, auto_latency_slo_ms: float = 0, auto_exploration: float = 0.05):
+        """
+        :param supported_backends: Names of the backends to route to, the backends themselves are only loaded when a
+            request for one of their models is received.
+        :param race_groups: Virtual model names and the models each of them races against each other.
+        :param auto_models: Models the virtual auto-fast and auto-cheap models choose from, None or empty to disable
+            them.
+        :param auto_latency_slo_ms: Default latency SLO of auto-cheap, 0 for none.
+        :param auto_exploration: Share of the auto-fast and auto-cheap requests used to measure other models.
+        """
         self.supported_backends = supported_backends
+        self.race_backends: dict[str, RaceApiBackend] = {
+            model_id: RaceApiBackend(model_id, members, self.get_backend, self.get_catalog_model)
+            for model_id, members in (race_groups or {}).items()}
+        self.selector_backend: SelectorApiBackend | None = SelectorApiBackend(
+            auto_models, self.get_backend, self.get_catalog_model, auto_latency_slo_ms,
+            auto_exploration) if auto_models else None
+
+        # model id -> backend name, built from the model catalogs without loading the backends
+        self.model_routes: dict[str, str] = {}
+        self.catalog_version = -1
+
+        super().__init__('', '', [])
+        self.update_routes()
+
+    @property
+    def models(self) -> list[AvailableModel]:
+        self.update_routes()
+        return self._models
+
+    @models.setter
+    def models(self, models: list[AvailableModel]):
+        self._models = models
+
+    def update_routes(self):
+        """Rebuild the model list and routing table if any of the backend catalogs changed since the last call."""
+
+        if self.catalog_version == registry.catalog_version:
+            return
+
+        catalog_version = registry.catalog_version
+        model_routes = {}
+        for backend_name in self.supported_backends:
+            for model in load_models(backend_name):
+                model_routes.setdefault(model.id, backend_name)
+
+        # swap in the new tables at once so concurrent requests never see a partially built routing table
+        self._models = [model for backend_name in self.supported_backends for model in load_models(backend_name)] + \
+            [race_backend.models[0] for race_backend in self.race_backends.values()] + \
+            (self.selector_backend.models if self.selector_backend is not None else [])
+        self.model_routes = model_routes
+        self.catalog_version = catalog_version
+
+    def get_backend(self, model_id: str) -> TargetApiBackend:
+        """Get the backend serving a model, loading it if this is the first request routed to it."""
+
+        race_backend = self.race_backends.get(model_id)
+        if race_backend is not None:
+            return race_backend
+        if model_id in POLICIES and self.selector_backend is not None:
+            return self.selector_backend
 
-        models = [model for backend in supported_backends for model in backend.models]
-        super().__init__('', '', models)
+        self.update_routes()
+
+        backend_name = self.model_routes.get(model_id)
+        if backend_name is None:
+            raise ValueError("Model not found in any supported backend")
+
+        return load_backend(backend_name)
+
+    def get_embedding_backend(self, model_id: str) -> TargetApiBackend:
+        """Get the backend serving an embedding model, loading it if this is the first request routed to it."""
+
+        backend_name = EMBEDDING_MODELS.get(model_id)
+        if backend_name is None:
+            # models of refreshed catalogs
+            self.update_routes()
+            backend_name = self.model_routes.get(model_id)
+        if backend_name is None or backend_name not in self.supported_backends:
+            raise ValueError("Embedding model not found in any supported backend")
+
+        return load_backend(backend_name)
+
+    def get_catalog_model(self, model_id: str) -> AvailableModel | None:
+        """Get a model from the catalogs without loading its backend."""
+
+        self.update_routes()
+
+        backend_name = self.model_routes.get(model_id)
+        if backend_name is None:
+            return None
+        return next((model for model in load_models(backend_name) if model.id == model_id), None)
+
+    def _route(self, model_id: str) -> TargetApiBackend:
+        with tracing.start_span("auto.route", {"model": model_id}) as span:
+            backend = self.get_backend(model_id)
+            span.set_attribute("backend", backend.name)
+        return backend
 
     def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> OpenAICompletionResponse:
-        for backend in self.supported_backends:
-            if completionRequest.model in [model.id for model in backend.models]:
-                return backend.handle_completion_request(completionRequest, pass_api_key)
-
-        raise ValueError("Model not found in any supported backend")
+        return self._route(completionRequest.model).handle_completion_request(completionRequest, pass_api_key)
 
     def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> Iterator[AnyStr]:
-        for backend in self.supported_backends:
-            if completionRequest.model in [model.id for model in backend.models]:
-                return backend.handle_streamed_completion_request(completionRequest, pass_api_key)
-
-        raise ValueError("Model not found in any supported backend")
+        return self._route(completionRequest.model).handle_streamed_completion_request(
+            completionRequest, pass_api_key)
@@ -1,15 +1,24 @@
 import json
 import os
+import time
+from contextlib import closing
 from typing import Iterator, AnyStr, Sequence
 
 import cohere
 from cohere.types import NonStreamedChatResponse, Tool, ChatRequestToolResultsItem
-from dotenv import load_dotenv
 
+from app import tracing, transport
+from app.deadline import Deadline
 from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse, \
-    OpenAICompletionChunkResponse
+    ChunkEncoder, Embeddings, MessageConverter, convert_messages
+from app.services.registry import load_models
+
+# cohere rejects larger max_tokens values, requests asking for more are clamped
+MAX_OUTPUT_TOKENS = 4000
+
+# most texts cohere embeds in one call
+MAX_EMBEDDING_BATCH_SIZE = 96
 
-load_dotenv()
 
 class CohereCompletionRequest:
     def __init__(self, model: str, max_tokens: int | None, tools: Sequence[Tool] | None,
@@ -26,6 +35,7 @@ class CohereCompletionRequest:
         self.top_p = top_p
 
     @classmethod
+    @tracing.traced("cohere.from_openai_request")
     def from_openai_request(cls, completionRequest: OpenAICompletionRequest) -> 'CohereCompletionRequest':
         openai_tools = completionRequest.tools
 
@@ -34,12 +44,12 @@ class CohereCompletionRequest:
         if openai_tools is not None:
             cohere_tools = [_format_openai_tool_to_cohere_tool(tool) for tool in openai_tools]
 
-        # convert openai messages to cohere chat format
-        cohere_chat = _format_openai_messages_to_cohere_chat(completionRequest.messages)
+        # convert openai messages to cohere chat format, only the new messages of a chat session
+        cohere_chat = convert_messages(completionRequest, "cohere", CohereMessageConverter)
 
         cohere_request = CohereCompletionRequest(
             model=completionRequest.model,
-            max_tokens=min(completionRequest.max_tokens, 4000) if completionRequest.max_tokens is not None else None,
+            max_tokens=min(completionRequest.max_tokens, MAX_OUTPUT_TOKENS) if completionRequest.max_tokens is not None else None,
             tools=cohere_tools,
             tool_results=cohere_chat.tool_results,
             chat_history=cohere_chat.chat_history,
@@ -50,8 +60,12 @@ class CohereCompletionRequest:
         )
         return cohere_request
 
-    def make_api_request(self, base_url: str, api_key: str) -> NonStreamedChatResponse:
-        client = cohere.Client(api_key, base_url=base_url)
+    @tracing.traced("cohere.make_api_request", tracing.KIND_CLIENT)
+    def make_api_request(self, base_url: str, api_key: str, deadline: Deadline | None = None) \
+            -> NonStreamedChatResponse:
+        client = cohere.Client(api_key, base_url=base_url,
+                               timeout=deadline.get_seconds() if deadline is not None else None)
+        _instrument_client(client)
 
         response = client.chat(**self.to_dict())
         return response
@@ -87,53 +101,59 @@ class CohereChat:
         self.tool_results = tool_results
 
 
-def _format_openai_messages_to_cohere_chat(openai_messages) -> CohereChat:
-    chat_history = []
-
-    preamble = None
+class CohereMessageConverter(MessageConverter):
+    """Converts OpenAI messages to a CohereChat."""
 
-    tool_results = []
+    def __init__(self):
+        super().__init__()
+        self.chat_history = []
+        self.preamble = None
+        self.tool_results = []
+        # tool call id -> function of the tool calls made by the assistant so far
+        self.tool_calls = {}
 
-    for message in openai_messages:
+    def add(self, message: dict):
         if message["role"] == "user":
-            chat_history.append(cohere.ChatMessage(role="USER", message=message["content"]))
-        elif message["role"] == "assistant" and message.get("content") is not None:
-            chat_history.append(cohere.ChatMessage(role="CHATBOT", message=message["content"]))
+            self.chat_history.append(cohere.ChatMessage(role="USER", message=message["content"]))
+        elif message["role"] == "assistant":
+            for tool_call in message.get("tool_calls") or []:
+                self.tool_calls[tool_call["id"]] = tool_call["function"]
+            if message.get("content") is not None:
+                self.chat_history.append(cohere.ChatMessage(role="CHATBOT", message=message["content"]))
         elif message["role"] == "tool":
-            corresponding_call_arguments = None
-            corresponding_call_name = None
-            for tool_message in openai_messages:
-                if tool_message["role"] == "assistant" and tool_message.get("tool_calls") is not None:
-                    for tool_call in tool_message["tool_calls"]:
-                        if tool_call["id"] == message["tool_call_id"]:
-                            corresponding_call_arguments = tool_call["function"]["arguments"]
-                            corresponding_call_name = tool_call["function"]["name"]
-                            break
+            function = self.tool_calls.get(message["tool_call_id"], {})
             call = {
-                "name": corresponding_call_name,
-                "parameters": json.loads(corresponding_call_arguments),
-                "generation_id": corresponding_call_name + message["tool_call_id"]  # TODO: reconsider this
+                "name": function.get("name"),
+                "parameters": json.loads(function.get("arguments")),
+                "generation_id": function.get("name") + message["tool_call_id"]  # TODO: reconsider this
             }
 
             # replace content ' with " to make it json compatible
             content = message["content"].replace("'", "\"")
-            tool_results.append(
+            self.tool_results.append(
                 {
                     "call": call,
                     "outputs": [json.loads(content)]
                 }
             )
         elif message["role"] == "system":
-            if preamble is None:
-                preamble = ""
-            preamble += message["content"] + "\n"
+            if self.preamble is None:
+                self.preamble = ""
+            self.preamble += message["content"] + "\n"
 
-    # the last message is the user prompt so remove it from the chat history
-    last_message = chat_history[-1]
-    chat_history = chat_history[:-1]
+    def build(self) -> CohereChat:
+        # the last message is the user prompt so remove it from the chat history
+        last_message = self.chat_history[-1]
+        chat_history = self.chat_history[:-1]
 
-    return CohereChat(chat_history=chat_history, last_message=last_message.message, preamble=preamble,
-                      tool_results=tool_results)
+        return CohereChat(chat_history=chat_history, last_message=last_message.message, preamble=self.preamble,
+                          tool_results=list(self.tool_results))
+
+
+def _format_openai_messages_to_cohere_chat(openai_messages) -> CohereChat:
+    converter = CohereMessageConverter()
+    converter.extend(openai_messages)
+    return converter.build()
 
 
 def _format_openai_tool_to_cohere_tool(input_json: dict) -> Tool:
@@ -235,58 +255,92 @@ def _stream_request(completionRequest: OpenAICompletionRequest, client: cohere.c
 
     response_stream = client.chat_stream(**CohereCompletionRequest.from_openai_request(completionRequest).to_dict())
 
-    completionId = "static_id"
+    encoder = ChunkEncoder(completionRequest.model, "static_id")
 
-    for response in response_stream:
-        if response.event_type == "stream-start":
-            continue
+    # closed explicitly so the upstream stream ends as soon as the client goes away, aborted if the request is
+    # cancelled while waiting for the next event
+    with closing(response_stream), transport.abort_responses_on_cancel(
+            client._client_wrapper.httpx_client.httpx_client, completionRequest.deadline):
+        for response in response_stream:
+            if response.event_type == "stream-start":
+                continue
 
-        if response.event_type == "stream-end":
-            chunk_message = str(OpenAICompletionChunkResponse(
-                completion_id=completionId,
-                model=completionRequest.model,
-                choices=[
-                    {"index": 0, "delta": {}, "finish_reason": "stop"}]
-            ).to_json())
+            if response.event_type == "stream-end":
+                tokens = response.response.meta.tokens if response.response.meta else None
+                if tokens is not None:
+                    completionRequest.usage = {"prompt_tokens": int(tokens.input_tokens or 0),
+                                               "completion_tokens": int(tokens.output_tokens or 0)}
 
-            yield "data:" + chunk_message + "\n\n"
+                yield encoder.finish("stop")
 
-            break
+                break
 
-        if response.event_type == "text-generation":
-            delta = {"content": response.text}
-            if not sent_role:
-                delta["role"] = "assistant"
-                sent_role = True
-            chunk_message = str(OpenAICompletionChunkResponse(
-                completion_id=completionId,
-                model=completionRequest.model,
-                choices=[{"index": 0, "delta": delta, "finish_reason": None}]
-            ).to_json())
+            if response.event_type == "text-generation":
+                role = None
+                if not sent_role:
+                    role = "assistant"
+                    sent_role = True
+                yield encoder.encode(response.text, role)
 
-            yield "data:" + chunk_message + "\n\n"
+
+def _instrument_client(client: cohere.Client):
+    # the SDK creates its own HTTP client, which sends the traceparent header of the current span
+    tracing.instrument_client(client._client_wrapper.httpx_client.httpx_client)
 
 
 class CohereApiBackend(TargetApiBackend):
-    def __init__(self, base_url: str = os.environ.get("COHERE_API_URL", "https://api.cohere.ai"),
-                 api_key: str = os.environ.get("COHERE_API_KEY")):
+    name = "cohere"
+    max_output_tokens = MAX_OUTPUT_TOKENS
+    max_embedding_batch_size = MAX_EMBEDDING_BATCH_SIZE
+
+    def __init__(self, base_url: str | None = None, api_key: str | None = None):
         """Load the available models from data/cohere_models.json."""
 
-        models = []
-        with open('data/cohere_models.json') as f:
-            data = json.load(f)
-            for model in data:
-                models.append(AvailableModel(**model))
-        super().__init__(base_url, api_key, models)
+        super().__init__(base_url or os.environ.get("COHERE_API_URL", "https://api.cohere.ai"),
+                         api_key or os.environ.get("COHERE_API_KEY"), load_models("cohere"))
 
     def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> OpenAICompletionResponse:
         cohere_response = CohereCompletionRequest.from_openai_request(completionRequest).make_api_request(
-            self.base_url, self.get_api_key(completionRequest, pass_api_key))
+            self.base_url, self.get_api_key(completionRequest, pass_api_key), completionRequest.deadline)
 
         return _format_cohere_response_to_openai_response(completionRequest, cohere_response)
 
+    def create_embeddings(self, model: str, inputs: list[str], api_key: str, deadline: Deadline | None = None) \
+            -> Embeddings | None:
+        client = cohere.Client(api_key, base_url=self.base_url,
+                               timeout=deadline.get_seconds() if deadline is not None else None)
+        _instrument_client(client)
+
+        # v3 models require an input type, the OpenAI API has no equivalent, documents are the general purpose choice
+        response = client.embed(texts=inputs, model=model, input_type="search_document", batching=False)
+        billed_units = response.meta.billed_units if response.meta is not None else None
+        return Embeddings(response.embeddings, int(billed_units.input_tokens or 0) if billed_units else 0)
+
+    def list_upstream_models(self) -> list[AvailableModel] | None:
+        client = cohere.Client(self.api_key, base_url=self.base_url)
+
+        # the cohere model list has no creation date, use the discovery time of new models instead and keep the one of
+        # known models, so an unchanged catalog stays the same
+        created = {model.id: model.created for model in load_models("cohere")}
+        discovered = int(time.time())
+        models = []
+        page_token = None
+        while True:
+            response = client.models.list(endpoint="chat", page_size=1000, page_token=page_token)
+            models.extend(AvailableModel(id=model.name, object="model", created=created.get(model.name, discovered),
+                                         owned_by="cohere",
+                                         context_window=int(model.context_length) if model.context_length else None)
+                          for model in response.models or [])
+
+            page_token = response.next_page_token
+            if not page_token:
+                return models
+
     def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> Iterator[AnyStr]:
-        co = cohere.Client(self.get_api_key(completionRequest, pass_api_key), base_url=self.base_url)
+        deadline = completionRequest.deadline
+        co = cohere.Client(self.get_api_key(completionRequest, pass_api_key), base_url=self.base_url,
+                           timeout=deadline.get_seconds() if deadline is not None else None)
+        _instrument_client(co)
         return _stream_request(completionRequest, co)
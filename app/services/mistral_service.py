@@ -1,16 +1,16 @@
-import json
 import os
+from contextlib import closing
 from typing import Iterator, AnyStr
 
-from dotenv import load_dotenv
-
+from app import tracing, transport
+from app.deadline import Deadline
 from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse, \
-    OpenAICompletionChunkResponse
+    ChunkEncoder, Embeddings
+from app.services.registry import load_models
 
 from mistralai.client import MistralClient
 from mistralai.models.chat_completion import ChatCompletionResponse
 
-load_dotenv()
 
 class MistralCompletionRequest:
     def __init__(self, model: str, max_tokens: int | None, tools, messages,
@@ -24,6 +24,7 @@ class MistralCompletionRequest:
         self.tool_choice = tool_choice
 
     @classmethod
+    @tracing.traced("mistral.from_openai_request")
     def from_openai_request(cls, completionRequest: OpenAICompletionRequest) -> 'MistralCompletionRequest':
         mistral_messages = _format_openai_messages_to_mistral_messages(completionRequest.messages)
 
@@ -42,8 +43,10 @@ class MistralCompletionRequest:
         )
         return mistral_request
 
-    def make_api_request(self, base_url: str, api_key: str) -> ChatCompletionResponse:
-        client = MistralClient(api_key=api_key, endpoint=base_url)
+    @tracing.traced("mistral.make_api_request", tracing.KIND_CLIENT)
+    def make_api_request(self, base_url: str, api_key: str, deadline: Deadline | None = None) \
+            -> ChatCompletionResponse:
+        client = _get_client(base_url, api_key, deadline)
 
         additional_args = {}
         if self.temperature is not None:
@@ -96,6 +99,18 @@ def _format_mistral_response_to_openai_response(response: ChatCompletionResponse
         promptTokens=response.usage.prompt_tokens)
 
 
+def _get_client(base_url: str, api_key: str, deadline: Deadline | None) -> MistralClient:
+    # the SDK takes a single timeout per client, clients are created per request
+    timeout = deadline.get_seconds() if deadline is not None else None
+    if timeout is None:
+        client = MistralClient(api_key=api_key, endpoint=base_url)
+    else:
+        client = MistralClient(api_key=api_key, endpoint=base_url, timeout=timeout)
+    # the SDK does not take an HTTP client, its own one sends the traceparent header instead
+    tracing.instrument_client(client._client)
+    return client
+
+
 def _stream_request(completionRequest: OpenAICompletionRequest, client: MistralClient) -> Iterator[AnyStr]:
     mistral_messages = completionRequest.messages
 
@@ -105,40 +120,56 @@ def _stream_request(completionRequest: OpenAICompletionRequest, client: MistralC
         "model": completionRequest.model
     }
 
-    for chunk in client.chat_stream(**stream_args):
-        chunk_message = str(OpenAICompletionChunkResponse(
-            completion_id=chunk.id,
-            model=completionRequest.model,
-            choices=[{"index": 0, "delta": {
-                "content": chunk.choices[0].delta.content,
-                "role": "assistant"
-            }, "finish_reason": None}]
-        ).to_json())
+    encoder = ChunkEncoder(completionRequest.model)
 
-        yield "data:" + chunk_message + "\n\n"
+    # closed explicitly so the upstream stream ends as soon as the client goes away, aborted if the request is
+    # cancelled while waiting for the next chunk
+    with closing(client.chat_stream(**stream_args)) as response_stream, \
+            transport.abort_responses_on_cancel(client._client, completionRequest.deadline):
+        for chunk in response_stream:
+            # the last chunk reports the token usage of the whole stream
+            if chunk.usage is not None:
+                completionRequest.usage = {"prompt_tokens": chunk.usage.prompt_tokens,
+                                           "completion_tokens": chunk.usage.completion_tokens}
+
+            yield encoder.encode(chunk.choices[0].delta.content, "assistant", chunk.id)
 
 
 class MistralApiBackend(TargetApiBackend):
-    def __init__(self, base_url: str = os.environ.get("MISTRAL_API_URL", "https://api.mistral.ai"),
-                 api_key: str = os.environ.get("MISTRAL_API_KEY")):
+    name = "mistral"
+    # the API also limits the total tokens of a batch, long inputs are rejected by the provider
+    max_embedding_batch_size = 128
+
+    def __init__(self, base_url: str | None = None, api_key: str | None = None):
         """Load the available models from data/mistral_models.json."""
 
-        models = []
-        with open('data/mistral_models.json') as f:
-            data = json.load(f)
-            for model in data:
-                models.append(AvailableModel(**model))
-        super().__init__(base_url, api_key, models)
+        super().__init__(base_url or os.environ.get("MISTRAL_API_URL", "https://api.mistral.ai"),
+                         api_key or os.environ.get("MISTRAL_API_KEY"), load_models("mistral"))
 
     def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> OpenAICompletionResponse:
         request = MistralCompletionRequest.from_openai_request(completionRequest)
-        response = request.make_api_request(self.base_url, self.get_api_key(completionRequest, pass_api_key))
+        response = request.make_api_request(self.base_url, self.get_api_key(completionRequest, pass_api_key),
+                                            completionRequest.deadline)
 
         return _format_mistral_response_to_openai_response(response)
 
+    def create_embeddings(self, model: str, inputs: list[str], api_key: str, deadline: Deadline | None = None) \
+            -> Embeddings | None:
+        response = _get_client(self.base_url, api_key, deadline).embeddings(model, inputs)
+
+        data = sorted(response.data, key=lambda embedding: embedding.index)
+        return Embeddings([embedding.embedding for embedding in data], response.usage.prompt_tokens)
+
+    def list_upstream_models(self) -> list[AvailableModel] | None:
+        client = MistralClient(api_key=self.api_key, endpoint=self.base_url)
+
+        return [AvailableModel(id=model.id, object="model", created=model.created, owned_by=model.owned_by)
+                for model in client.list_models().data]
+
     def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> Iterator[AnyStr]:
-        client = MistralClient(api_key=self.get_api_key(completionRequest, pass_api_key), endpoint=self.base_url)
+        client = _get_client(self.base_url, self.get_api_key(completionRequest, pass_api_key),
+                             completionRequest.deadline)
 
         return _stream_request(completionRequest, client)
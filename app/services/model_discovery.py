@@ -0,0 +1,69 @@
+import logging
+import threading
+
+from app.services.registry import load_backend, load_models, set_models
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRefresher:
+    """Periodically fetches the live model lists from the providers and updates the model catalogs."""
+
+    def __init__(self, backend_names: list[str], interval: float):
+        """
+        :param backend_names: Names of the backends to refresh.
+        :param interval: Seconds between refreshes.
+        """
+        self.backend_names = backend_names
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """Start refreshing on a background daemon thread, requests keep being served from the current catalogs."""
+
+        self._thread = threading.Thread(target=self._run, name="model-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def refresh(self):
+        """Refresh the catalogs of all backends once, keeping the current catalog of backends that fail."""
+
+        for backend_name in self.backend_names:
+            try:
+                backend = load_backend(backend_name)
+                if backend.api_key is None:
+                    continue
+
+                models = backend.list_upstream_models()
+            except Exception:
+                logger.warning("Failed to fetch the model list of backend %s", backend_name, exc_info=True)
+                continue
+
+            # not every provider lists the context window and none lists prices, keep the ones of the current catalog
+            current_models = {model.id: model for model in load_models(backend_name)}
+            for model in models or []:
+                current_model = current_models.get(model.id)
+                if current_model is None:
+                    continue
+                if model.context_window is None:
+                    model.context_window = current_model.context_window
+                if model.prompt_price is None:
+                    model.prompt_price = current_model.prompt_price
+                    model.completion_price = current_model.completion_price
+
+            # only replace changed catalogs so the /v1/models ETag stays stable
+            if models and [model.to_dict() for model in models] != \
+                    [model.to_dict() for model in current_models.values()]:
+                logger.info("Updated the model list of backend %s (%d models)", backend_name, len(models))
+                set_models(backend_name, models)
+
+    def _run(self):
+        while True:
+            self.refresh()
+            if self._stop_event.wait(self.interval):
+                return
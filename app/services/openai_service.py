@@ -2,46 +2,67 @@ import json
 import os
 from typing import Iterator, AnyStr
 
-import requests
-from dotenv import load_dotenv
 from openai import OpenAI
 
-from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse
+from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse, \
+    Embeddings
+from app import transport
+from app.deadline import Deadline
+from app.services.registry import load_models
 
-load_dotenv()
 
 def _stream_request(completionRequest: OpenAICompletionRequest, client: OpenAI) -> Iterator[AnyStr]:
     stream_args = completionRequest.to_dict()
     stream_args["stream"] = True
 
+    # always ask for the usage chunk, but only forward it if the client asked for it as well
+    forward_usage = bool((completionRequest.stream_options or {}).get("include_usage"))
+    stream_args["stream_options"] = {"include_usage": True}
+
     url = str(client.base_url) + "/chat/completions"
     headers = {
         "Authorization": "Bearer " + client.api_key,
         "Content-Type": "application/json"
     }
 
-    response = requests.post(url=url, json=stream_args, headers=headers, stream=True)
+    with transport.stream("POST", url, deadline=completionRequest.deadline, json=stream_args,
+                          headers=headers) as response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+
+            # the usage chunk is the only one with token counts and no choices
+            if '"prompt_tokens"' in line and line.startswith("data:"):
+                usage = json.loads(line[5:]).get("usage")
+                if usage:
+                    completionRequest.usage = {"prompt_tokens": usage["prompt_tokens"],
+                                               "completion_tokens": usage["completion_tokens"]}
+                    if not forward_usage:
+                        continue
 
-    for chunk in response.iter_lines():
-        yield chunk + b"\n\n"
+            yield line + "\n\n"
 
 
 class OpenAIApiBackend(TargetApiBackend):
-    def __init__(self, base_url: str = os.environ.get("OPENAI_API_URL", "https://api.openai.com/v1"),
-                 api_key: str = os.environ.get("OPENAI_API_KEY")):
+    name = "openai"
+    supports_n = True
+    max_embedding_batch_size = 2048
+
+    def __init__(self, base_url: str | None = None, api_key: str | None = None):
         """Load the available models from data/openai_models.json."""
-        models = []
-        with open('data/openai_models.json') as f:
-            data = json.load(f)
-            for model in data:
-                models.append(AvailableModel(**model))
-        super().__init__(base_url, api_key, models)
+
+        super().__init__(base_url or os.environ.get("OPENAI_API_URL", "https://api.openai.com/v1"),
+                         api_key or os.environ.get("OPENAI_API_KEY"), load_models("openai"))
 
     def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> OpenAICompletionResponse:
-        client: OpenAI = OpenAI(api_key=self.get_api_key(completionRequest, pass_api_key), base_url=self.base_url)
+        client: OpenAI = OpenAI(api_key=self.get_api_key(completionRequest, pass_api_key), base_url=self.base_url,
+                                http_client=transport.get_http_client(self.base_url))
 
-        response = client.chat.completions.create(**completionRequest.to_dict())
+        request_args = completionRequest.to_dict()
+        if completionRequest.deadline is not None:
+            request_args["timeout"] = completionRequest.deadline.get_timeout()
+        response = client.chat.completions.create(**request_args)
 
         return OpenAICompletionResponse(
             completion_id=response.id,
@@ -52,8 +73,27 @@ class OpenAIApiBackend(TargetApiBackend):
             system_fingerprint=response.system_fingerprint
         )
 
+    def create_embeddings(self, model: str, inputs: list[str], api_key: str, deadline: Deadline | None = None) \
+            -> Embeddings | None:
+        client = OpenAI(api_key=api_key, base_url=self.base_url, http_client=transport.get_http_client(self.base_url))
+
+        embedding_args = {"model": model, "input": inputs}
+        if deadline is not None:
+            embedding_args["timeout"] = deadline.get_timeout()
+        response = client.embeddings.create(**embedding_args)
+        data = sorted(response.data, key=lambda embedding: embedding.index)
+        return Embeddings([embedding.embedding for embedding in data], response.usage.prompt_tokens)
+
+    def list_upstream_models(self) -> list[AvailableModel] | None:
+        client = OpenAI(api_key=self.api_key, base_url=self.base_url,
+                        http_client=transport.get_http_client(self.base_url))
+
+        return [AvailableModel(id=model.id, object="model", created=model.created, owned_by=model.owned_by)
+                for model in client.models.list()]
+
     def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
             -> Iterator[AnyStr]:
-        client = OpenAI(api_key=self.get_api_key(completionRequest, pass_api_key), base_url=self.base_url)
+        client = OpenAI(api_key=self.get_api_key(completionRequest, pass_api_key), base_url=self.base_url,
+                        http_client=transport.get_http_client(self.base_url))
 
         return _stream_request(completionRequest, client)
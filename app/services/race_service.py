@@ -0,0 +1,269 @@
+import copy
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import as_completed
+from typing import Iterator, AnyStr, Callable
+
+from app import fanout, tracing
+from app.circuit_breaker import get_circuit_breaker, is_backend_failure
+from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse
+
+logger = logging.getLogger(__name__)
+
+
+class RaceStats:
+    """Outcomes of the races of a group, per member model."""
+
+    def __init__(self, members: list[str]):
+        self._lock = threading.Lock()
+        self.races = 0
+        self.wins = dict.fromkeys(members, 0)
+        self.errors = dict.fromkeys(members, 0)
+        # summed seconds from the start of a race until the member won it
+        self.win_time = dict.fromkeys(members, 0.0)
+
+    def record_win(self, member: str, seconds: float):
+        with self._lock:
+            self.races += 1
+            self.wins[member] += 1
+            self.win_time[member] += seconds
+
+    def record_error(self, member: str):
+        with self._lock:
+            self.errors[member] += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "races": self.races,
+                "members": [{
+                    "model": member,
+                    "wins": self.wins[member],
+                    "errors": self.errors[member],
+                    "avg_win_ms": self.win_time[member] / self.wins[member] * 1000 if self.wins[member] else None
+                } for member in self.wins]
+            }
+
+
+def parse_race_groups(value: str | None) -> dict[str, list[str]]:
+    """
+    Parse race groups from the RACE_GROUPS format.
+
+    :param value: Groups separated by ";", each a virtual model name and its comma separated member models, e.g.
+        "race-fast=claude-3-haiku-20240307,mistral-small-latest,gpt-3.5-turbo".
+    :raises ValueError: If a group is malformed.
+    """
+    groups = {}
+    for group in (value or "").split(";"):
+        if not group.strip():
+            continue
+        name, _, members = group.partition("=")
+        members = [member.strip() for member in members.split(",") if member.strip()]
+        if not name.strip() or len(members) < 2:
+            raise ValueError("Race groups must be defined as <model>=<member>,<member>[,...]: " + group)
+        groups[name.strip()] = members
+    return groups
+
+
+def _is_failure(clone: OpenAICompletionRequest, error: Exception) -> bool | None:
+    # a member aborted because another one won did not fail, its call has no outcome
+    if clone.deadline is not None and clone.deadline.cancelled:
+        return None
+    return is_backend_failure(error)
+
+
+def _has_token(chunk: dict) -> bool:
+    for choice in chunk.get("choices") or []:
+        delta = choice.get("delta") or {}
+        if delta.get("content") or delta.get("tool_calls"):
+            return True
+    return False
+
+
+class RaceApiBackend(TargetApiBackend):
+    """
+    A virtual model sending every request to all models of a group at once and answering with the first good
+    response. The streams of the other models are aborted as soon as a winner is known, like their non-streamed calls
+    sent over HTTP/2. The other non-streamed calls cannot be interrupted, they finish in the background and their
+    responses are discarded.
+    """
+
+    name = "race"
+    virtual = True
+
+    def __init__(self, model_id: str, members: list[str], get_member_backend: Callable[[str], TargetApiBackend],
+                 get_member_model: Callable[[str], AvailableModel | None]):
+        """
+        :param model_id: Name of the virtual model.
+        :param members: Models raced against each other.
+        :param get_member_backend: Gets the backend serving a member model.
+        :param get_member_model: Gets the catalog entry of a member model.
+        """
+        self.members = members
+        self.get_member_backend = get_member_backend
+        self.get_member_model = get_member_model
+        self.stats = RaceStats(members)
+        super().__init__('', '', [AvailableModel(id=model_id, object="model", created=0, owned_by="race")])
+
+    def get_model(self, model_id: str) -> AvailableModel | None:
+        model = super().get_model(model_id)
+        if model is None:
+            return None
+
+        # a request has to fit every member, the smallest context window applies
+        context_windows = [member_model.context_window if member_model is not None else None
+                           for member_model in map(self.get_member_model, self.members)]
+        if None not in context_windows:
+            model.context_window = min(context_windows)
+        return model
+
+    def _clone(self, completionRequest: OpenAICompletionRequest, member: str) -> OpenAICompletionRequest:
+        # every member gets its own deadline, so the losers can be cancelled without the winner
+        clone = copy.copy(completionRequest)
+        clone.model = member
+        clone.usage = None
+        if completionRequest.deadline is not None:
+            clone.deadline = completionRequest.deadline.child()
+        return clone
+
+    def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
+            -> OpenAICompletionResponse:
+        started_at = time.monotonic()
+        clones = [self._clone(completionRequest, member) for member in self.members]
+
+        def call(clone: OpenAICompletionRequest) -> OpenAICompletionResponse:
+            with tracing.start_span("race.member", {"model": clone.model}):
+                backend = self.get_member_backend(clone.model)
+                breaker = get_circuit_breaker(backend.name, "completions")
+                # a member with an open circuit fails right away and loses the race
+                probe = breaker.before_call() if breaker is not None else False
+                member_started_at = time.monotonic()
+                try:
+                    response = backend.handle_completion_request(clone, pass_api_key)
+                except Exception as e:
+                    if breaker is not None:
+                        breaker.after_call(probe, _is_failure(clone, e))
+                    raise
+                if breaker is not None:
+                    breaker.after_call(probe, False, time.monotonic() - member_started_at)
+                return response
+
+        executor = fanout.get_executor()
+        call = tracing.propagate(call)
+        futures = {executor.submit(call, clone): clone for clone in clones}
+        error = None
+        for future in as_completed(futures):
+            clone = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.warning("Race member %s failed: %s", clone.model, e)
+                self.stats.record_error(clone.model)
+                error = e
+                continue
+            if not response.choices:
+                self.stats.record_error(clone.model)
+                continue
+
+            self._finish(clone, clones, started_at)
+            return response
+
+        if error is not None:
+            raise error
+        raise Exception("No member of the race returned a response")
+
+    def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
+            -> Iterator[AnyStr]:
+        started_at = time.monotonic()
+        clones = [self._clone(completionRequest, member) for member in self.members]
+        output: queue.Queue = queue.Queue(maxsize=256)
+        stopped = [threading.Event() for _ in clones]
+
+        def member_frames(clone: OpenAICompletionRequest) -> Iterator[AnyStr]:
+            # resolved on the reader thread, a member that cannot be loaded or whose circuit is open only loses its race
+            backend = self.get_member_backend(clone.model)
+            breaker = get_circuit_breaker(backend.name, "completions")
+            probe = breaker.before_call() if breaker is not None else False
+            member_started_at = time.monotonic()
+            ttft = None
+            # None while the stream runs and if it is stopped because another member won
+            failed = None
+            try:
+                for frame in backend.handle_streamed_completion_request(clone, pass_api_key):
+                    if ttft is None:
+                        ttft = time.monotonic() - member_started_at
+                    yield frame
+                failed = False
+            except Exception as e:
+                failed = _is_failure(clone, e)
+                raise
+            finally:
+                if breaker is not None:
+                    breaker.after_call(probe, failed, ttft)
+
+        for index, clone in enumerate(clones):
+            fanout.StreamReader(member_frames(clone), index, output, stopped[index]).start()
+
+        # frames received before any member produced a token, e.g. the role chunk
+        pending: list[list[AnyStr]] = [[] for _ in clones]
+        running = set(range(len(clones)))
+        winner = None
+        error = None
+        try:
+            while winner is None and running:
+                index, item = output.get()
+                if item is fanout.END or isinstance(item, BaseException):
+                    running.discard(index)
+                    if isinstance(item, BaseException):
+                        logger.warning("Race member %s failed: %s", clones[index].model, item)
+                        self.stats.record_error(clones[index].model)
+                        error = item
+                    elif not running:
+                        # no member produced a token, answer with the last (empty) stream that ended
+                        winner = index
+                    continue
+
+                pending[index].append(item)
+                chunk = fanout.parse_frame(item)
+                if isinstance(chunk, dict) and _has_token(chunk):
+                    winner = index
+
+            if winner is None:
+                raise error or Exception("No member of the race returned a response")
+
+            # commit to the winner, stop reading the other streams
+            for index in range(len(clones)):
+                if index != winner:
+                    stopped[index].set()
+            self._finish(clones[winner], clones, started_at)
+            yield from pending[winner]
+
+            winner_ended = winner not in running
+            while not winner_ended:
+                index, item = output.get()
+                if index != winner:
+                    continue
+                if item is fanout.END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+            completionRequest.usage = clones[winner].usage
+        finally:
+            for event in stopped:
+                event.set()
+            for clone in clones:
+                if clone.deadline is not None:
+                    clone.deadline.cancel()
+
+    def _finish(self, winner: OpenAICompletionRequest, clones: list[OpenAICompletionRequest], started_at: float):
+        elapsed = time.monotonic() - started_at
+        logger.info("Race for %s won by %s after %.0f ms", self.models[0].id, winner.model, elapsed * 1000)
+        self.stats.record_win(winner.model, elapsed)
+        tracing.get_current_span().set_attributes({"race.members": len(clones), "race.winner": winner.model})
+        for clone in clones:
+            if clone is not winner and clone.deadline is not None:
+                clone.deadline.cancel()
@@ -0,0 +1,85 @@
+import importlib
+import json
+import threading
+import time
+from pathlib import Path
+
+from app.models import TargetApiBackend, AvailableModel
+
+# directory with the static model catalogs (data/<backend>_models.json), resolved relative to the project root so the
+# server does not depend on the working directory it was started from
+DATA_DIR = Path(__file__).resolve().parent.parent.parent / "data"
+
+# backend name -> (module, class name); modules are only imported when the backend is first used, so the provider
+# SDKs of unused backends are never loaded
+BACKENDS: dict[str, tuple[str, str]] = {
+    "anthropic": ("app.services.anthropic_service", "AnthropicApiBackend"),
+    "mistral": ("app.services.mistral_service", "MistralApiBackend"),
+    "cohere": ("app.services.cohere_service", "CohereApiBackend"),
+    "openai": ("app.services.openai_service", "OpenAIApiBackend"),
+}
+
+# embedding model id -> backend name, embedding models are not part of the (chat) model catalogs
+EMBEDDING_MODELS: dict[str, str] = {
+    "text-embedding-3-small": "openai",
+    "text-embedding-3-large": "openai",
+    "text-embedding-ada-002": "openai",
+    "mistral-embed": "mistral",
+    "embed-english-v3.0": "cohere",
+    "embed-multilingual-v3.0": "cohere",
+    "embed-english-light-v3.0": "cohere",
+    "embed-multilingual-light-v3.0": "cohere",
+}
+
+_lock = threading.RLock()
+_catalogs: dict[str, list[AvailableModel]] = {}
+_backends: dict[str, TargetApiBackend] = {}
+
+# incremented whenever a catalog is replaced, lets readers cheaply detect that derived data (routing tables, the
+# serialized model list) is stale
+catalog_version = 0
+catalog_updated_at = time.time()
+
+
+def load_models(backend_name: str) -> list[AvailableModel]:
+    """Get the model catalog of a backend, reading data/<backend>_models.json only on first use."""
+
+    models = _catalogs.get(backend_name)
+    if models is not None:
+        return models
+
+    with _lock:
+        if backend_name not in _catalogs:
+            with open(DATA_DIR / f"{backend_name}_models.json") as f:
+                _catalogs[backend_name] = [AvailableModel(**model) for model in json.load(f)]
+        return _catalogs[backend_name]
+
+
+def set_models(backend_name: str, models: list[AvailableModel]):
+    """Replace the model catalog of a backend, e.g. with the live model list fetched from the provider."""
+
+    global catalog_version, catalog_updated_at
+    with _lock:
+        _catalogs[backend_name] = models
+        if backend_name in _backends:
+            _backends[backend_name].models = models
+        catalog_version += 1
+        catalog_updated_at = time.time()
+
+
+def load_backend(backend_name: str) -> TargetApiBackend:
+    """Get the backend instance for a backend name, importing its module (and provider SDK) on first use."""
+
+    backend = _backends.get(backend_name)
+    if backend is not None:
+        return backend
+
+    if backend_name not in BACKENDS:
+        raise ValueError("Unknown backend: " + backend_name)
+
+    with _lock:
+        if backend_name not in _backends:
+            module_name, class_name = BACKENDS[backend_name]
+            backend_class = getattr(importlib.import_module(module_name), class_name)
+            _backends[backend_name] = backend_class()
+        return _backends[backend_name]
@@ -0,0 +1,277 @@
+import copy
+import logging
+import random
+import threading
+import time
+from typing import Iterator, AnyStr, Callable
+
+from app import tracing
+from app.circuit_breaker import CircuitBreaker, CircuitOpenError, get_circuit_breaker, is_backend_failure
+from app.models import TargetApiBackend, AvailableModel, OpenAICompletionRequest, OpenAICompletionResponse
+
+logger = logging.getLogger(__name__)
+
+# the model with the lowest recent latency (time to first token for streams)
+AUTO_FAST = "auto-fast"
+# the cheapest model meeting the latency SLO of the request
+AUTO_CHEAP = "auto-cheap"
+POLICIES = (AUTO_FAST, AUTO_CHEAP)
+
+# weight of the newest call in the rolling averages
+SMOOTHING = 0.2
+# calls needed before the latency of a model is trusted, models with fewer calls are tried optimistically
+MIN_SAMPLES = 3
+# statistics older than this are stale and the model is tried again, so a provider that recovered gets traffic back
+STALE_SECONDS = 300
+# models failing more often than this are only chosen if no other model is healthy
+MAX_ERROR_RATE = 0.2
+# prompt tokens per completion token assumed when comparing prices
+PROMPT_TOKEN_RATIO = 3
+
+
+class ModelStats:
+    """Rolling latency, time to first token and error rate of the calls to a model."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        # exponentially weighted averages in seconds, None until the first successful call
+        self.latency: float | None = None
+        self.ttft: float | None = None
+        self.error_rate = 0.0
+        self.updated_at = 0.0
+
+    def record(self, failed: bool, latency: float | None = None, ttft: float | None = None):
+        """
+        :param latency: Seconds until the whole (non-streamed) response arrived.
+        :param ttft: Seconds until the first chunk of a stream arrived.
+        """
+        with self._lock:
+            if self.updated_at < time.monotonic() - STALE_SECONDS:
+                # start over instead of averaging with outdated calls
+                self.calls = 0
+                self.latency = self.ttft = None
+                self.error_rate = 0.0
+            self.calls += 1
+            self.errors += failed
+            self.error_rate += SMOOTHING * (failed - self.error_rate)
+            if latency is not None:
+                self.latency = latency if self.latency is None else self.latency + SMOOTHING * (latency - self.latency)
+            if ttft is not None:
+                self.ttft = ttft if self.ttft is None else self.ttft + SMOOTHING * (ttft - self.ttft)
+            self.updated_at = time.monotonic()
+
+    def get_latency(self, streamed: bool) -> float | None:
+        """The expected latency of a call, None if the model has too few recent calls to tell."""
+
+        if self.calls < MIN_SAMPLES or self.updated_at < time.monotonic() - STALE_SECONDS:
+            return None
+        first, second = (self.ttft, self.latency) if streamed else (self.latency, self.ttft)
+        return first if first is not None else second
+
+    def is_healthy(self) -> bool:
+        return self.error_rate <= MAX_ERROR_RATE or self.updated_at < time.monotonic() - STALE_SECONDS
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "error_rate": self.error_rate,
+                "avg_latency_ms": self.latency * 1000 if self.latency is not None else None,
+                "avg_ttft_ms": self.ttft * 1000 if self.ttft is not None else None,
+                "seconds_since_update": time.monotonic() - self.updated_at if self.updated_at else None
+            }
+
+
+class SelectorApiBackend(TargetApiBackend):
+    """
+    The virtual models auto-fast and auto-cheap, answering every request with one of several candidate models.
+
+    auto-fast picks the candidate with the lowest recent latency (time to first token for streams), auto-cheap the
+    cheapest candidate whose recent latency meets the latency SLO of the request. Candidates without enough recent calls
+    are tried optimistically and a share of the requests explores the other candidates, so traffic shifts back to
+    providers that recovered. Candidates with an open circuit, a high error rate or without an API key are avoided.
+    """
+
+    name = "selector"
+    virtual = True
+
+    def __init__(self, candidates: list[str], get_member_backend: Callable[[str], TargetApiBackend],
+                 get_member_model: Callable[[str], AvailableModel | None], latency_slo_ms: float = 0,
+                 exploration: float = 0.05):
+        """
+        :param candidates: Models to choose from.
+        :param get_member_backend: Gets the backend serving a candidate model.
+        :param get_member_model: Gets the catalog entry (with the prices) of a candidate model.
+        :param latency_slo_ms: Latency SLO of auto-cheap for requests without latency_slo_ms, 0 for no SLO.
+        :param exploration: Share (0 to 1) of the requests sent to the least recently measured candidate instead.
+        """
+        self.candidates = candidates
+        self.get_member_backend = get_member_backend
+        self.get_member_model = get_member_model
+        self.latency_slo_ms = latency_slo_ms
+        self.exploration = exploration
+        self.stats = {candidate: ModelStats() for candidate in candidates}
+        super().__init__('', '', [AvailableModel(id=policy, object="model", created=0, owned_by="auto")
+                                  for policy in POLICIES])
+
+    def get_model(self, model_id: str) -> AvailableModel | None:
+        model = super().get_model(model_id)
+        if model is None:
+            return None
+
+        # any candidate can be chosen, the smallest context window applies
+        context_windows = [member_model.context_window if member_model is not None else None
+                           for member_model in map(self.get_member_model, self.candidates)]
+        if None not in context_windows:
+            model.context_window = min(context_windows)
+        return model
+
+    def _get_price(self, candidate: str) -> float:
+        model = self.get_member_model(candidate)
+        if model is None or model.prompt_price is None or model.completion_price is None:
+            return float("inf")
+        return model.prompt_price * PROMPT_TOKEN_RATIO + model.completion_price
+
+    def _get_breaker(self, candidate: str) -> CircuitBreaker | None:
+        return get_circuit_breaker(self.get_member_backend(candidate).name, "completions")
+
+    def _get_available(self, pass_api_key: bool) -> list[str]:
+        available = []
+        for candidate in self.candidates:
+            try:
+                backend = self.get_member_backend(candidate)
+            except ValueError:
+                continue
+            if not pass_api_key and not backend.api_key:
+                continue
+            breaker = self._get_breaker(candidate)
+            if breaker is not None and breaker.is_open():
+                continue
+            available.append(candidate)
+        return available
+
+    def select(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool,
+               available: list[str] | None = None) -> str:
+        """
+        Choose the model answering a request to a virtual model.
+
+        :param available: Candidates to choose from, by default the ones with an API key and a closed circuit.
+        """
+        if available is None:
+            available = self._get_available(pass_api_key)
+        if not available:
+            raise Exception(f"No model is available for {completionRequest.model}")
+
+        if len(available) > 1 and random.random() < self.exploration:
+            return min(available, key=lambda candidate: self.stats[candidate].updated_at)
+
+        streamed = bool(completionRequest.streamed)
+        # candidates with an unknown latency are assumed to be fast, so they get measured
+        latencies = {candidate: self.stats[candidate].get_latency(streamed) for candidate in available}
+        healthy = [candidate for candidate in available if self.stats[candidate].is_healthy()] or available
+
+        if completionRequest.model == AUTO_FAST:
+            return min(healthy, key=lambda candidate: (latencies[candidate] or 0, self._get_price(candidate)))
+
+        slo_ms = completionRequest.latency_slo_ms or self.latency_slo_ms
+        by_price = sorted(healthy, key=self._get_price)
+        for candidate in by_price:
+            latency = latencies[candidate]
+            if not slo_ms or latency is None or latency * 1000 <= slo_ms:
+                return candidate
+        # nothing meets the SLO, come as close as possible
+        return min(by_price, key=lambda candidate: latencies[candidate])
+
+    def _clone(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
+            -> tuple[OpenAICompletionRequest, CircuitBreaker | None, bool]:
+        # the call goes through the circuit breaker of the chosen model's backend, pass the breaker and the probe flag
+        # on to _record
+        clone = copy.copy(completionRequest)
+        available = self._get_available(pass_api_key)
+        while True:
+            clone.model = self.select(completionRequest, pass_api_key, available)
+            breaker = self._get_breaker(clone.model)
+            try:
+                probe = breaker.before_call() if breaker is not None else False
+                break
+            except CircuitOpenError:
+                # the probes of a half open circuit are all in flight, choose another model
+                available.remove(clone.model)
+                if not available:
+                    raise
+        logger.debug("Answering %s with %s", completionRequest.model, clone.model)
+        tracing.get_current_span().set_attributes({"auto.policy": completionRequest.model, "auto.model": clone.model})
+        return clone, breaker, probe
+
+    def handle_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
+            -> OpenAICompletionResponse:
+        clone, breaker, probe = self._clone(completionRequest, pass_api_key)
+        stats = self.stats[clone.model]
+
+        started_at = time.monotonic()
+        try:
+            response = self.get_member_backend(clone.model).handle_completion_request(clone, pass_api_key)
+        except Exception as e:
+            failed = is_backend_failure(e)
+            if failed:
+                stats.record(True)
+            if breaker is not None:
+                breaker.after_call(probe, failed)
+            raise
+        latency = time.monotonic() - started_at
+        stats.record(False, latency=latency)
+        if breaker is not None:
+            breaker.after_call(probe, False, latency)
+
+        # report the chosen model, backends that echo the requested model would report the virtual one
+        if response.model in POLICIES or not response.model:
+            response.model = clone.model
+        return response
+
+    def handle_streamed_completion_request(self, completionRequest: OpenAICompletionRequest, pass_api_key: bool) \
+            -> Iterator[AnyStr]:
+        clone, breaker, probe = self._clone(completionRequest, pass_api_key)
+        try:
+            frames = self.get_member_backend(clone.model).handle_streamed_completion_request(clone, pass_api_key)
+        except Exception as e:
+            if breaker is not None:
+                breaker.after_call(probe, is_backend_failure(e))
+            raise
+        return self._measure_stream(frames, completionRequest, clone, breaker, probe)
+
+    def _measure_stream(self, frames: Iterator[AnyStr], completionRequest: OpenAICompletionRequest,
+                        clone: OpenAICompletionRequest, breaker: CircuitBreaker | None, probe: bool) \
+            -> Iterator[AnyStr]:
+        stats = self.stats[clone.model]
+        started_at = time.monotonic()
+        ttft = None
+        # None while the stream runs and if the client abandons it
+        failed = None
+        try:
+            for frame in frames:
+                if ttft is None:
+                    ttft = time.monotonic() - started_at
+                yield frame
+            failed = False
+        except Exception as e:
+            failed = is_backend_failure(e)
+            if failed:
+                stats.record(True)
+            raise
+        finally:
+            if hasattr(frames, "close"):
+                frames.close()
+            completionRequest.usage = clone.usage
+            if breaker is not None:
+                breaker.after_call(probe, failed, ttft)
+        stats.record(False, ttft=ttft)
+
+    def to_dict(self) -> dict:
+        return {
+            "latency_slo_ms": self.latency_slo_ms or None,
+            "candidates": [dict(self.stats[candidate].to_dict(), model=candidate, price=self._get_price(candidate))
+                           for candidate in self.candidates]
+        }
@@ -1,32 +1,47 @@
 from app.models import TargetApiBackend
-from app.services.anthropic_service import AnthropicApiBackend
 from app.services.auto_service import AutoApiBackend
-from app.services.cohere_service import CohereApiBackend
-from app.services.mistral_service import MistralApiBackend
-from app.services.openai_service import OpenAIApiBackend
+from app.services.model_discovery import ModelRefresher
+from app.services.registry import BACKENDS, load_backend
 
 current_target_api: TargetApiBackend | None = None
+current_backend_names: list[str] = []
+model_refresher: ModelRefresher | None = None
 
 
-def init_target_api_backend(target_api: str):
-    """Initialize the target API backend based on the provided configuration."""
+def init_target_api_backend(target_api: str, race_groups: dict[str, list[str]] | None = None,
+                            auto_models: list[str] | None = None, auto_latency_slo_ms: float = 0,
+                            auto_exploration: float = 0.05):
+    """
+    Initialize the target API backend based on the provided configuration.
 
-    global current_target_api
-    if target_api == "anthropic":
-        current_target_api = AnthropicApiBackend()
-    elif target_api == "mistral":
-        current_target_api = MistralApiBackend()
-    elif target_api == "cohere":
-        current_target_api = CohereApiBackend()
-    elif target_api == "openai":
-        current_target_api = OpenAIApiBackend()
+    :param race_groups: Virtual models racing several models against each other, only available when routing
+        between all backends.
+    :param auto_models: Models the virtual auto-fast and auto-cheap models choose from, only available when routing
+        between all backends.
+    :param auto_latency_slo_ms: Default latency SLO of auto-cheap in milliseconds, 0 for none.
+    :param auto_exploration: Share of the auto-fast and auto-cheap requests sent to the least recently measured model.
+    """
+
+    global current_target_api, current_backend_names
+    if target_api in BACKENDS:
+        current_backend_names = [target_api]
+        current_target_api = load_backend(target_api)
     else:
-        current_target_api = AutoApiBackend(supported_backends=[
-            AnthropicApiBackend(),
-            MistralApiBackend(),
-            CohereApiBackend(),
-            OpenAIApiBackend()
-        ])
+        current_backend_names = ["anthropic", "mistral", "cohere", "openai"]
+        current_target_api = AutoApiBackend(supported_backends=current_backend_names, race_groups=race_groups,
+                                            auto_models=auto_models, auto_latency_slo_ms=auto_latency_slo_ms,
+                                            auto_exploration=auto_exploration)
+
+
+def init_model_refresher(interval: float):
+    """Start refreshing the model catalogs of the current backends from the providers every `interval` seconds."""
+
+    global model_refresher
+    if model_refresher is not None:
+        model_refresher.stop()
+
+    model_refresher = ModelRefresher(current_backend_names, interval)
+    model_refresher.start()
 
 
 def get_current_target_api_backend() -> TargetApiBackend:
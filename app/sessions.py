@@ -0,0 +1,194 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, Callable
+
+from app.models import ConversionCache
+from app.rate_limits import hash_client_key
+
+# approximate bytes used by a session besides its messages
+SESSION_OVERHEAD = 1000
+
+
+class ChatSession:
+    """A conversation whose history is kept by the server, clients only send the new messages of each turn."""
+
+    def __init__(self, session_id: str, key_hash: bytes, params: dict):
+        """
+        :param key_hash: Hash of the API key that created the session, only requests with the same key may use it.
+        :param params: Fields of the completion requests of the session (model, max_tokens, tools, ...), the requests
+            of a turn can override them.
+        """
+        self.id = session_id
+        self.key_hash = key_hash
+        self.params = params
+        self.messages: list[dict] = []
+        # the history converted to the formats of the backends, reused by the next turn
+        self.conversions = ConversionCache()
+        self.created = int(time.time())
+        self.size = SESSION_OVERHEAD + len(json.dumps(params))
+        self.last_used_at = time.monotonic()
+        # held while a turn runs, turns of a session are answered one at a time
+        self.turn_lock = threading.Lock()
+
+    def to_dict(self, include_messages: bool = False) -> dict:
+        session = {
+            "id": self.id,
+            "object": "chat.session",
+            "created": self.created,
+            "model": self.params.get("model"),
+            "message_count": len(self.messages)
+        }
+        if include_messages:
+            session["messages"] = self.messages
+        return session
+
+
+class SessionStore:
+    """
+    Chat sessions of the process, dropped after `ttl` idle seconds or, least recently used first, when their histories
+    exceed the memory budget.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int):
+        """
+        :param ttl: Seconds a session is kept after its last use.
+        :param max_bytes: Memory budget of the histories.
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self._lock = threading.Lock()
+        # sessions in least recently used order
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, api_key: str | None, params: dict, messages: list[dict]) -> ChatSession:
+        """
+        Start a session.
+
+        :param params: Fields of the completion requests of the session.
+        :param messages: Messages the history starts with, e.g. the system prompt.
+        """
+        session = ChatSession("sess_" + secrets.token_urlsafe(18), hash_client_key(api_key or ""), params)
+        with self._lock:
+            self._expire()
+            self._sessions[session.id] = session
+            self.size += session.size
+        self.append(session, messages)
+        return session
+
+    def get(self, api_key: str | None, session_id: str) -> ChatSession | None:
+        """Get a session of an API key, None if it does not exist, expired or belongs to another key."""
+
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is None or session.key_hash != hash_client_key(api_key or ""):
+                return None
+            session.last_used_at = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, api_key: str | None, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.key_hash != hash_client_key(api_key or ""):
+                return False
+            self._remove(session)
+            return True
+
+    def append(self, session: ChatSession, messages: list[dict]):
+        """Add the messages of a completed turn to the history of a session."""
+
+        size = sum(len(json.dumps(message)) for message in messages)
+        with self._lock:
+            if self._sessions.get(session.id) is not session:
+                # deleted or evicted while the turn ran
+                return
+            # a new list, so requests still holding the old history are not affected
+            session.messages = session.messages + messages
+            session.size += size
+            session.last_used_at = time.monotonic()
+            self._sessions.move_to_end(session.id)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._sessions.values())))
+
+    def _expire(self):
+        expired_at = time.monotonic() - self.ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_used_at > expired_at:
+                break
+            self._remove(session)
+
+    def _remove(self, session: ChatSession):
+        del self._sessions[session.id]
+        self.size -= session.size
+
+
+def collect_reply(body: Iterator[bytes], on_done: Callable[[dict | None], None]) -> Iterator[bytes]:
+    """
+    Pass the body of a streamed completion through and assemble the assistant message of its first choice.
+
+    :param body: The SSE body of the response.
+    :param on_done: Called with the assistant message once the stream has been sent completely, or with None if it
+        failed or the client went away.
+    """
+    content = []
+    tool_calls: dict[int, dict] = {}
+    pending = b""
+    message = None
+    try:
+        for data in body:
+            yield data
+            pending += data
+            events = pending.split(b"\n\n")
+            pending = events.pop()
+            for event in events:
+                if not event.startswith(b"data:") or event[5:].strip() == b"[DONE]":
+                    continue
+                for choice in json.loads(event[5:]).get("choices") or []:
+                    if choice.get("index", 0) != 0:
+                        continue
+                    delta = choice.get("delta") or {}
+                    if delta.get("content"):
+                        content.append(delta["content"])
+                    for tool_call in delta.get("tool_calls") or []:
+                        call = tool_calls.setdefault(tool_call.get("index", 0),
+                                                     {"id": None, "type": "function",
+                                                      "function": {"name": "", "arguments": ""}})
+                        call["id"] = tool_call.get("id") or call["id"]
+                        function = tool_call.get("function") or {}
+                        call["function"]["name"] += function.get("name") or ""
+                        call["function"]["arguments"] += function.get("arguments") or ""
+
+        message = {"role": "assistant", "content": "".join(content) if content else None}
+        if tool_calls:
+            message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+        on_done(message)
+
+
+session_store: SessionStore | None = None
+
+
+def init_session_store(ttl: float, max_bytes: int):
+    """Keep chat sessions for `ttl` idle seconds. A ttl of 0 disables sessions."""
+
+    global session_store
+    session_store = SessionStore(ttl, max_bytes) if ttl > 0 else None
+
+
+def get_session_store() -> SessionStore | None:
+    """Get the session store, None if chat sessions are disabled."""
+
+    return session_store
@@ -0,0 +1,207 @@
+import json
+import queue
+import threading
+import time
+from typing import Iterator, AnyStr
+
+from flask import Response
+
+# SSE comment sent while the upstream is silent, ignored by clients but keeps idle connections open
+HEARTBEAT_FRAME = b": keep-alive\n\n"
+
+_END = object()
+
+
+class _Pump(threading.Thread):
+    """Reads the frames of an upstream stream on a background thread, so the response can flush and heartbeat on
+    its own schedule while the upstream is silent."""
+
+    def __init__(self, frames: Iterator[AnyStr]):
+        super().__init__(name="sse-pump", daemon=True)
+        self.frames = frames
+        self.queue: queue.Queue = queue.Queue(maxsize=256)
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                if not self._put(frame):
+                    break
+            else:
+                self._put(_END)
+        except BaseException as e:
+            self._put(e)
+        finally:
+            # closes the upstream stream early if the client went away
+            if hasattr(self.frames, "close"):
+                self.frames.close()
+
+    def _put(self, item) -> bool:
+        # bounded queue: a slow client slows the upstream read down instead of buffering the whole completion
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+class _Coalescer:
+    """Merges consecutive text deltas of the same choice into a single chunk frame."""
+
+    def __init__(self):
+        self.frames: list[bytes] = []
+        # chunk whose delta is still being extended, serialized when flushed
+        self.pending_chunk: dict | None = None
+        self.pending_content: list[str] = []
+
+    def __bool__(self):
+        return bool(self.frames) or self.pending_chunk is not None
+
+    def add(self, frame: AnyStr):
+        if isinstance(frame, str):
+            frame = frame.encode()
+
+        chunk = _parse_text_delta_chunk(frame)
+        if chunk is None:
+            self._close_pending()
+            self.frames.append(frame)
+            return
+
+        delta = chunk["choices"][0]["delta"]
+        pending = self.pending_chunk
+        if pending is not None and pending["id"] == chunk["id"] and \
+                pending["choices"][0]["index"] == chunk["choices"][0]["index"] and \
+                delta.get("role", pending["choices"][0]["delta"].get("role")) == \
+                pending["choices"][0]["delta"].get("role"):
+            self.pending_content.append(delta.get("content") or "")
+            return
+
+        self._close_pending()
+        self.pending_chunk = chunk
+        self.pending_content = [delta.get("content") or ""]
+
+    def flush(self) -> bytes:
+        self._close_pending()
+        data = b"".join(self.frames)
+        self.frames = []
+        return data
+
+    def _close_pending(self):
+        if self.pending_chunk is None:
+            return
+
+        self.pending_chunk["choices"][0]["delta"]["content"] = "".join(self.pending_content)
+        self.frames.append(b"data:" + json.dumps(self.pending_chunk).encode() + b"\n\n")
+        self.pending_chunk = None
+        self.pending_content = []
+
+
+def _parse_text_delta_chunk(frame: bytes) -> dict | None:
+    # only single choice chunks carrying nothing but text (and the role) can be merged
+    if not frame.startswith(b"data:") or frame.count(b"\n\n") != 1 or b"[DONE]" in frame:
+        return None
+    try:
+        chunk = json.loads(frame[5:])
+    except ValueError:
+        return None
+
+    if not isinstance(chunk, dict) or "id" not in chunk or chunk.keys() - \
+            {"id", "object", "created", "model", "system_fingerprint", "choices"}:
+        return None
+    choices = chunk.get("choices")
+    if not isinstance(choices, list) or len(choices) != 1 or choices[0].get("finish_reason") is not None or \
+            choices[0].keys() - {"index", "delta", "finish_reason", "logprobs"} or choices[0].get("logprobs"):
+        return None
+    delta = choices[0].get("delta")
+    if not isinstance(delta, dict) or delta.keys() - {"role", "content"} or \
+            not isinstance(delta.get("content") or "", str):
+        return None
+    return chunk
+
+
+def _encode(frames: Iterator[AnyStr]) -> Iterator[bytes]:
+    try:
+        for frame in frames:
+            yield frame.encode() if isinstance(frame, str) else frame
+    finally:
+        if hasattr(frames, "close"):
+            frames.close()
+
+
+def _buffered(frames: Iterator[AnyStr], flush_window: float, heartbeat_interval: float) -> Iterator[bytes]:
+    pump = _Pump(frames)
+    pump.start()
+
+    coalescer = _Coalescer()
+    # time the oldest frame in the coalescer was received and the time of the last write to the client
+    first_pending_at = None
+    last_write_at = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            timeouts = []
+            if first_pending_at is not None:
+                timeouts.append(first_pending_at + flush_window - now)
+            if heartbeat_interval > 0:
+                timeouts.append(last_write_at + heartbeat_interval - now)
+
+            try:
+                item = pump.queue.get(timeout=max(min(timeouts), 0) if timeouts else None)
+            except queue.Empty:
+                if coalescer:
+                    yield coalescer.flush()
+                    first_pending_at = None
+                else:
+                    yield HEARTBEAT_FRAME
+                last_write_at = time.monotonic()
+                continue
+
+            if item is _END:
+                if coalescer:
+                    yield coalescer.flush()
+                return
+            if isinstance(item, BaseException):
+                if coalescer:
+                    yield coalescer.flush()
+                raise item
+
+            if flush_window <= 0:
+                yield item.encode() if isinstance(item, str) else item
+                last_write_at = time.monotonic()
+                continue
+
+            coalescer.add(item)
+            if first_pending_at is None:
+                first_pending_at = time.monotonic()
+            if time.monotonic() - first_pending_at >= flush_window:
+                yield coalescer.flush()
+                first_pending_at = None
+                last_write_at = time.monotonic()
+    finally:
+        pump.stopped.set()
+
+
+def event_stream_response(frames: Iterator[AnyStr], flush_window_ms: float = 0,
+                          heartbeat_interval: float = 0) -> Response:
+    """
+    Create a server-sent events response from a stream of SSE frames.
+
+    :param frames: SSE frames produced by a backend, each a complete "data: ...\\n\\n" event.
+    :param flush_window_ms: If positive, text deltas received within this many milliseconds are merged into a single
+        chunk and all frames of the window are written to the client at once.
+    :param heartbeat_interval: If positive, an SSE comment is sent after this many seconds without any other frame,
+        so proxies and load balancers do not close the idle connection.
+    :return: The streamed response.
+    """
+    if flush_window_ms > 0 or heartbeat_interval > 0:
+        body = _buffered(frames, flush_window_ms / 1000, heartbeat_interval)
+    else:
+        body = _encode(frames)
+
+    return Response(body, mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # disable response buffering in nginx style reverse proxies
+        "X-Accel-Buffering": "no",
+    })
@@ -0,0 +1,150 @@
+import json
+import threading
+
+# starting points for the number of characters (UTF-8 bytes) per token of each provider's tokenizer, refined at
+# runtime from the prompt token counts the providers report
+DEFAULT_CHARS_PER_TOKEN = {
+    "openai": 4.0,
+    "anthropic": 3.5,
+    "mistral": 3.5,
+    "cohere": 4.0,
+}
+FALLBACK_CHARS_PER_TOKEN = 3.5
+
+# tokens added per message for the role and separators, and per image part
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 1000
+
+# relative error of an estimate, requests are only rejected if they exceed the context window by more than this
+ESTIMATE_TOLERANCE = 0.1
+
+# weight of a new observation in the running calibration
+CALIBRATION_WEIGHT = 0.05
+
+
+class PromptEstimate:
+    """Estimated size of a prompt."""
+
+    def __init__(self, chars: int, messages: int, images: int, tokens: int):
+        self.chars = chars
+        self.messages = messages
+        self.images = images
+        self.tokens = tokens
+
+
+class TokenEstimator:
+    """Fast local prompt token estimator, calibrated per provider from the actual token counts."""
+
+    def __init__(self):
+        self.chars_per_token = dict(DEFAULT_CHARS_PER_TOKEN)
+        self._lock = threading.Lock()
+
+    def estimate(self, provider: str, messages, tools=None) -> PromptEstimate:
+        """
+        Estimate the prompt tokens of a request.
+
+        :param provider: Name of the backend the request is sent to.
+        :param messages: OpenAI format messages.
+        :param tools: OpenAI format tools.
+        """
+        chars = _text_size(json.dumps(tools)) if tools else 0
+        images = 0
+        for message in messages:
+            message_chars, message_images = _message_size(message)
+            chars += message_chars
+            images += message_images
+        return self._estimate(provider, chars, len(messages), images)
+
+    def _estimate(self, provider: str, chars: int, messages: int, images: int) -> PromptEstimate:
+        tokens = chars / self.chars_per_token.get(provider, FALLBACK_CHARS_PER_TOKEN) + \
+            messages * MESSAGE_OVERHEAD_TOKENS + images * IMAGE_TOKENS
+        return PromptEstimate(chars=chars, messages=messages, images=images, tokens=int(tokens) + 1)
+
+    def trim(self, provider: str, messages: list, tools, max_tokens: int) -> list | None:
+        """
+        Drop the oldest non-system turns until the estimated prompt fits.
+
+        An assistant message with tool calls and the tool results answering it are dropped together, the last turn is
+        always kept.
+
+        :param provider: Name of the backend the request is sent to.
+        :param messages: OpenAI format messages.
+        :param tools: OpenAI format tools.
+        :param max_tokens: Maximum estimated prompt tokens.
+        :return: The trimmed messages or None if the prompt does not fit even with only the last turn.
+        """
+        system_messages = [message for message in messages if message["role"] == "system"]
+
+        # group the other messages into turns that can only be dropped as a whole
+        turns = []
+        for message in messages:
+            if message["role"] == "system":
+                continue
+            if message["role"] in ("tool", "function") and turns:
+                turns[-1].append(message)
+            else:
+                turns.append([message])
+
+        # size every message once, dropping a turn then only subtracts its size
+        chars = _text_size(json.dumps(tools)) if tools else 0
+        images = 0
+        for message in system_messages:
+            message_chars, message_images = _message_size(message)
+            chars += message_chars
+            images += message_images
+        turn_sizes = []
+        for turn in turns:
+            sizes = [_message_size(message) for message in turn]
+            turn_size = (sum(x[0] for x in sizes), sum(x[1] for x in sizes))
+            turn_sizes.append(turn_size)
+            chars += turn_size[0]
+            images += turn_size[1]
+        message_count = len(messages)
+
+        for start, turn in enumerate(turns):
+            # a conversation cannot start with the model's answer
+            skip = start > 0 and turn[0]["role"] == "assistant" and start < len(turns) - 1
+            if not skip and self._estimate(provider, chars, message_count, images).tokens <= max_tokens:
+                return system_messages + [message for remaining in turns[start:] for message in remaining]
+
+            chars -= turn_sizes[start][0]
+            images -= turn_sizes[start][1]
+            message_count -= len(turn)
+        return None
+
+    def calibrate(self, provider: str, estimate: PromptEstimate, prompt_tokens: int):
+        """Refine the provider's characters per token from the prompt tokens it reported for an estimated prompt."""
+
+        text_tokens = prompt_tokens - estimate.messages * MESSAGE_OVERHEAD_TOKENS - estimate.images * IMAGE_TOKENS
+        # short prompts are dominated by the overhead and would skew the calibration
+        if estimate.chars < 200 or text_tokens <= 0:
+            return
+
+        observed = min(max(estimate.chars / text_tokens, 1.0), 8.0)
+        with self._lock:
+            current = self.chars_per_token.get(provider, FALLBACK_CHARS_PER_TOKEN)
+            self.chars_per_token[provider] = current + (observed - current) * CALIBRATION_WEIGHT
+
+
+def _message_size(message: dict) -> tuple[int, int]:
+    # (characters, images) of a message
+    content = message.get("content")
+    chars = _text_size(content)
+    images = sum(1 for part in content if part.get("type") == "image_url") if isinstance(content, list) else 0
+    for tool_call in message.get("tool_calls") or []:
+        chars += _text_size(tool_call["function"]["name"]) + _text_size(tool_call["function"]["arguments"])
+    return chars, images
+
+
+def _text_size(content) -> int:
+    if content is None:
+        return 0
+    if isinstance(content, list):
+        return sum(_text_size(part.get("text")) for part in content if part.get("type") == "text")
+    if not isinstance(content, str):
+        content = str(content)
+    # UTF-8 size, non-latin scripts have far fewer characters per token
+    return len(content) if content.isascii() else len(content.encode())
+
+
+token_estimator = TokenEstimator()
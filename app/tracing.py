@@ -0,0 +1,491 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from typing import Iterator, Callable, TypeVar, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SERVICE_NAME = "llm-converter"
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Span:
+    """A timed operation of a trace, exported when it ends. Spans are context managers making them the current span."""
+
+    recording = True
+
+    def __init__(self, tracer: 'Tracer', name: str, trace_id: str, parent_id: str | None, kind: int = KIND_INTERNAL,
+                 attributes: dict | None = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes) if attributes else {}
+        self.events: list[tuple[str, int, dict | None]] = []
+        self.error: str | None = None
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self._token: contextvars.Token | None = None
+
+    def __enter__(self) -> 'Span':
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_span.reset(self._token)
+        if exc_value is not None and not isinstance(exc_value, GeneratorExit):
+            self.set_error(repr(exc_value))
+        self.end()
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes: dict):
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, attributes: dict | None = None, timestamp_ns: int | None = None):
+        self.events.append((name, timestamp_ns if timestamp_ns is not None else time.time_ns(), attributes))
+
+    def set_error(self, message: str):
+        self.error = message
+
+    def end(self):
+        """End the span and queue it for export, later calls are ignored."""
+
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer.processor.on_end(self)
+
+    def get_traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _to_otlp_attributes(self.attributes),
+            "status": {"code": 2, "message": self.error} if self.error is not None else {"code": 1}
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [{"name": name, "timeUnixNano": str(timestamp_ns),
+                               "attributes": _to_otlp_attributes(attributes or {})}
+                              for name, timestamp_ns, attributes in self.events]
+        return span
+
+
+class _NonRecordingSpan:
+    """Stands in for the spans of requests that are not traced, every method does nothing."""
+
+    recording = False
+
+    def __init__(self, trace_id: str | None = None, parent_id: str | None = None):
+        """
+        :param trace_id: Trace of the client an unsampled request continues, still passed on to the upstreams.
+        :param parent_id: Span id of the client, the parent of the upstream requests as this request records none.
+        """
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+
+    def __enter__(self) -> '_NonRecordingSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def set_attributes(self, attributes: dict):
+        pass
+
+    def add_event(self, name: str, attributes: dict | None = None, timestamp_ns: int | None = None):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+    def end(self):
+        pass
+
+    def get_traceparent(self) -> str | None:
+        if self.trace_id is None:
+            return None
+        # the sampled flag is cleared, the upstreams do not record their part of the trace either
+        return f"00-{self.trace_id}-{self.parent_id}-00"
+
+
+NON_RECORDING_SPAN = _NonRecordingSpan()
+
+_current_span: contextvars.ContextVar[Span | _NonRecordingSpan | None] = \
+    contextvars.ContextVar("current_span", default=None)
+
+
+def _to_otlp_attributes(attributes: dict) -> list[dict]:
+    result = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            # 64 bit integers are strings in OTLP/JSON
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        result.append({"key": key, "value": otlp_value})
+    return result
+
+
+def parse_traceparent(header: str | None) -> tuple[str, str, bool] | None:
+    """
+    Parse a W3C traceparent header.
+
+    :return: The trace id, parent span id and sampled flag, None if the header is missing or invalid.
+    """
+    if not header:
+        return None
+    match = _TRACEPARENT.match(header.strip().lower())
+    if match is None:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    if trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+class FileSpanExporter:
+    """Appends batches of spans to a local file as OTLP/JSON lines, rotating it when it grows too large."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        """
+        :param path: Path of the file, rotated files get the suffixes .1 (newest) to .`backups`.
+        :param max_bytes: Size the file is rotated at, 0 to never rotate.
+        :param backups: Number of rotated files kept.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def export(self, payload: bytes):
+        if self.max_bytes and os.path.exists(self.path) and \
+                os.path.getsize(self.path) + len(payload) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(payload + b"\n")
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, self.path + ".1")
+
+
+class CollectorSpanExporter:
+    """Sends batches of spans to an OpenTelemetry collector with OTLP/HTTP in the JSON encoding."""
+
+    def __init__(self, url: str, timeout: float = 10):
+        """
+        :param url: The traces endpoint of the collector, e.g. http://localhost:4318/v1/traces.
+        """
+        import httpx
+
+        self.url = url
+        # a client of its own, span exports are not upstream requests and are never traced themselves
+        self.client = httpx.Client(timeout=timeout)
+
+    def export(self, payload: bytes):
+        response = self.client.post(self.url, content=payload, headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+
+
+class BatchSpanProcessor:
+    """
+    Collects ended spans on an in-memory queue and exports them in batches from a background thread, so tracing never
+    blocks the request path.
+    """
+
+    def __init__(self, exporter: FileSpanExporter | CollectorSpanExporter, batch_size: int = 512,
+                 flush_interval: float = 5.0, max_queue_size: int = 20000):
+        """
+        :param batch_size: Maximum number of spans exported at once.
+        :param flush_interval: Maximum seconds a span waits in the queue before it is exported.
+        :param max_queue_size: Spans beyond this many pending ones are dropped instead of growing memory.
+        """
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue[Span | None] = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+
+        self._exporter_thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._exporter_thread.start()
+
+    def on_end(self, span: Span):
+        """Queue a span for export, never blocks."""
+
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Export all queued spans and stop the exporter thread."""
+
+        self.queue.put(None)
+        self._exporter_thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # collect more spans until the batch is full, the oldest span waited long enough or the processor closes
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [span for span in batch if span is not None]
+                # the close marker may have overtaken spans queued concurrently
+                while not self.queue.empty():
+                    span = self.queue.get_nowait()
+                    if span is not None:
+                        batch.append(span)
+            if not batch:
+                continue
+
+            try:
+                self.exporter.export(encode_spans(batch))
+            except Exception:
+                logger.exception("Failed to export %d spans", len(batch))
+
+
+def encode_spans(spans: list[Span]) -> bytes:
+    """Encode spans as an OTLP/JSON ExportTraceServiceRequest."""
+
+    return json.dumps({
+        "resourceSpans": [{
+            "resource": {"attributes": _to_otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [span.to_otlp() for span in spans]
+            }]
+        }]
+    }, separators=(",", ":")).encode()
+
+
+class Tracer:
+    """Starts the spans of sampled requests."""
+
+    def __init__(self, processor: BatchSpanProcessor, sample_rate: float):
+        """
+        :param sample_rate: Share (0 to 1) of the requests traced, requests continuing a sampled trace of the client
+            are always traced.
+        """
+        self.processor = processor
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name: str, traceparent: str | None, attributes: dict | None = None) \
+            -> Span | _NonRecordingSpan:
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = "%032x" % random.getrandbits(128), None
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return _NonRecordingSpan(trace_id, parent_id) if parent is not None else NON_RECORDING_SPAN
+        return Span(self, name, trace_id, parent_id, KIND_SERVER, attributes)
+
+
+tracer: Tracer | None = None
+
+
+def init_tracing(export: str | None, sample_rate: float, file_max_bytes: int, file_backups: int):
+    """
+    Start exporting the spans of sampled requests.
+
+    :param export: Path of the OTLP/JSON file or the http(s) URL of the collector, None to disable tracing.
+    """
+    global tracer
+    if tracer is not None:
+        tracer.processor.close()
+    if not export:
+        tracer = None
+        return
+
+    if export.startswith(("http://", "https://")):
+        exporter = CollectorSpanExporter(export)
+    else:
+        exporter = FileSpanExporter(export, file_max_bytes, file_backups)
+    tracer = Tracer(BatchSpanProcessor(exporter), sample_rate)
+
+
+def get_tracer() -> Tracer | None:
+    """Get the tracer, None if tracing is disabled."""
+
+    return tracer
+
+
+def start_trace(name: str, traceparent: str | None = None, attributes: dict | None = None) \
+        -> Span | _NonRecordingSpan:
+    """
+    Start the root span of a request, continuing the trace of the client if it sent a traceparent header.
+
+    :return: A span doing nothing if tracing is disabled or the request is not sampled, an unsampled trace of the
+        client is still passed on to the upstreams.
+    """
+    if tracer is None:
+        return NON_RECORDING_SPAN
+    return tracer.start_trace(name, traceparent, attributes)
+
+
+def start_span(name: str, attributes: dict | None = None, kind: int = KIND_INTERNAL) -> Span | _NonRecordingSpan:
+    """Start a child of the current span, a span doing nothing if the current request is not traced."""
+
+    parent = _current_span.get()
+    if parent is None or not parent.recording:
+        return NON_RECORDING_SPAN
+    return Span(parent.tracer, name, parent.trace_id, parent.span_id, kind, attributes)
+
+
+def get_current_span() -> Span | _NonRecordingSpan:
+    return _current_span.get() or NON_RECORDING_SPAN
+
+
+def use_span(span: Span | _NonRecordingSpan):
+    """Make a span the current span within a with block, without ending it."""
+
+    # an unsampled span of a client trace is made current too, for the traceparent of the upstream requests
+    return _Activation(None if span is NON_RECORDING_SPAN else span)
+
+
+class _Activation:
+    def __init__(self, span: Span | _NonRecordingSpan | None):
+        self.span = span
+        self._token: contextvars.Token | None = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_span.reset(self._token)
+
+
+def traced(name: str, kind: int = KIND_INTERNAL) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Decorate a function to run in a child span of the current span, if the current request is traced."""
+
+    def decorator(function: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) -> T:
+            if not get_current_span().recording:
+                return function(*args, **kwargs)
+            with start_span(name, kind=kind):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(function: Callable[..., T]) -> Callable[..., T]:
+    """Bind a function to the current span, for running it on another thread (e.g. an executor)."""
+
+    span = _current_span.get()
+    if span is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs) -> T:
+        with use_span(span):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def bind(frames: Iterator[T]) -> Iterator[T]:
+    """Bind the iteration of a stream to the current span, for reading it on another thread (e.g. the SSE pump)."""
+
+    span = _current_span.get()
+    if span is None:
+        return frames
+    return _bound(frames, span)
+
+
+def _bound(frames: Iterator[T], span: Span | _NonRecordingSpan) -> Iterator[T]:
+    iterator = iter(frames)
+    try:
+        while True:
+            with use_span(span):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        if hasattr(frames, "close"):
+            with use_span(span):
+                frames.close()
+
+
+def add_trace_headers(headers: dict | None) -> dict | None:
+    """Add the traceparent header of the current span to the headers of an upstream request."""
+
+    traceparent = get_current_span().get_traceparent()
+    if traceparent is None:
+        return headers
+    return dict(headers or {}, traceparent=traceparent)
+
+
+def _inject_traceparent(request: 'httpx.Request'):
+    traceparent = get_current_span().get_traceparent()
+    if traceparent is not None:
+        request.headers["traceparent"] = traceparent
+
+
+def instrument_client(client: 'httpx.Client'):
+    """Send the traceparent header of the current span with every request of an httpx client."""
+
+    if tracer is None:
+        return
+    if _inject_traceparent not in client.event_hooks["request"]:
+        client.event_hooks["request"] = client.event_hooks["request"] + [_inject_traceparent]
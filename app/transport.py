@@ -0,0 +1,263 @@
+import asyncio
+import socket
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator
+
+from app import tracing
+from app.deadline import Deadline, abort_on_cancel
+
+if TYPE_CHECKING:
+    import httpx
+
+# whether the raw upstream requests use HTTP/2 and the connection limit per origin, set from the app config by
+# init_transport
+use_http2 = False
+max_connections = 100
+# seconds to wait for a connection and for data, for the requests sent without a deadline (the provider SDKs and the
+# model refreshes), None for no limit
+connect_timeout: float | None = 10
+read_timeout: float | None = 300
+
+_lock = threading.Lock()
+_clients: dict[tuple[str, str, int], 'httpx.Client'] = {}
+_http2_clients: dict[tuple[str, str, int], 'httpx.AsyncClient'] = {}
+_http2_loop: asyncio.AbstractEventLoop | None = None
+
+
+def init_transport(http2: bool, connections: int = 100, connect: float | None = 10, read: float | None = 300):
+    """
+    Configure the upstream transport.
+
+    :param http2: Whether to send the raw upstream requests (post and stream) over HTTP/2, so concurrent requests and
+        streams to the same provider are multiplexed over a few connections. Requires the h2 package. Cleartext
+        (http://) upstreams are spoken to with HTTP/2 prior knowledge, https upstreams negotiate the protocol with ALPN.
+    :param connections: Maximum number of connections per upstream origin, all of them are kept alive for reuse.
+    :param connect: Default seconds to wait for a connection, None or 0 for no limit.
+    :param read: Default seconds to wait for the upstream to send data, None or 0 for no limit.
+    """
+    global use_http2, max_connections, connect_timeout, read_timeout
+
+    if http2:
+        # fail at startup instead of on the first request if the optional dependency is missing
+        import h2  # noqa: F401
+
+    with _lock:
+        use_http2 = http2
+        max_connections = connections
+        connect_timeout = connect or None
+        read_timeout = read or None
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        for async_client in _http2_clients.values():
+            asyncio.run_coroutine_threadsafe(async_client.aclose(), _http2_loop)
+        _http2_clients.clear()
+
+
+def _get_origin(url: str) -> tuple[str, str, int]:
+    # imported on first use, httpx is slow to import and only needed once a request is sent upstream
+    import httpx
+
+    parsed_url = httpx.URL(url)
+    return parsed_url.scheme, parsed_url.host, parsed_url.port or 0
+
+
+def _get_default_timeout() -> 'httpx.Timeout':
+    import httpx
+
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+
+def get_http_client(url: str) -> 'httpx.Client':
+    """
+    Get the shared HTTP/1.1 client for the origin of a URL, also used by the provider SDKs.
+
+    Connections are pooled per origin and reused across requests.
+    """
+    import httpx
+
+    key = _get_origin(url)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        if key not in _clients:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            # requests with a deadline override the timeout, the SDKs use the one of the client
+            _clients[key] = httpx.Client(limits=limits, timeout=_get_default_timeout())
+            # the provider SDKs share the client, their requests carry the traceparent header as well
+            tracing.instrument_client(_clients[key])
+        return _clients[key]
+
+
+def _get_http2_client(url: str) -> 'httpx.AsyncClient':
+    # the synchronous httpx HTTP/2 implementation is not safe to share between threads (concurrent requests can open
+    # streams out of order), so HTTP/2 requests are multiplexed by an async client on a dedicated event loop thread
+    import httpx
+
+    global _http2_loop
+
+    key = _get_origin(url)
+    client = _http2_clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        if _http2_loop is None:
+            _http2_loop = asyncio.new_event_loop()
+            threading.Thread(target=_http2_loop.run_forever, name="upstream-http2", daemon=True).start()
+
+        if key not in _http2_clients:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            _http2_clients[key] = httpx.AsyncClient(http1=key[0] == "https", http2=True, limits=limits,
+                                                       timeout=_get_default_timeout())
+        return _http2_clients[key]
+
+
+def _run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, _http2_loop).result()
+
+
+class _Http2StreamedResponse:
+    """Synchronous view of a streamed HTTP/2 response received on the transport's event loop."""
+
+    def __init__(self, response: 'httpx.Response'):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.http_version = response.http_version
+        # read in progress on the event loop, cancelled to abort the stream
+        self._pending = None
+        self._aborted = False
+
+    def iter_bytes(self) -> Iterator[bytes]:
+        return self._iterate(self._response.aiter_bytes())
+
+    def iter_lines(self) -> Iterator[str]:
+        # split the lines on this side, every chunk handed over from the event loop thread costs a context switch
+        pending = ""
+        for chunk in self._iterate(self._response.aiter_text()):
+            lines = (pending + chunk).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line.removesuffix("\r")
+        if pending:
+            yield pending
+
+    def read(self) -> bytes:
+        return _run(self._response.aread())
+
+    def close(self):
+        _run(self._response.aclose())
+
+    def abort(self):
+        """Stop reading the stream from another thread, the other streams of the connection are not affected."""
+
+        self._aborted = True
+        if self._pending is not None:
+            self._pending.cancel()
+
+    def _iterate(self, async_iterator) -> Iterator:
+        while not self._aborted:
+            self._pending = asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), _http2_loop)
+            try:
+                yield self._pending.result()
+            except StopAsyncIteration:
+                return
+            finally:
+                self._pending = None
+
+
+def abort_response(response):
+    """
+    Abort reading a streamed response from another thread, e.g. when the client went away while the reading thread
+    waits for the upstream.
+    """
+    if isinstance(response, _Http2StreamedResponse):
+        response.abort()
+        return
+
+    # closing the socket does not wake up a blocked read, shutting it down does, the connection is discarded
+    network_stream = response.extensions.get("network_stream")
+    upstream_socket = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if upstream_socket is not None:
+        try:
+            upstream_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+@contextmanager
+def abort_responses_on_cancel(client: 'httpx.Client', deadline: Deadline | None):
+    """
+    Abort the responses an HTTP client receives in the block when the request is cancelled, for the SDKs that read a
+    stream without exposing its response. The client must only be used by this request.
+    """
+    if deadline is None:
+        yield
+        return
+
+    responses = []
+
+    def on_response(response: 'httpx.Response'):
+        responses.append(response)
+        # the request was cancelled while waiting for the response
+        if deadline.cancelled:
+            abort_response(response)
+
+    def abort():
+        for response in list(responses):
+            abort_response(response)
+
+    client.event_hooks["response"] = client.event_hooks["response"] + [on_response]
+    with abort_on_cancel(deadline, abort):
+        yield
+
+
+def post(url: str, deadline: Deadline | None = None, **kwargs) -> 'httpx.Response':
+    """
+    Send a POST request upstream through the shared connections of the URL's origin.
+
+    :param deadline: Time limits of the request. Over HTTP/2 the request is aborted when the request is cancelled, a
+        blocking HTTP/1.1 request cannot be interrupted and runs until the upstream answers or times out.
+    """
+    if deadline is not None:
+        kwargs["timeout"] = deadline.get_timeout()
+
+    if use_http2:
+        # the requests are sent from the event loop thread, which does not know the current span
+        kwargs["headers"] = tracing.add_trace_headers(kwargs.get("headers"))
+        future = asyncio.run_coroutine_threadsafe(_get_http2_client(url).post(url, **kwargs), _http2_loop)
+        # cancelling the task resets the stream, the other requests on the connection are not affected
+        with abort_on_cancel(deadline, future.cancel):
+            return future.result()
+    return get_http_client(url).post(url, **kwargs)
+
+
+@contextmanager
+def stream(method: str, url: str, deadline: Deadline | None = None, **kwargs):
+    """
+    Send a streamed request upstream through the shared connections of the URL's origin.
+
+    :param deadline: Time limits of the request, the stream is aborted when the request is cancelled.
+    """
+    if deadline is not None:
+        kwargs["timeout"] = deadline.get_timeout()
+
+    if not use_http2:
+        with get_http_client(url).stream(method, url, **kwargs) as response:
+            with abort_on_cancel(deadline, lambda: abort_response(response)):
+                yield response
+        return
+
+    kwargs["headers"] = tracing.add_trace_headers(kwargs.get("headers"))
+    client = _get_http2_client(url)
+    response = _run(client.send(client.build_request(method, url, **kwargs), stream=True))
+    streamed_response = _Http2StreamedResponse(response)
+    try:
+        with abort_on_cancel(deadline, streamed_response.abort):
+            yield streamed_response
+    finally:
+        _run(response.aclose())
@@ -0,0 +1,242 @@
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Iterator, AnyStr, Callable
+
+logger = logging.getLogger(__name__)
+
+# columns the aggregates can be grouped by
+GROUP_BY_COLUMNS = ("api_key", "model", "backend", "status")
+
+
+class UsageRecord:
+    """Token and latency accounting of a single completion request."""
+
+    def __init__(self, api_key: str | None, model: str, backend: str, prompt_tokens: int, completion_tokens: int,
+                 latency_ms: float, streamed: bool, status: str = "ok", ttft_ms: float | None = None,
+                 timestamp: float | None = None):
+        """
+        :param api_key: API key of the request, only a hash of it is stored.
+        :param model: The requested model.
+        :param backend: Name of the backend that handled the request.
+        :param latency_ms: Time until the whole response was sent.
+        :param status: "ok", "error" or "cancelled" (the client went away during a stream).
+        :param ttft_ms: Time until the first streamed chunk, None for non-streamed requests.
+        """
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.api_key = hash_api_key(api_key)
+        self.model = model
+        self.backend = backend
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.latency_ms = latency_ms
+        self.ttft_ms = ttft_ms
+        self.streamed = streamed
+        self.status = status
+
+    def to_row(self) -> tuple:
+        return (self.timestamp, self.api_key, self.model, self.backend, self.prompt_tokens, self.completion_tokens,
+                self.latency_ms, self.ttft_ms, int(self.streamed), self.status)
+
+
+def hash_api_key(api_key: str | None) -> str:
+    """Identify an API key in the ledger without storing the key itself."""
+
+    if not api_key:
+        return ""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+class UsageLedger:
+    """
+    Collects usage records on an in-memory queue and writes them to SQLite in batches from a background thread, so
+    accounting never blocks the request path.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 1.0, max_queue_size: int = 100000):
+        """
+        :param path: Path of the SQLite database.
+        :param batch_size: Maximum number of records written per transaction.
+        :param flush_interval: Maximum seconds a record waits in the queue before it is written.
+        :param max_queue_size: Records beyond this many pending ones are dropped instead of growing memory.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue[UsageRecord | None] = queue.Queue(maxsize=max_queue_size)
+        self.dropped = 0
+
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS usage (
+                    timestamp REAL NOT NULL,
+                    api_key TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    backend TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    latency_ms REAL NOT NULL,
+                    ttft_ms REAL,
+                    streamed INTEGER NOT NULL,
+                    status TEXT NOT NULL
+                )""")
+            connection.execute("CREATE INDEX IF NOT EXISTS usage_timestamp ON usage (timestamp)")
+
+        self._writer = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, record: UsageRecord):
+        """Queue a record for writing, never blocks."""
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write all queued records and stop the writer."""
+
+        self.queue.put(None)
+        self._writer.join()
+
+    def _run(self):
+        connection = self._connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # collect more records until the batch is full or the oldest record waited long enough
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                running = False
+                batch = [record for record in batch if record is not None]
+                # the close marker may have overtaken records queued concurrently
+                while not self.queue.empty():
+                    record = self.queue.get_nowait()
+                    if record is not None:
+                        batch.append(record)
+
+            try:
+                with connection:
+                    connection.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                           [record.to_row() for record in batch])
+            except sqlite3.Error:
+                logger.exception("Failed to write %d usage records", len(batch))
+        connection.close()
+
+    def summarize(self, since: float | None = None, until: float | None = None,
+                  group_by: list[str] | None = None) -> list[dict]:
+        """
+        Aggregate the written usage records.
+
+        :param since: Only include records from this unix timestamp on.
+        :param until: Only include records before this unix timestamp.
+        :param group_by: Columns to group by, any of GROUP_BY_COLUMNS.
+        :return: One aggregate per group.
+        """
+        group_by = group_by or []
+        for column in group_by:
+            if column not in GROUP_BY_COLUMNS:
+                raise ValueError("Cannot group usage by: " + column)
+
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(until)
+
+        columns = ", ".join(group_by)
+        query = f"""
+            SELECT {columns + ", " if group_by else ""}
+                COUNT(*), SUM(status != 'ok'), SUM(prompt_tokens), SUM(completion_tokens), AVG(latency_ms),
+                MAX(latency_ms), AVG(ttft_ms)
+            FROM usage
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            {"GROUP BY " + columns if group_by else ""}"""
+
+        connection = self._connect()
+        try:
+            rows = connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+        summary = []
+        for row in rows:
+            aggregate = dict(zip(group_by, row[:len(group_by)]))
+            requests, errors, prompt_tokens, completion_tokens, avg_latency, max_latency, avg_ttft = \
+                row[len(group_by):]
+            if not requests:
+                continue
+            aggregate.update({
+                "requests": requests,
+                "errors": errors,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "avg_latency_ms": avg_latency,
+                "max_latency_ms": max_latency,
+                "avg_ttft_ms": avg_ttft,
+            })
+            summary.append(aggregate)
+        return summary
+
+
+def track_stream(frames: Iterator[AnyStr], on_finish: Callable[[str, float | None], None]) -> Iterator[AnyStr]:
+    """
+    Pass a stream through and report when it ends.
+
+    :param frames: The stream to track.
+    :param on_finish: Called with the status ("ok", "error" or "cancelled") and the time of the first frame
+        (perf_counter) once the stream is exhausted, failed or closed by the client.
+    """
+    status = "error"
+    first_frame_at = None
+    try:
+        for frame in frames:
+            if first_frame_at is None:
+                first_frame_at = time.perf_counter()
+            yield frame
+        status = "ok"
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    finally:
+        if hasattr(frames, "close"):
+            frames.close()
+        on_finish(status, first_frame_at)
+
+
+usage_ledger: UsageLedger | None = None
+
+
+def init_usage_ledger(path: str, batch_size: int, flush_interval: float):
+    """Start collecting usage records into the SQLite database at `path`."""
+
+    global usage_ledger
+    if usage_ledger is not None:
+        usage_ledger.close()
+    usage_ledger = UsageLedger(path, batch_size=batch_size, flush_interval=flush_interval)
+
+
+def get_usage_ledger() -> UsageLedger | None:
+    """Get the usage ledger, None if usage accounting is disabled."""
+
+    return usage_ledger
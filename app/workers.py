@@ -0,0 +1,386 @@
+import _thread
+import contextlib
+import logging
+import mmap
+import os
+import signal
+import socket
+import stat
+import struct
+import threading
+import time
+from typing import Callable
+
+from flask import Flask
+from werkzeug.wsgi import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+# pid, requests, errors, active requests, restarts, start time of a worker
+_SLOT = struct.Struct("qqqqqd")
+
+# workers exiting sooner than this after their start are restarted with a delay, so a worker that cannot start does
+# not fork in a loop
+MIN_WORKER_UPTIME = 1.0
+
+_STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+# socket files created by create_unix_listen_socket, path -> (pid of the creating process, inode of the file)
+_socket_files: dict[str, tuple[int, int]] = {}
+
+
+class WorkerStats:
+    """
+    Request counters of all workers in a memory region shared between the processes.
+
+    Every worker only writes its own slot, any worker can read all of them.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # anonymous shared mapping created before forking, inherited by every worker
+        self._memory = mmap.mmap(-1, _SLOT.size * workers)
+        self._lock = threading.Lock()
+        self.slot: int | None = None
+
+    def _read(self, slot: int) -> list:
+        return list(_SLOT.unpack_from(self._memory, slot * _SLOT.size))
+
+    def _write(self, slot: int, values: list):
+        _SLOT.pack_into(self._memory, slot * _SLOT.size, *values)
+
+    def start_worker(self, slot: int, pid: int):
+        """Reset the slot of a (re)started worker, keeping the restart count."""
+
+        restarts = self._read(slot)[4]
+        self._write(slot, [pid, 0, 0, 0, restarts, time.time()])
+
+    def count_restart(self, slot: int):
+        values = self._read(slot)
+        values[4] += 1
+        self._write(slot, values)
+
+    def request_started(self):
+        with self._lock:
+            values = self._read(self.slot)
+            values[1] += 1
+            values[3] += 1
+            self._write(self.slot, values)
+
+    def request_finished(self, error: bool):
+        with self._lock:
+            values = self._read(self.slot)
+            values[2] += error
+            values[3] -= 1
+            self._write(self.slot, values)
+
+    def active_requests(self) -> int:
+        """Number of requests in progress in this worker."""
+
+        return self._read(self.slot)[3]
+
+    def summarize(self) -> dict:
+        """Get the counters of every worker and their totals."""
+
+        workers = []
+        for slot in range(self.workers):
+            pid, requests, errors, active, restarts, started_at = self._read(slot)
+            workers.append({"worker": slot, "pid": pid, "requests": requests, "errors": errors,
+                            "active_requests": active, "restarts": restarts, "started_at": started_at})
+        return {
+            "object": "list",
+            "data": workers,
+            "total": {key: sum(worker[key] for worker in workers)
+                      for key in ("requests", "errors", "active_requests", "restarts")}
+        }
+
+
+class _CountingMiddleware:
+    """Counts the requests of a worker, a request ends once its (possibly streamed) response is closed."""
+
+    def __init__(self, app, stats: WorkerStats):
+        self.app = app
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        status = []
+
+        def counting_start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(" ", 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        self.stats.request_started()
+        try:
+            response = self.app(environ, counting_start_response)
+        except BaseException:
+            self.stats.request_finished(error=True)
+            raise
+        return ClosingIterator(response, lambda: self.stats.request_finished(error=not status or status[-1] >= 500))
+
+
+def _serve_worker(create_app: Callable[[], Flask], listen_sockets: list[socket.socket], stats: WorkerStats,
+                  slot: int, shutdown_timeout: float):
+    # runs in the forked worker process, the app (and its background threads) is created after the fork
+    stats.slot = slot
+    app = create_app()
+    app.wsgi_app = _CountingMiddleware(app.wsgi_app, stats)
+    servers = create_servers(app, listen_sockets)
+
+    drained = threading.Event()
+
+    def drain():
+        # let in-flight requests and streams finish, then stop the server loop on the main thread
+        deadline = time.monotonic() + shutdown_timeout
+        while stats.active_requests() > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        drained.set()
+        _thread.interrupt_main(signal.SIGTERM)
+
+    def handle_stop(signum, frame):
+        if drained.is_set():
+            raise KeyboardInterrupt
+        if not servers[0].accepting:
+            return
+        # stop accepting, the listening sockets stay open for the other workers
+        for server in servers:
+            server.accepting = False
+        servers[0].pull_trigger()
+        threading.Thread(target=drain, name="worker-drain", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+    # waitress stops its loop and its request threads on KeyboardInterrupt
+    servers[0].run()
+
+    # write the pending usage records before the worker exits
+    from app.usage import get_usage_ledger
+    usage_ledger = get_usage_ledger()
+    if usage_ledger is not None:
+        usage_ledger.close()
+
+
+class Supervisor:
+    """Forks the workers serving the app on shared listening sockets and restarts the ones that exit."""
+
+    def __init__(self, create_app: Callable[[], Flask], listen_sockets: list[socket.socket], workers: int,
+                 shutdown_timeout: float = 30):
+        """
+        :param create_app: Creates the app in every worker.
+        :param listen_sockets: Listening sockets, created before forking and shared by all workers.
+        :param workers: Number of worker processes.
+        :param shutdown_timeout: Seconds the workers wait for in-flight requests when shutting down.
+        """
+        self.create_app = create_app
+        self.listen_sockets = listen_sockets
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.stats = WorkerStats(workers)
+        self.stopping = False
+        # pid -> (slot, start time)
+        self._pids: dict[int, tuple[int, float]] = {}
+
+    def _spawn(self, slot: int):
+        # the stop signals stay blocked until the worker has installed its handlers, so a worker stopped while it
+        # starts still shuts down
+        signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self.stats.start_worker(slot, os.getpid())
+                _serve_worker(self.create_app, self.listen_sockets, self.stats, slot, self.shutdown_timeout)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.exception("Worker %d failed", slot)
+                exit_code = 1
+            finally:
+                # never return into the supervisor's code in the child
+                os._exit(exit_code)
+
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+        self._pids[pid] = (slot, time.monotonic())
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        """Serve until SIGTERM or SIGINT, then stop the workers gracefully."""
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for slot in range(self.workers):
+            self._spawn(slot)
+        logger.info("Started %d workers", self.workers)
+
+        while not self.stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+
+            slot, started_at = self._pids.pop(pid)
+            if self.stopping:
+                break
+            exit_code = os.waitstatus_to_exitcode(status)
+            if exit_code < 0:
+                logger.warning("Worker %d (pid %d) was killed by %s, restarting it", slot, pid,
+                               signal.Signals(-exit_code).name)
+            else:
+                logger.warning("Worker %d (pid %d) exited with status %d, restarting it", slot, pid, exit_code)
+            if time.monotonic() - started_at < MIN_WORKER_UPTIME:
+                time.sleep(MIN_WORKER_UPTIME)
+            self.stats.count_restart(slot)
+            self._spawn(slot)
+
+        self._shutdown()
+
+    def _shutdown(self):
+        logger.info("Stopping %d workers", len(self._pids))
+        for pid in self._pids:
+            os.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.shutdown_timeout + 5
+        while self._pids and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.05)
+            else:
+                self._pids.pop(pid, None)
+
+        for pid in self._pids:
+            logger.warning("Worker pid %d did not stop in time, killing it", pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self._pids.clear()
+
+
+def create_listen_socket(port: int, backlog: int = 1024) -> socket.socket:
+    """Create a TCP listening socket on all interfaces to share between the workers."""
+
+    if socket.has_dualstack_ipv6():
+        listen_socket = socket.create_server(("", port), family=socket.AF_INET6, backlog=backlog, dualstack_ipv6=True)
+    else:
+        listen_socket = socket.create_server(("", port), backlog=backlog)
+    listen_socket.setblocking(False)
+    return listen_socket
+
+
+def create_unix_listen_socket(path: str, perms: int = 0o600, backlog: int = 1024) -> socket.socket:
+    """
+    Create a UNIX domain listening socket to share between the workers.
+
+    A socket file left behind by a server that did not shut down cleanly is replaced, a socket another server still
+    listens on is not.
+
+    :param perms: Permissions of the socket file, clients need write permission to connect.
+    :raises OSError: If the path is taken by another file or a running server.
+    """
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError(f"{path} exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                # nobody listens on it anymore
+                os.unlink(path)
+            else:
+                raise OSError(f"Another server is listening on {path}")
+
+    listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # create the file with the final permissions right away, so no client can connect before the chmod
+    umask = os.umask(0o777 & ~perms)
+    try:
+        listen_socket.bind(path)
+    finally:
+        os.umask(umask)
+    _socket_files[path] = (os.getpid(), os.stat(path).st_ino)
+    os.chmod(path, perms)
+    listen_socket.listen(backlog)
+    listen_socket.setblocking(False)
+    return listen_socket
+
+
+def remove_unix_socket(path: str):
+    """
+    Remove a socket file created by create_unix_listen_socket on shutdown.
+
+    Only the process that created the file removes it, and only if it was not replaced in the meantime, e.g. by a
+    server started after this one found it unused.
+    """
+    pid, inode = _socket_files.pop(path, (None, None))
+    if pid != os.getpid():
+        return
+    with contextlib.suppress(FileNotFoundError):
+        if os.stat(path).st_ino == inode:
+            os.unlink(path)
+
+
+def create_listen_sockets(port: int, unix_socket: str | None = None, unix_socket_perms: int = 0o600) \
+        -> list[socket.socket]:
+    """
+    Create the listening sockets of the server.
+
+    :param port: TCP port, 0 to only listen on the UNIX domain socket.
+    :param unix_socket: Path of a UNIX domain socket to listen on as well, None for none.
+    """
+    listen_sockets = []
+    if port or not unix_socket:
+        listen_sockets.append(create_listen_socket(port))
+    if unix_socket:
+        listen_sockets.append(create_unix_listen_socket(unix_socket, unix_socket_perms))
+    return listen_sockets
+
+
+def create_servers(app, listen_sockets: list[socket.socket]) -> list:
+    """
+    Create the waitress servers of the listening sockets, sharing one event loop and one pool of request threads.
+
+    Waitress refuses to mix TCP and UNIX domain sockets in one server, so every socket gets its own server. Running the
+    first server runs all of them.
+    """
+    from waitress import create_server
+    from waitress.adjustments import Adjustments
+    from waitress.task import ThreadedTaskDispatcher
+
+    socket_map = {}
+    dispatcher = ThreadedTaskDispatcher()
+    dispatcher.set_thread_count(Adjustments().threads)
+    return [create_server(app, map=socket_map, _dispatcher=dispatcher, sockets=[listen_socket])
+            for listen_socket in listen_sockets]
+
+
+def serve(app, listen_sockets: list[socket.socket]):
+    """Serve the app from this process until SIGTERM or SIGINT."""
+
+    def handle_stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    # waitress stops its loop and its request threads on KeyboardInterrupt
+    create_servers(app, listen_sockets)[0].run()
+
+
+worker_stats: WorkerStats | None = None
+
+
+def run_workers(create_app: Callable[[], Flask], listen_sockets: list[socket.socket], workers: int,
+                shutdown_timeout: float):
+    """Serve the app from `workers` processes until SIGTERM or SIGINT."""
+
+    global worker_stats
+    supervisor = Supervisor(create_app, listen_sockets, workers, shutdown_timeout)
+    worker_stats = supervisor.stats
+    supervisor.run()
+
+
+def get_worker_stats() -> WorkerStats | None:
+    """Get the request counters of all workers, None if the app is served by a single process."""
+
+    return worker_stats
@@ -0,0 +1,55 @@
+"""
+Streaming chunk encoding benchmark.
+
+Encodes text deltas as SSE frames with a new OpenAICompletionChunkResponse per chunk (serializing the whole chunk) and
+with the per-stream ChunkEncoder (serializing only the delta), and reports the chunks per second of one core.
+
+Usage: python -m benchmarks.chunk_encoder [--chunks N]
+"""
+
+import argparse
+import random
+import time
+
+from app.models import OpenAICompletionChunkResponse, ChunkEncoder
+
+WORDS = " the of report sales region customer revenue quarter summarize largest product growth, market. Ünïcode".split()
+
+
+def _chunk_response(deltas: list[str]) -> float:
+    started_at = time.perf_counter()
+    for text in deltas:
+        chunk_message = OpenAICompletionChunkResponse(
+            completion_id="msg_01XFDUDYJgAACzvnptvVoYEL",
+            model="claude-3-haiku-20240307",
+            choices=[{"index": 0, "delta": {"content": text}, "finish_reason": None}]
+        ).to_json()
+        ("data:" + chunk_message + "\n\n").encode()
+    return time.perf_counter() - started_at
+
+
+def _chunk_encoder(deltas: list[str]) -> float:
+    started_at = time.perf_counter()
+    encoder = ChunkEncoder("claude-3-haiku-20240307", "msg_01XFDUDYJgAACzvnptvVoYEL")
+    for text in deltas:
+        encoder.encode(text)
+    return time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=500000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    # token sized deltas, as the providers stream them
+    deltas = [" " + rng.choice(WORDS) for _ in range(args.chunks)]
+
+    for name, run in (("OpenAICompletionChunkResponse", _chunk_response), ("ChunkEncoder", _chunk_encoder)):
+        # best of three, to skip warm-up and scheduling noise
+        elapsed = min(run(deltas) for _ in range(3))
+        print(f"{name:30} {args.chunks / elapsed:12,.0f} chunks/s  {elapsed / args.chunks * 1e9:6.0f} ns/chunk")
+
+
+if __name__ == "__main__":
+    main()
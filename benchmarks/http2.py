@@ -0,0 +1,100 @@
+"""
+Upstream transport benchmark: HTTP/1.1 vs HTTP/2.
+
+Sends concurrent requests through the Anthropic raw HTTP path (AnthropicCompletionRequest.make_api_request) and the
+OpenAI streaming path (openai_service._stream_request) to a local HTTP/1.1 stub upstream and to a local HTTP/2 stub
+upstream, and reports throughput, latency and the number of upstream connections opened. The previous transport
+(a plain requests.post per call) is included as a baseline for the Anthropic path.
+
+Requires the h2 package.
+
+Usage: python -m benchmarks.http2 [--concurrency 64] [--requests 2000] [--tokens 32]
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app import transport
+from app.models import OpenAICompletionRequest
+from app.services import openai_service
+from app.services.anthropic_service import AnthropicCompletionRequest
+from benchmarks.stub_upstream import start_stub_upstream
+from benchmarks.stub_upstream_h2 import start_stub_upstream_h2
+
+
+def _completion_request(model: str) -> OpenAICompletionRequest:
+    return OpenAICompletionRequest(api_key="stub", model=model, max_tokens=64,
+                                   messages=[{"role": "user", "content": "Hello"}], stream=True)
+
+
+def _anthropic_call(base_url: str):
+    response = AnthropicCompletionRequest.from_openai_request(_completion_request("claude-3-haiku-20240307")) \
+        .make_api_request(base_url, "stub")
+    assert response["type"] == "message"
+
+
+def _anthropic_requests_baseline_call(base_url: str):
+    request = AnthropicCompletionRequest.from_openai_request(_completion_request("claude-3-haiku-20240307"))
+    response = requests.post(base_url + "/v1/messages", json=request.to_dict(), headers={"x-api-key": "stub"})
+    assert response.json()["type"] == "message"
+
+
+def _openai_stream_call(base_url: str):
+    client = openai_service.OpenAI(api_key="stub", base_url=base_url, http_client=transport.get_http_client(base_url))
+    chunks = list(openai_service._stream_request(_completion_request("gpt-3.5-turbo"), client))
+    assert chunks[-1].startswith("data: [DONE]")
+
+
+def _run(name: str, call, base_url: str, server, concurrency: int, total: int):
+    connections_before = server.connections
+
+    def timed_call(_):
+        start = time.perf_counter()
+        call(base_url)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(timed_call, range(total)))
+    elapsed = time.perf_counter() - start
+
+    print(f"  {name:<34} {total / elapsed:>9.0f} req/s   p50 {statistics.median(latencies) * 1000:>7.2f} ms   "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:>7.2f} ms   "
+          f"{server.connections - connections_before:>5} connections")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--tokens", type=int, default=32)
+    args = parser.parse_args()
+
+    http1_upstream = start_stub_upstream(tokens=args.tokens)
+    http2_upstream = start_stub_upstream_h2(tokens=args.tokens)
+    http1_url = f"http://127.0.0.1:{http1_upstream.server_port}"
+    http2_url = f"http://127.0.0.1:{http2_upstream.server_port}"
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, {args.tokens} tokens per completion")
+
+    _run("anthropic, requests.post (baseline)", _anthropic_requests_baseline_call, http1_url, http1_upstream,
+         args.concurrency, args.requests)
+
+    transport.init_transport(http2=False)
+    _run("anthropic, HTTP/1.1", _anthropic_call, http1_url, http1_upstream, args.concurrency, args.requests)
+    _run("openai stream, HTTP/1.1", _openai_stream_call, http1_url, http1_upstream, args.concurrency, args.requests)
+
+    transport.init_transport(http2=True)
+    _run("anthropic, HTTP/2", _anthropic_call, http2_url, http2_upstream, args.concurrency, args.requests)
+    _run("openai stream, HTTP/2", _openai_stream_call, http2_url, http2_upstream, args.concurrency, args.requests)
+
+    http1_upstream.shutdown()
+    http2_upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
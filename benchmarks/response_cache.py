@@ -0,0 +1,78 @@
+"""
+Similarity response cache benchmark.
+
+Fills the cache with distinct prompts and measures the latency of lookups that hit (near-duplicates of cached prompts
+with other ids and timestamps) and miss, split into the signature computation and the index lookup.
+
+Usage: python -m benchmarks.response_cache [--entries N] [--lookups N]
+"""
+
+import argparse
+import resource
+import random
+import statistics
+import time
+
+from app.models import OpenAICompletionRequest
+from app.response_cache import SimilarityCache, get_request_scope, get_shingles, minhash_signature
+
+WORDS = ("report sales region customer revenue quarter summarize list largest product growth market team budget "
+         "forecast risk plan review contract invoice order shipment delay supplier price discount").split()
+
+
+def _prompt(rng: random.Random, request_id: int) -> str:
+    return f"Request {request_id:08x} at 2024-05-01T10:{request_id % 60:02d}:00Z: " + \
+        " ".join(rng.choice(WORDS) for _ in range(40))
+
+
+def _percentiles(samples: list[float]) -> str:
+    samples = sorted(samples)
+    return f"median {statistics.median(samples) * 1e6:7.1f}us  p99 {samples[int(len(samples) * 0.99)] * 1e6:7.1f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--threshold", type=float, default=0.9)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    payload = '{"id": "cached", "choices": []}'
+    scope = get_request_scope(OpenAICompletionRequest(api_key="", model="model", max_tokens=100, messages=[]))
+    cache = SimilarityCache(args.threshold, max_bytes=1 << 40)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started_at = time.perf_counter()
+    prompts = []
+    for i in range(args.entries):
+        prompt = _prompt(rng, i)
+        if i < args.lookups:
+            prompts.append(prompt)
+        cache.insert(scope, minhash_signature(get_shingles([{"role": "user", "content": prompt}])), payload)
+    fill_time = time.perf_counter() - started_at
+    # ru_maxrss is in KiB on Linux
+    memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+
+    print(f"{args.entries} entries filled in {fill_time:.1f}s, {memory / args.entries:.0f} bytes per entry "
+          f"({cache.bands} bands of {cache.band_rows} rows)")
+
+    for name, make_prompt in (
+            ("hit", lambda i: prompts[i].replace(f"{i:08x}", f"{i + 7:08x}").replace("10:", "11:")),
+            ("miss", lambda i: _prompt(rng, i))):
+        signature_times, lookup_times, hits = [], [], 0
+        for i in range(args.lookups):
+            messages = [{"role": "user", "content": make_prompt(i)}]
+            started_at = time.perf_counter()
+            signature = minhash_signature(get_shingles(messages))
+            signed_at = time.perf_counter()
+            hits += cache.lookup(scope, signature) is not None
+            lookup_times.append(time.perf_counter() - signed_at)
+            signature_times.append(signed_at - started_at)
+
+        print(f"{name:<5} signature {_percentiles(signature_times)} | index lookup {_percentiles(lookup_times)} | "
+              f"hit rate {hits / args.lookups:.3f}")
+
+
+if __name__ == '__main__':
+    main()
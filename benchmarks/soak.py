@@ -0,0 +1,237 @@
+"""
+Soak test and leak detection harness.
+
+Serves the app from this process (waitress on a background thread) in front of a local stub upstream and drives
+streamed and non-streamed completions at it from several client processes for a long time, through the Anthropic and
+OpenAI backends. Some streams are abandoned by their client halfway through, the way disconnecting users leave them.
+
+Every --interval seconds the resident memory, open file descriptors, threads and the memory traced by tracemalloc of
+the server are sampled. After the warm-up the first sample is the baseline, after the load stops and the in-flight
+requests drained the last sample is compared to it: growth beyond the thresholds fails the run (exit code 1). The
+samples, the result and the allocation sites that grew the most since the baseline are written to a JSON report.
+
+Usage: python -m benchmarks.soak [--duration 3600] [--clients 4] [--threads 8] [--report soak-report.json]
+"""
+
+import argparse
+import gc
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from benchmarks.stub_upstream import start_stub_upstream
+
+MODELS = ["claude-3-haiku-20240307", "gpt-3.5-turbo"]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run_upstream(port: int, token_delay: float):
+    # abandoned streams make the stub print broken pipe errors
+    sys.stderr = open(os.devnull, "w")
+    start_stub_upstream(tokens=32, token_delay=token_delay, port=port)
+    threading.Event().wait()
+
+
+def _run_client(port: int, threads: int, duration: float, stream_share: float, abandon_share: float,
+                results: multiprocessing.Queue):
+    deadline = time.monotonic() + duration
+    counts = {"requests": 0, "streamed": 0, "abandoned": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def run(seed: int):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while time.monotonic() < deadline:
+            stream = rng.random() < stream_share
+            abandon = stream and rng.random() < abandon_share
+            body = json.dumps({
+                "model": rng.choice(MODELS),
+                "max_tokens": 64,
+                "stream": stream,
+                "messages": [{"role": "user", "content": f"Soak request {rng.getrandbits(32)}"}],
+            })
+            try:
+                connection.request("POST", "/v1/chat/completions", body=body,
+                                   headers={"Content-Type": "application/json", "Authorization": "Bearer stub"})
+                response = connection.getresponse()
+                if abandon:
+                    # read the first events and hang up, leaving the server with an unfinished stream
+                    response.read1(256)
+                    connection.close()
+                else:
+                    response.read()
+                error = response.status != 200
+            except OSError:
+                error = True
+                connection.close()
+            with lock:
+                counts["requests"] += 1
+                counts["streamed"] += stream
+                counts["abandoned"] += abandon
+                counts["errors"] += error
+
+    workers = [threading.Thread(target=run, args=(os.getpid() * 1000 + i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put(counts)
+
+
+def _sample(started_at: float) -> dict:
+    with open("/proc/self/statm") as statm:
+        rss = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return {
+        "time": round(time.monotonic() - started_at, 1),
+        "rss": rss,
+        "fds": len(os.listdir("/proc/self/fd")),
+        "threads": threading.active_count(),
+        "traced": tracemalloc.get_traced_memory()[0],
+    }
+
+
+def _top_allocations(baseline: tracemalloc.Snapshot, final: tracemalloc.Snapshot, limit: int) -> list[dict]:
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap*"), tracemalloc.Filter(False, "<unknown>")]
+    final, baseline = final.filter_traces(filters), baseline.filter_traces(filters)
+    # the call stack holding the most memory of every allocating line
+    stacks = {}
+    for stat in final.statistics("traceback"):
+        stacks.setdefault(stat.traceback[0], stat.traceback)
+
+    top = []
+    # grouped by the allocating line, the stacks of a line can differ in every request
+    for difference in final.compare_to(baseline, "lineno")[:limit]:
+        if difference.size_diff <= 0:
+            continue
+        frame = difference.traceback[0]
+        top.append({
+            "site": f"{frame.filename}:{frame.lineno}",
+            "size_diff": difference.size_diff,
+            "count_diff": difference.count_diff,
+            "traceback": stacks[frame].format(most_recent_first=True) if frame in stacks else [],
+        })
+    return top
+
+
+def _print_sample(sample: dict):
+    print(f"  {sample['time']:>8.0f}s  rss {sample['rss'] / 2 ** 20:>7.1f} MiB  fds {sample['fds']:>4}  "
+          f"threads {sample['threads']:>4}  traced {sample['traced'] / 2 ** 20:>7.1f} MiB", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=3600, help="seconds of load, after the warm-up")
+    parser.add_argument("--warmup", type=float, default=60, help="seconds of load before the baseline sample")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between samples")
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--threads", type=int, default=8, help="connections per load generating process")
+    parser.add_argument("--stream-share", type=float, default=0.7, help="share of streamed requests")
+    parser.add_argument("--abandon-share", type=float, default=0.05, help="share of streams the client abandons")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="seconds between streamed tokens")
+    parser.add_argument("--traceback-frames", type=int, default=8, help="frames kept per traced allocation")
+    parser.add_argument("--max-rss-growth", type=float, default=64, help="MiB")
+    parser.add_argument("--max-traced-growth", type=float, default=16, help="MiB")
+    parser.add_argument("--max-fd-growth", type=int, default=16)
+    parser.add_argument("--max-thread-growth", type=int, default=8)
+    parser.add_argument("--top", type=int, default=15, help="allocation sites in the report")
+    parser.add_argument("--report", default="soak-report.json")
+    args = parser.parse_args()
+
+    # the load generators and the upstream must not inherit the traced server
+    multiprocessing.set_start_method("spawn")
+    upstream_port = _free_port()
+    upstream = multiprocessing.Process(target=_run_upstream, args=(upstream_port, args.token_delay), daemon=True)
+    upstream.start()
+
+    os.environ.update(TARGET_API="", AUTH_MODE="NO_AUTH", LOG_LEVEL="WARNING", SSE_HEARTBEAT_INTERVAL="1",
+                      ANTHROPIC_API_KEY="stub", ANTHROPIC_API_URL=f"http://127.0.0.1:{upstream_port}",
+                      OPENAI_API_KEY="stub", OPENAI_API_URL=f"http://127.0.0.1:{upstream_port}/v1")
+    tracemalloc.start(args.traceback_frames)
+    # the request queue of waitress is expected to fill up under this load
+    logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+    from waitress import create_server
+    from app.__main__ import create_app
+
+    server = create_server(create_app(), host="127.0.0.1", port=0)
+    threading.Thread(target=server.run, daemon=True).start()
+
+    results = multiprocessing.Queue()
+    load_duration = args.warmup + args.duration
+    clients = [multiprocessing.Process(target=_run_client, args=(
+        server.effective_port, args.threads, load_duration, args.stream_share, args.abandon_share, results))
+        for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    print(f"{args.clients} client processes with {args.threads} connections each, "
+          f"{args.warmup:.0f}s warm-up and {args.duration:.0f}s of load")
+    started_at = time.monotonic()
+    time.sleep(args.warmup)
+    gc.collect()
+    # the baseline snapshot is held until the end, the samples include its memory
+    baseline_snapshot = tracemalloc.take_snapshot()
+    samples = [_sample(started_at)]
+    _print_sample(samples[0])
+    while time.monotonic() - started_at < load_duration:
+        time.sleep(min(args.interval, max(0.0, load_duration - (time.monotonic() - started_at))))
+        samples.append(_sample(started_at))
+        _print_sample(samples[-1])
+
+    totals = {}
+    for _ in clients:
+        for key, value in results.get().items():
+            totals[key] = totals.get(key, 0) + value
+    for client in clients:
+        client.join()
+
+    # let abandoned streams and idle connections be noticed and closed before the final sample
+    time.sleep(max(5.0, args.interval))
+    gc.collect()
+    samples.append(_sample(started_at))
+    # taken after the sample, so its memory does not count
+    final_snapshot = tracemalloc.take_snapshot()
+    print("after the load:")
+    _print_sample(samples[-1])
+
+    baseline, final = samples[0], samples[-1]
+    growth = {key: final[key] - baseline[key] for key in ("rss", "fds", "threads", "traced")}
+    limits = {"rss": args.max_rss_growth * 2 ** 20, "fds": args.max_fd_growth, "threads": args.max_thread_growth,
+              "traced": args.max_traced_growth * 2 ** 20}
+    failures = [key for key in growth if growth[key] > limits[key]]
+    top = _top_allocations(baseline_snapshot, final_snapshot, args.top)
+    upstream.terminate()
+
+    with open(args.report, "w") as report:
+        json.dump({"settings": vars(args), "requests": totals, "samples": samples, "growth": growth,
+                   "limits": limits, "failures": failures, "top_allocations": top}, report, indent=2)
+
+    print(f"{totals.get('requests', 0)} requests ({totals.get('streamed', 0)} streamed, "
+          f"{totals.get('abandoned', 0)} abandoned, {totals.get('errors', 0)} errors)")
+    print(f"growth since the baseline: rss {growth['rss'] / 2 ** 20:.1f} MiB, fds {growth['fds']}, "
+          f"threads {growth['threads']}, traced {growth['traced'] / 2 ** 20:.1f} MiB")
+    print("top allocation sites by growth:")
+    for allocation in top[:5]:
+        print(f"  {allocation['size_diff'] / 1024:>9.1f} KiB  {allocation['count_diff']:>+7} blocks  "
+              f"{allocation['site']}")
+    print(f"report written to {args.report}")
+    if failures:
+        print("FAILED: growth beyond the limits of " + ", ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Cold start benchmark.
+
+Every run starts a fresh interpreter and measures how long it takes to import the app, create it, serve the first
+/v1/models request and serve the first completion (routed through the Anthropic backend to a local stub upstream).
+
+Usage: python -m benchmarks.startup [--runs N] [--target-api anthropic]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.stub_upstream import start_stub_upstream
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _child():
+    start = time.perf_counter()
+    from app.__main__ import create_app
+    imported = time.perf_counter()
+
+    app = create_app()
+    created = time.perf_counter()
+
+    client = app.test_client()
+    client.get("/v1/models", headers={"Authorization": "Bearer stub"})
+    first_models = time.perf_counter()
+
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer stub"}, json={
+        "model": "claude-3-haiku-20240307",
+        "messages": [{"role": "user", "content": "Hello"}],
+    })
+    assert response.status_code == 200, response.data
+    first_completion = time.perf_counter()
+
+    print(json.dumps({
+        "import": imported - start,
+        "create_app": created - imported,
+        "first_models_request": first_models - created,
+        "first_completion_request": first_completion - first_models,
+        "total": first_completion - start,
+        "loaded_sdks": sorted(name for name in ("anthropic", "cohere", "mistralai", "openai") if name in sys.modules),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target-api", default="", help="TARGET_API for the server, blank selects automatically")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child()
+        return
+
+    upstream = start_stub_upstream()
+    env = dict(os.environ,
+               TARGET_API=args.target_api,
+               AUTH_MODE="NO_AUTH",
+               ANTHROPIC_API_URL=f"http://127.0.0.1:{upstream.server_port}",
+               ANTHROPIC_API_KEY="stub")
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"], env=env, cwd=PROJECT_ROOT,
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.runs} cold starts, median seconds:")
+    for key in ("import", "create_app", "first_models_request", "first_completion_request", "total"):
+        print(f"  {key:<26} {statistics.median(r[key] for r in results):.4f}")
+    print(f"  SDKs loaded after first completion: {', '.join(results[-1]['loaded_sdks']) or 'none'}")
+
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
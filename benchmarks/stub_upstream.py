@@ -0,0 +1,169 @@
+"""
+Local stub of the upstream provider APIs, used by the benchmarks so they never touch the network.
+
+Serves the Anthropic messages API (POST /v1/messages) and the OpenAI chat completions API (POST /chat/completions or
+/v1/chat/completions), both non-streamed and streamed, with a fixed number of generated tokens and an optional delay
+between streamed tokens.
+"""
+
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Iterator
+
+
+def _tokens(tokens: int, token_delay: float) -> Iterator[str]:
+    for i in range(tokens):
+        if token_delay:
+            time.sleep(token_delay)
+        yield f"tok{i} "
+
+
+def anthropic_message(body: dict, tokens: int, token_delay: float = 0.0) -> dict:
+    return {
+        "id": "msg_stub", "type": "message", "role": "assistant", "model": body.get("model"),
+        "content": [{"type": "text", "text": "".join(_tokens(tokens, token_delay))}],
+        "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": tokens}
+    }
+
+
+def anthropic_events(body: dict, tokens: int, token_delay: float = 0.0) -> Iterator[str]:
+    def event(name: str, data: dict) -> str:
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    message = {"id": "msg_stub", "type": "message", "role": "assistant", "model": body.get("model"),
+               "content": [], "stop_reason": None, "stop_sequence": None,
+               "usage": {"input_tokens": 10, "output_tokens": 0}}
+    yield event("message_start", {"type": "message_start", "message": message})
+    yield event("content_block_start", {"type": "content_block_start", "index": 0,
+                                        "content_block": {"type": "text", "text": ""}})
+    for token in _tokens(tokens, token_delay):
+        yield event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                            "delta": {"type": "text_delta", "text": token}})
+    yield event("content_block_stop", {"type": "content_block_stop", "index": 0})
+    yield event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                  "usage": {"output_tokens": tokens}})
+    yield event("message_stop", {"type": "message_stop"})
+
+
+def openai_completion(body: dict, tokens: int, token_delay: float = 0.0) -> dict:
+    return {
+        "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+        "model": body.get("model"), "system_fingerprint": "stub",
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": "".join(_tokens(tokens, token_delay))}}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens}
+    }
+
+
+def openai_events(body: dict, tokens: int, token_delay: float = 0.0) -> Iterator[str]:
+    def chunk(delta: dict, finish_reason: str | None = None) -> str:
+        return "data: " + json.dumps({
+            "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": body.get("model"), "system_fingerprint": "stub",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}) + "\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    for token in _tokens(tokens, token_delay):
+        yield chunk({"content": token})
+    yield chunk({}, "stop")
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield "data: " + json.dumps({
+            "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+            "model": body.get("model"), "system_fingerprint": "stub", "choices": [],
+            "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens}}) + "\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def handle_request(method: str, path: str, body: dict, tokens: int, token_delay: float = 0.0) \
+        -> tuple[int, dict | Iterator[str] | None]:
+    """
+    Produce the stub response to a request.
+
+    :return: Status code and either a JSON payload, an iterator of SSE events or None.
+    """
+    if method == "GET" and path.split("?")[0].endswith("/models"):
+        return 200, {"object": "list", "data": [{"id": "stub-model", "object": "model", "created": 0,
+                                                 "owned_by": "stub"}]}
+    if method == "POST" and path.endswith("/v1/messages"):
+        if body.get("stream"):
+            return 200, anthropic_events(body, tokens, token_delay)
+        return 200, anthropic_message(body, tokens, token_delay)
+    if method == "POST" and path.endswith("/chat/completions"):
+        if body.get("stream"):
+            return 200, openai_events(body, tokens, token_delay)
+        return 200, openai_completion(body, tokens, token_delay)
+    return 404, None
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without TCP_NODELAY every keep-alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    # overridden by start_stub_upstream
+    tokens = 16
+    token_delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._respond("GET", {})
+
+    def do_POST(self):
+        self._respond("POST", json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}"))
+
+    def _respond(self, method: str, body: dict):
+        status, payload = handle_request(method, self.path, body, self.tokens, self.token_delay)
+
+        if payload is None:
+            self.send_error(status)
+        elif isinstance(payload, dict):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_response(status)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in payload:
+                data = event.encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+
+class _StubUpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    # number of accepted connections
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+def start_stub_upstream(tokens: int = 16, token_delay: float = 0.0, port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the stub upstream on a background thread.
+
+    :param tokens: Number of tokens generated per completion.
+    :param token_delay: Delay in seconds between generated tokens.
+    :param port: Port to listen on, 0 picks a free port.
+    :return: The running server, its base url is http://127.0.0.1:<server.server_port>.
+    """
+
+    handler = type("ConfiguredStubUpstreamHandler", (StubUpstreamHandler,),
+                   {"tokens": tokens, "token_delay": token_delay})
+    server = _StubUpstreamServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
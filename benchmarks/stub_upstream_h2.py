@@ -0,0 +1,134 @@
+"""
+HTTP/2 (cleartext, prior knowledge) variant of the stub upstream, serving the same responses as stub_upstream.
+
+Requires the h2 package.
+"""
+
+import asyncio
+import json
+import threading
+
+import h2.config
+import h2.connection
+import h2.events
+
+from benchmarks.stub_upstream import handle_request
+
+
+class _H2Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, tokens: int, token_delay: float):
+        self.reader = reader
+        self.writer = writer
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        self.requests: dict[int, dict] = {}
+        self.flow_control_waiters: dict[int, asyncio.Event] = {}
+
+    async def run(self):
+        self.connection.initiate_connection()
+        await self._flush()
+
+        while data := await self.reader.read(65536):
+            for event in self.connection.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    self.requests[event.stream_id] = {"headers": dict(event.headers), "body": b""}
+                elif isinstance(event, h2.events.DataReceived):
+                    self.requests[event.stream_id]["body"] += event.data
+                    self.connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    asyncio.create_task(self._respond(event.stream_id, self.requests.pop(event.stream_id)))
+                elif isinstance(event, h2.events.WindowUpdated):
+                    for waiter in self.flow_control_waiters.values():
+                        waiter.set()
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    self.writer.close()
+                    return
+            await self._flush()
+
+    async def _respond(self, stream_id: int, request: dict):
+        method = request["headers"][b":method"].decode()
+        path = request["headers"][b":path"].decode()
+        body = json.loads(request["body"] or b"{}")
+
+        status, payload = handle_request(method, path, body, self.tokens, self.token_delay)
+        if payload is None:
+            self.connection.send_headers(stream_id, [(":status", str(status))], end_stream=True)
+        elif isinstance(payload, dict):
+            data = json.dumps(payload).encode()
+            self.connection.send_headers(stream_id, [(":status", str(status)), ("content-type", "application/json"),
+                                                     ("content-length", str(len(data)))])
+            await self._send_data(stream_id, data, end_stream=True)
+        else:
+            self.connection.send_headers(stream_id, [(":status", str(status)), ("content-type", "text/event-stream")])
+            # only hand the generator to a thread if it sleeps between tokens
+            next_event = (lambda: asyncio.to_thread(next, payload, None)) if self.token_delay else \
+                (lambda: asyncio.sleep(0, next(payload, None)))
+            while (event := await next_event()) is not None:
+                await self._send_data(stream_id, event.encode())
+            await self._send_data(stream_id, b"", end_stream=True)
+        await self._flush()
+
+    async def _send_data(self, stream_id: int, data: bytes, end_stream: bool = False):
+        while True:
+            window = min(self.connection.local_flow_control_window(stream_id), self.connection.max_outbound_frame_size)
+            if window >= len(data):
+                self.connection.send_data(stream_id, data, end_stream=end_stream)
+                await self._flush()
+                return
+
+            if window > 0:
+                self.connection.send_data(stream_id, data[:window])
+                data = data[window:]
+                await self._flush()
+                continue
+
+            waiter = self.flow_control_waiters.setdefault(stream_id, asyncio.Event())
+            await waiter.wait()
+            waiter.clear()
+
+    async def _flush(self):
+        data = self.connection.data_to_send()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+
+class StubUpstreamH2:
+    """A running HTTP/2 stub upstream, its base url is http://127.0.0.1:<server_port>."""
+
+    def __init__(self, tokens: int, token_delay: float, port: int):
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.server_port = port
+        # number of accepted connections
+        self.connections = 0
+        self._loop = asyncio.new_event_loop()
+
+    def start(self):
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle_connection, "127.0.0.1", self.server_port), self._loop).result()
+        self.server_port = self._server.sockets[0].getsockname()[1]
+
+    def shutdown(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _close(self):
+        self._server.close()
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        await _H2Connection(reader, writer, self.tokens, self.token_delay).run()
+
+
+def start_stub_upstream_h2(tokens: int = 16, token_delay: float = 0.0, port: int = 0) -> StubUpstreamH2:
+    """Start the HTTP/2 stub upstream on a background event loop, see start_stub_upstream for the parameters."""
+
+    server = StubUpstreamH2(tokens, token_delay, port)
+    server.start()
+    return server
@@ -0,0 +1,142 @@
+"""
+UNIX domain socket benchmark.
+
+Starts the server (python -m app) listening on both a TCP port and a UNIX domain socket in front of a local stub
+upstream and sends small non-streamed Anthropic completions over a keep-alive connection of each, reporting the
+round-trip latency percentiles. Both transports are measured against the same server process, alternating rounds so
+warm-up and noise affect them alike.
+
+Usage: python -m benchmarks.uds [--requests 2000] [--rounds 5]
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.stub_upstream import start_stub_upstream
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BODY = json.dumps({
+    "model": "claude-3-haiku-20240307",
+    "max_tokens": 16,
+    "messages": [{"role": "user", "content": "Hi"}],
+})
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a UNIX domain socket."""
+
+    def __init__(self, path: str):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run_upstream(port: int):
+    start_stub_upstream(port=port)
+    threading.Event().wait()
+
+
+def _request(connection: http.client.HTTPConnection, method: str = "POST", path: str = "/v1/chat/completions"):
+    connection.request(method, path, body=BODY if method == "POST" else None,
+                       headers={"Content-Type": "application/json", "Authorization": "Bearer stub"})
+    response = connection.getresponse()
+    response.read()
+    assert response.status == 200, response.status
+
+
+def _wait_until_serving(connect):
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            connection = connect()
+            _request(connection, "GET", "/v1/models")
+            connection.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _measure(connection: http.client.HTTPConnection, requests: int) -> list[float]:
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        _request(connection)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per transport and round")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    upstream_port = _free_port()
+    upstream = multiprocessing.Process(target=_run_upstream, args=(upstream_port,), daemon=True)
+    upstream.start()
+
+    port = _free_port()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "llm-converter.sock")
+    env = dict(os.environ, SERVER_PORT=str(port), UNIX_SOCKET=path, TARGET_API="anthropic", AUTH_MODE="NO_AUTH",
+               LOG_LEVEL="WARNING", ANTHROPIC_API_KEY="stub", ANTHROPIC_API_URL=f"http://127.0.0.1:{upstream_port}")
+    server = subprocess.Popen([sys.executable, "-m", "app"], cwd=PROJECT_ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        transports = {
+            "tcp": lambda: http.client.HTTPConnection("127.0.0.1", port),
+            "unix": lambda: UnixHTTPConnection(path),
+        }
+        for connect in transports.values():
+            _wait_until_serving(connect)
+
+        connections = {name: connect() for name, connect in transports.items()}
+        latencies = {name: [] for name in transports}
+        for name, connection in connections.items():
+            # warm up the connection, the server and the upstream pool
+            _measure(connection, 100)
+        for _ in range(args.rounds):
+            for name, connection in connections.items():
+                latencies[name] += _measure(connection, args.requests)
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.terminate()
+        os.rmdir(directory)
+
+    print(f"{args.rounds * args.requests} small non-streamed completions per transport, one keep-alive connection")
+    tcp_p50 = _percentile(latencies["tcp"], 0.5)
+    for name, values in latencies.items():
+        p50 = _percentile(values, 0.5)
+        print(f"  {name:>4}  p50 {p50 * 1e6:>7.0f} us   p99 {_percentile(values, 0.99) * 1e6:>7.0f} us   "
+              f"{tcp_p50 / p50:>5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
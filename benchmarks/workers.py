@@ -0,0 +1,124 @@
+"""
+Multi-process serving benchmark.
+
+Starts the server (python -m app) with an increasing number of worker processes in front of a local stub upstream and
+drives non-streamed Anthropic completions at it from several client processes, reporting the throughput per worker
+count. The stub upstream and the load generators run in their own processes, so the server is the bottleneck.
+
+Usage: python -m benchmarks.workers [--workers 1,2,4] [--clients 4] [--duration 10]
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from benchmarks.stub_upstream import start_stub_upstream
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BODY = json.dumps({
+    "model": "claude-3-haiku-20240307",
+    "messages": [{"role": "user", "content": "Hello"}],
+})
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run_upstream(port: int):
+    start_stub_upstream(port=port)
+    threading.Event().wait()
+
+
+def _run_client(port: int, threads: int, duration: float, results: multiprocessing.Queue):
+    deadline = time.monotonic() + duration
+    counts = []
+
+    def run():
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        count = 0
+        while time.monotonic() < deadline:
+            connection.request("POST", "/v1/chat/completions", body=BODY,
+                               headers={"Content-Type": "application/json", "Authorization": "Bearer stub"})
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200, response.status
+            count += 1
+        counts.append(count)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put(sum(counts))
+
+
+def _wait_until_serving(port: int):
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/models", timeout=1).read()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts to compare")
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--threads", type=int, default=8, help="connections per load generating process")
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    upstream_port = _free_port()
+    upstream = multiprocessing.Process(target=_run_upstream, args=(upstream_port,), daemon=True)
+    upstream.start()
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} client processes with {args.threads} connections each")
+    baseline = None
+    for workers in [int(x) for x in args.workers.split(",")]:
+        port = _free_port()
+        env = dict(os.environ, WORKERS=str(workers), SERVER_PORT=str(port), TARGET_API="anthropic",
+                   AUTH_MODE="NO_AUTH", LOG_LEVEL="WARNING", ANTHROPIC_API_KEY="stub",
+                   ANTHROPIC_API_URL=f"http://127.0.0.1:{upstream_port}")
+        server = subprocess.Popen([sys.executable, "-m", "app"], cwd=PROJECT_ROOT, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_until_serving(port)
+
+            results = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=_run_client, args=(port, args.threads, args.duration, results))
+                       for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            total = sum(results.get() for _ in clients)
+            for client in clients:
+                client.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+        throughput = total / args.duration
+        baseline = baseline or throughput
+        print(f"  {workers:>3} workers {throughput:>9.0f} req/s   {throughput / baseline:>5.2f}x")
+
+    upstream.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import json
+import time
+
+import pytest
+
+from app import transport
+from app.cassettes import init_cassettes, RECORD, REPLAY, REPLAY_FAST
+from app.models import OpenAICompletionRequest
+from app.services.anthropic_service import AnthropicApiBackend
+from benchmarks.stub_upstream import start_stub_upstream
+
+TOKENS = 5
+TOKEN_DELAY = 0.05
+
+
+@pytest.fixture(autouse=True)
+def restore_transport():
+    yield
+    init_cassettes(None, "")
+    transport.init_transport(http2=False)
+
+
+def _run(backend: AnthropicApiBackend) -> tuple[list, str, float]:
+    started_at = time.monotonic()
+    completionRequest = OpenAICompletionRequest(api_key="stub", model="claude-3-haiku-20240307", max_tokens=10,
+                                                messages=[{"role": "user", "content": "Hello"}], stream=True)
+    # the chunks are created by the server, without their timestamps they are identical across runs
+    frames = [{key: value for key, value in json.loads(frame[5:]).items() if key != "created"}
+              for frame in backend.handle_streamed_completion_request(completionRequest, False)]
+    completionRequest.streamed = False
+    content = backend.handle_completion_request(completionRequest, False).choices[0]["message"]["content"]
+    return frames, content, time.monotonic() - started_at
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "upstream.cassette.jsonl.gz")
+    upstream = start_stub_upstream(tokens=TOKENS, token_delay=TOKEN_DELAY)
+    backend = AnthropicApiBackend(base_url=f"http://127.0.0.1:{upstream.server_port}", api_key="stub")
+    try:
+        init_cassettes(RECORD, path)
+        transport.init_transport(http2=False)
+        recorded = _run(backend)
+    finally:
+        upstream.shutdown()
+        upstream.server_close()
+
+    # the upstream is gone, the exchanges are answered from the cassette
+    init_cassettes(REPLAY, path)
+    transport.init_transport(http2=False)
+    replayed = _run(backend)
+    assert replayed[:2] == recorded[:2]
+    assert replayed[2] >= TOKENS * TOKEN_DELAY * 2 * 0.8
+
+    init_cassettes(REPLAY_FAST, path)
+    transport.init_transport(http2=False)
+    replayed_fast = _run(backend)
+    assert replayed_fast[:2] == recorded[:2]
+    assert replayed_fast[2] < TOKENS * TOKEN_DELAY
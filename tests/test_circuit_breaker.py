@@ -0,0 +1,93 @@
+import time
+
+import httpx
+import pytest
+from mistralai.exceptions import MistralAPIException
+
+import app.services.service_manager
+import app.transport
+from app.__main__ import create_app
+from app.circuit_breaker import CircuitBreaker, CircuitOpenError, is_backend_failure, OPEN, CLOSED
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionRequest
+from app.services.anthropic_service import AnthropicApiBackend, AnthropicApiError
+
+
+class FailingBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.calls = 0
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.calls += 1
+        raise httpx.ConnectError("Connection refused")
+
+
+def test_breaker_opens_and_recovers():
+    breaker = CircuitBreaker("fake/completions", failure_rate=0.5, min_requests=4, slow_call_seconds=1,
+                             open_seconds=0.1, probes=2)
+    for failed in (False, True, False):
+        breaker.after_call(breaker.before_call(), failed)
+    assert breaker.state == CLOSED
+
+    # a slow call counts as failed
+    breaker.after_call(breaker.before_call(), False, seconds=2)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # half open: only the probes are let through, a failed probe reopens the circuit
+    time.sleep(0.1)
+    assert breaker.before_call() is True
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.after_call(True, True)
+    assert breaker.state == OPEN
+
+    time.sleep(0.1)
+    probes = [breaker.before_call(), breaker.before_call()]
+    for probe in probes:
+        breaker.after_call(probe, False)
+    assert breaker.state == CLOSED
+
+
+def test_client_errors_do_not_count():
+    request = httpx.Request("POST", "http://upstream")
+    assert not is_backend_failure(httpx.HTTPStatusError("", request=request, response=httpx.Response(400)))
+    assert is_backend_failure(httpx.HTTPStatusError("", request=request, response=httpx.Response(502)))
+    assert is_backend_failure(httpx.ReadTimeout("timed out"))
+    assert not is_backend_failure(MistralAPIException("Unauthorized", http_status=401))
+
+
+def test_anthropic_client_errors_do_not_count(monkeypatch):
+    response = httpx.Response(400, json={"type": "error", "error": {"type": "invalid_request_error"}})
+    monkeypatch.setattr(app.transport, "post", lambda url, deadline=None, **kwargs: response)
+    request = OpenAICompletionRequest(api_key="key", model="claude-3-haiku-20240307", max_tokens=10,
+                                      messages=[{"role": "user", "content": "Hi"}])
+    with pytest.raises(AnthropicApiError) as error:
+        AnthropicApiBackend(api_key="key").handle_completion_request(request, False)
+    assert error.value.status_code == 400
+    assert not is_backend_failure(error.value)
+
+
+def test_open_circuit_fails_fast(monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.CIRCUIT_BREAKER_MIN_REQUESTS = 3
+    client = create_app(config).test_client()
+    client.application.testing = False
+    backend = FailingBackend()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", backend)
+
+    for _ in range(3):
+        response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"}, json={"model": "model", "messages": []})
+        assert response.status_code == 500
+
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"}, json={"model": "model", "messages": []})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+    assert backend.calls == 3
@@ -0,0 +1,82 @@
+import gzip
+import json
+import zlib
+
+import pytest
+from flask import request
+
+from app.__main__ import create_app
+from app.compression import negotiate_encoding, StreamCompressor
+from app.config import Config, AuthMode
+
+
+@pytest.fixture
+def flask_app():
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.COMPRESSION_ENCODINGS = ["gzip"]
+    config.COMPRESSION_MIN_SIZE = 100
+    config.MAX_DECOMPRESSED_REQUEST_SIZE = 1024
+
+    flask_app = create_app(config)
+
+    @flask_app.route("/test/echo", methods=["POST"])
+    def echo():
+        return request.json
+
+    @flask_app.route("/test/stream")
+    def stream():
+        return (f"data: {i}\n\n" for i in range(3))
+
+    return flask_app
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding("gzip, deflate, br", ["zstd", "br", "gzip"]) == "br"
+    assert negotiate_encoding("gzip;q=1.0, br;q=0.5", ["br", "gzip"]) == "gzip"
+    assert negotiate_encoding("br;q=0", ["br"]) is None
+    assert negotiate_encoding("*", ["gzip"]) == "gzip"
+    assert negotiate_encoding(None, ["gzip"]) is None
+
+
+def test_stream_compressor_flushes_every_event():
+    compressor = StreamCompressor("gzip")
+    decompressor = zlib.decompressobj(31)
+
+    assert decompressor.decompress(compressor.compress(b"data: 1\n\n", flush=True)) == b"data: 1\n\n"
+    assert decompressor.decompress(compressor.compress(b"data: 2\n\n", flush=True)) == b"data: 2\n\n"
+
+
+def test_compressed_models_response(flask_app):
+    client = flask_app.test_client()
+
+    response = client.get("/v1/models", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert json.loads(gzip.decompress(response.data))["object"] == "list"
+
+    # conditional requests still work with the weak ETag of the compressed body
+    response = client.get("/v1/models", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+    assert "Content-Encoding" not in client.get("/v1/models").headers
+
+
+def test_compressed_stream(flask_app):
+    response = flask_app.test_client().get("/test/stream", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == b"data: 0\n\ndata: 1\n\ndata: 2\n\n"
+
+
+def test_compressed_request_body(flask_app):
+    client = flask_app.test_client()
+
+    response = client.post("/test/echo", data=gzip.compress(b'{"a": 1}'),
+                           headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert response.json == {"a": 1}
+
+    response = client.post("/test/echo", data=gzip.compress(b" " * 2048),
+                           headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert response.status_code == 413
@@ -2,7 +2,7 @@ import json
 
 import pytest
 
-from app.models import OpenAICompletionRequest
+from app.models import OpenAICompletionRequest, OpenAICompletionChunkResponse, ChunkEncoder
 import app.services.mistral_service
 import app.services.anthropic_service
 import app.services.cohere_service
@@ -209,3 +209,22 @@ def test_format_openai_request_to_mistral_request(openai_completion_request):
     assert mistral_request.top_p == 0.1
     assert mistral_request.tool_choice == "any"
     assert mistral_request.tools == openai_completion_request.tools
+
+
+def test_chunk_encoder_matches_chunk_response(monkeypatch):
+    monkeypatch.setattr("time.time", lambda: 1700000000.5)
+    encoder = ChunkEncoder("claude-3-haiku", "msg_1")
+
+    def expected(delta: dict, finish_reason: str | None, completion_id: str = "msg_1") -> bytes:
+        return ("data:" + OpenAICompletionChunkResponse(
+            completion_id=completion_id,
+            model="claude-3-haiku",
+            choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        ).to_json() + "\n\n").encode()
+
+    assert encoder.encode("Hi", "assistant") == expected({"content": "Hi", "role": "assistant"}, None)
+    assert encoder.encode(' "quoted" \\ zß\n\U0001f600') == expected({"content": ' "quoted" \\ zß\n\U0001f600'},
+                                                                         None)
+    assert encoder.encode(None, "assistant", "msg_2") == expected({"content": None, "role": "assistant"}, None,
+                                                                  "msg_2")
+    assert encoder.finish("stop") == expected({}, "stop", "msg_2")
@@ -0,0 +1,153 @@
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import httpx
+import openai
+import pytest
+from mistralai.exceptions import MistralException
+
+import app.services.service_manager
+from app import transport
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.deadline import Deadline, DeadlineExceeded
+from app.models import TargetApiBackend, OpenAICompletionRequest
+from app.services import mistral_service, openai_service
+from benchmarks.stub_upstream import start_stub_upstream
+
+
+class TimingOutBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.deadline = None
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.deadline = completionRequest.deadline
+        raise RuntimeError("Upstream failed") from httpx.ReadTimeout("timed out")
+
+
+def test_deadline_from_header():
+    deadline = Deadline.from_header("total=30, connect=2", total=600, connect=10, first_byte=300)
+    assert (deadline.total, deadline.connect, deadline.first_byte) == (30, 2, 300)
+
+    # the header can only shorten the configured limits
+    assert Deadline.from_header("900", total=600).total == 600
+    assert Deadline.from_header("5", total=0).total == 5
+    assert Deadline.from_header(None, total=0).remaining() is None
+
+    for header in ("soon", "total=-1", "read=5"):
+        with pytest.raises(ValueError):
+            Deadline.from_header(header)
+
+
+def test_guard_ends_stream_at_deadline():
+    def frames():
+        while True:
+            time.sleep(0.05)
+            yield "data: {}\n\n"
+
+    with pytest.raises(DeadlineExceeded):
+        for _ in Deadline(total=0.2).guard(frames()):
+            pass
+
+
+def test_timeout_returns_504(monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    backend = TimingOutBackend()
+    client = create_app(config).test_client()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", backend)
+
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key", "X-Request-Timeout": "5"},
+                           json={"model": "model", "messages": []})
+    assert response.status_code == 504
+    assert backend.deadline.total == 5
+
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key", "X-Request-Timeout": "x"},
+                           json={"model": "model", "messages": []})
+    assert response.status_code == 400
+
+
+def test_cancel_aborts_upstream_stream():
+    upstream = start_stub_upstream(tokens=10, token_delay=2)
+    transport.init_transport(http2=False)
+    base_url = f"http://127.0.0.1:{upstream.server_port}"
+    try:
+        completionRequest = OpenAICompletionRequest(api_key="stub", model="gpt-3.5-turbo", max_tokens=10,
+                                                    messages=[{"role": "user", "content": "Hello"}], stream=True)
+        completionRequest.deadline = Deadline(total=60)
+        client = openai_service.OpenAI(api_key="stub", base_url=base_url,
+                                       http_client=transport.get_http_client(base_url))
+        frames = openai_service._stream_request(completionRequest, client)
+        next(frames)
+
+        # the client goes away while the reading thread waits for the next token
+        threading.Timer(0.2, completionRequest.deadline.cancel).start()
+        started_at = time.monotonic()
+        with pytest.raises(httpx.HTTPError):
+            next(frames)
+        assert time.monotonic() - started_at < 1
+    finally:
+        upstream.shutdown()
+
+
+def test_sdk_calls_without_deadline_time_out():
+    upstream = start_stub_upstream(tokens=10, token_delay=2)
+    transport.init_transport(http2=False, read=0.3)
+    base_url = f"http://127.0.0.1:{upstream.server_port}"
+    try:
+        # the SDK uses the default timeout of the shared client
+        client = openai_service.OpenAI(api_key="stub", base_url=base_url, max_retries=0,
+                                       http_client=transport.get_http_client(base_url))
+        started_at = time.monotonic()
+        with pytest.raises(openai.APITimeoutError):
+            client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": "Hello"}])
+        assert time.monotonic() - started_at < 1.5
+    finally:
+        transport.init_transport(http2=False)
+        upstream.shutdown()
+
+
+def test_cancel_aborts_http2_request():
+    pytest.importorskip("h2")
+    from benchmarks.stub_upstream_h2 import start_stub_upstream_h2
+
+    upstream = start_stub_upstream_h2(tokens=2, token_delay=1)
+    transport.init_transport(http2=True)
+    url = f"http://127.0.0.1:{upstream.server_port}/v1/messages"
+    try:
+        deadline = Deadline(total=60)
+        # a losing race member, cancelled while the upstream generates the response
+        threading.Timer(0.2, deadline.cancel).start()
+        started_at = time.monotonic()
+        with pytest.raises(CancelledError):
+            transport.post(url, deadline=deadline, json={"model": "claude-3-haiku-20240307", "max_tokens": 2,
+                                                         "messages": [{"role": "user", "content": "Hello"}]})
+        assert time.monotonic() - started_at < 1
+    finally:
+        transport.init_transport(http2=False)
+        upstream.shutdown()
+
+
+def test_cancel_aborts_sdk_stream():
+    upstream = start_stub_upstream(tokens=10, token_delay=2)
+    try:
+        completionRequest = OpenAICompletionRequest(api_key="stub", model="mistral-small-latest", max_tokens=10,
+                                                    messages=[{"role": "user", "content": "Hello"}], stream=True)
+        completionRequest.deadline = Deadline(total=60)
+        backend = mistral_service.MistralApiBackend(base_url=f"http://127.0.0.1:{upstream.server_port}")
+        frames = backend.handle_streamed_completion_request(completionRequest, True)
+        next(frames)
+
+        # the SDK reads the stream itself, its response is aborted through the client
+        threading.Timer(0.2, completionRequest.deadline.cancel).start()
+        started_at = time.monotonic()
+        with pytest.raises(MistralException):
+            next(frames)
+        assert time.monotonic() - started_at < 1
+    finally:
+        upstream.shutdown()
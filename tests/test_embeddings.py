@@ -0,0 +1,101 @@
+import base64
+import struct
+import threading
+
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.deadline import Deadline, DeadlineExceeded
+from app.embeddings import EmbeddingBatcher
+from app.models import TargetApiBackend, Embeddings
+
+
+class EmbeddingBackend(TargetApiBackend):
+    name = "fake"
+    max_embedding_batch_size = 3
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.batches = []
+
+    def create_embeddings(self, model, inputs, api_key, deadline=None):
+        self.batches.append(list(inputs))
+        self.deadline = deadline
+        return Embeddings([[float(len(text)), 0.5] for text in inputs], prompt_tokens=sum(map(len, inputs)))
+
+
+def test_concurrent_requests_share_upstream_calls():
+    backend = EmbeddingBackend()
+    batcher = EmbeddingBatcher(window_ms=200)
+    results = {}
+
+    def embed(text):
+        results[text] = batcher.embed(backend, "model", [text], "key")
+
+    threads = [threading.Thread(target=embed, args=("x" * i,)) for i in range(1, 8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 7 inputs in batches of at most 3
+    assert len(backend.batches) == 3
+    assert all(len(batch) <= 3 for batch in backend.batches)
+    for text, result in results.items():
+        assert result.vectors == [[float(len(text)), 0.5]]
+        assert result.prompt_tokens == len(text)
+
+
+def test_large_request_is_split():
+    backend = EmbeddingBackend()
+    result = EmbeddingBatcher(window_ms=0).embed(backend, "model", ["a", "bb", "ccc", "dddd"], "key")
+    assert [vector[0] for vector in result.vectors] == [1, 2, 3, 4]
+    assert len(backend.batches) == 2
+
+
+@pytest.fixture
+def client(monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    test_client = create_app(config).test_client()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", EmbeddingBackend())
+    return test_client
+
+
+def test_embeddings_route(client):
+    response = client.post("/v1/embeddings", headers={"Authorization": "Bearer key"},
+                           json={"model": "model", "input": ["ab", "c"]})
+    assert response.status_code == 200
+    assert [item["embedding"] for item in response.json["data"]] == [[2.0, 0.5], [1.0, 0.5]]
+    assert response.json["usage"]["prompt_tokens"] == 3
+
+    response = client.post("/v1/embeddings", headers={"Authorization": "Bearer key"},
+                           json={"model": "model", "input": "ab", "encoding_format": "base64"})
+    assert struct.unpack("<2f", base64.b64decode(response.json["data"][0]["embedding"])) == (2.0, 0.5)
+
+    response = client.post("/v1/embeddings", headers={"Authorization": "Bearer key"},
+                           json={"model": "model", "input": [1, 2]})
+    assert response.status_code == 400
+
+
+def test_embeddings_follow_the_deadline(client):
+    response = client.post("/v1/embeddings", headers={"Authorization": "Bearer key", "X-Request-Timeout": "5"},
+                           json={"model": "model", "input": "ab"})
+    assert response.status_code == 200
+    assert app.services.service_manager.current_target_api.deadline.total == 5
+
+    # a request waiting for the batch of another one gives up at its own deadline
+    backend = EmbeddingBackend()
+    release = threading.Event()
+    backend.create_embeddings = lambda model, inputs, api_key, deadline=None: release.wait(5) and Embeddings(
+        [[0.0]] * len(inputs), 0)
+    batcher = EmbeddingBatcher(window_ms=50)
+    leader = threading.Thread(target=batcher.embed, args=(backend, "model", ["a"], "key"))
+    leader.start()
+    with pytest.raises(DeadlineExceeded):
+        batcher.embed(backend, "model", ["b"], "key", Deadline(total=0.2))
+    release.set()
+    leader.join()
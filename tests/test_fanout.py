@@ -0,0 +1,88 @@
+import json
+import time
+
+import pytest
+
+import app.services.service_manager
+from app import fanout
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionRequest, OpenAICompletionResponse, \
+    OpenAICompletionChunkResponse
+
+CALL_TIME = 0.2
+
+
+class SlowBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.calls = 0
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        assert completionRequest.n is None
+        self.calls += 1
+        time.sleep(CALL_TIME)
+        return OpenAICompletionResponse(
+            completion_id=f"id-{self.calls}", model="model", completionTokens=5, promptTokens=10,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}])
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        for text in ("a", "b", "c"):
+            time.sleep(CALL_TIME / 3)
+            yield "data:" + OpenAICompletionChunkResponse(
+                completion_id=str(id(completionRequest)), model="model",
+                choices=[{"index": 0, "delta": {"content": text}, "finish_reason": None}]).to_json() + "\n\n"
+        completionRequest.usage = {"prompt_tokens": 10, "completion_tokens": 3}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    test_client = create_app(config).test_client()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", SlowBackend())
+    return test_client
+
+
+def _request(n: int, stream: bool = False) -> OpenAICompletionRequest:
+    return OpenAICompletionRequest(api_key="key", model="model", max_tokens=10, n=n, stream=stream,
+                                   messages=[{"role": "user", "content": "Hello"}])
+
+
+def test_fanout_merges_choices():
+    started_at = time.monotonic()
+    response = fanout.handle_completion_request(SlowBackend(), _request(4), False, 4)
+
+    # the calls run concurrently
+    assert time.monotonic() - started_at < CALL_TIME * 2
+    assert [choice["index"] for choice in response.choices] == [0, 1, 2, 3]
+    assert (response.promptTokens, response.completionTokens) == (40, 20)
+
+
+def test_fanout_interleaves_streams():
+    completionRequest = _request(3, stream=True)
+    started_at = time.monotonic()
+    chunks = [json.loads(frame[5:]) for frame in
+              fanout.handle_streamed_completion_request(SlowBackend(), completionRequest, False, 3)]
+
+    assert time.monotonic() - started_at < CALL_TIME * 2
+    assert len({chunk["id"] for chunk in chunks}) == 1
+    for index in range(3):
+        assert "".join(chunk["choices"][0]["delta"]["content"] for chunk in chunks
+                       if chunk["choices"][0]["index"] == index) == "abc"
+    assert completionRequest.usage == {"prompt_tokens": 30, "completion_tokens": 9}
+
+
+def test_route_fans_out(client):
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"},
+                           json={"model": "model", "messages": [], "n": 2})
+    assert response.status_code == 200
+    assert len(response.json["choices"]) == 2
+    assert response.json["usage"]["prompt_tokens"] == 20
+
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"},
+                           json={"model": "model", "messages": [], "n": 0})
+    assert response.status_code == 400
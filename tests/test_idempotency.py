@@ -0,0 +1,124 @@
+import threading
+import time
+
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.idempotency import IdempotencyStore, get_idempotency_store
+from app.models import TargetApiBackend, OpenAICompletionResponse
+
+
+class SlowBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.calls = 0
+        self.release = threading.Event()
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.calls += 1
+        self.release.wait(5)
+        return OpenAICompletionResponse(completion_id=f"id-{self.calls}", model=completionRequest.model, choices=[],
+                                        completionTokens=1, promptTokens=1)
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        self.calls += 1
+        yield "data: 1\n\n"
+        self.release.wait(5)
+        yield "data: 2\n\n"
+        completionRequest.usage = {"prompt_tokens": 1, "completion_tokens": 1}
+
+
+@pytest.fixture
+def flask_app():
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.IDEMPOTENCY_TTL = 60
+    config.SSE_HEARTBEAT_INTERVAL = 0
+    return create_app(config)
+
+
+@pytest.fixture
+def backend(flask_app, monkeypatch):
+    backend = SlowBackend()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", backend)
+    return backend
+
+
+def _post(client, body: dict, key: str = "retry-1"):
+    return client.post("/v1/chat/completions", json=body,
+                       headers={"Authorization": "Bearer key", "Idempotency-Key": key})
+
+
+def test_store_expiry_and_budget():
+    store = IdempotencyStore(ttl=0.05, max_bytes=1000)
+    entry, created = store.begin("key", "a", {"model": "m"}, False)
+    assert created
+    assert store.begin("key", "a", {"model": "m"}, False) == (entry, False)
+    assert store.begin("key", "a", {"model": "other"}, False) == (None, False)
+    # keys are scoped to the API key
+    assert store.begin("other", "a", {"model": "m"}, False)[1]
+
+    store.complete(entry, b"x" * 100)
+    assert store.begin("key", "a", {"model": "m"}, False)[0].get_body() == b"x" * 100
+    time.sleep(0.1)
+    assert store.begin("key", "a", {"model": "m"}, False)[1]
+
+    # responses beyond the budget are not kept
+    entry, _ = store.begin("key", "b", {}, False)
+    store.complete(entry, b"x" * 2000)
+    assert store.begin("key", "b", {}, False)[1]
+
+
+def test_retry_attaches_to_running_request(flask_app, backend):
+    body = {"model": "m", "messages": []}
+    responses = []
+    first = threading.Thread(target=lambda: responses.append(_post(flask_app.test_client(), body)))
+    first.start()
+    time.sleep(0.1)
+    second = threading.Thread(target=lambda: responses.append(_post(flask_app.test_client(), body)))
+    second.start()
+    time.sleep(0.1)
+    backend.release.set()
+    first.join()
+    second.join()
+
+    assert backend.calls == 1
+    assert [response.json["id"] for response in responses] == ["id-1", "id-1"]
+    assert _post(flask_app.test_client(), body).headers["Idempotent-Replayed"] == "true"
+    assert _post(flask_app.test_client(), dict(body, model="other")).status_code == 422
+    assert backend.calls == 1
+
+
+def test_streamed_retry_replays_and_follows(flask_app, backend):
+    body = {"model": "m", "messages": [], "stream": True}
+    first = _post(flask_app.test_client(), body, key="stream-1")
+    # the client goes away after the first chunk, the stream keeps running
+    assert next(iter(first.response)) == b"data: 1\n\n"
+    first.close()
+
+    retry = _post(flask_app.test_client(), body, key="stream-1")
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    backend.release.set()
+    assert b"".join(retry.response) == b"data: 1\n\ndata: 2\n\n"
+    assert backend.calls == 1
+
+
+def test_streamed_retry_sent_upstream_if_the_original_failed_before_streaming(flask_app, backend):
+    body = {"model": "m", "messages": [], "max_tokens": 10, "stream": True}
+    # the original request is running, then rejected before it streams anything, e.g. by a rate limit
+    store = get_idempotency_store()
+    entry, created = store.begin("key", "stream-2", body, True)
+    assert created
+    threading.Timer(0.1, store.release, (entry,)).start()
+
+    backend.release.set()
+    retry = _post(flask_app.test_client(), body, key="stream-2")
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+    assert b"".join(retry.response) == b"data: 1\n\ndata: 2\n\n"
+    assert backend.calls == 1
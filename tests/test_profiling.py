@@ -0,0 +1,111 @@
+import marshal
+import threading
+
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionResponse, ChunkEncoder
+
+ADMIN_HEADERS = {"Authorization": "Bearer admin"}
+
+
+class FakeBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.entered.set()
+        self.release.wait(5)
+        return OpenAICompletionResponse(
+            completion_id="id", model="model", completionTokens=1, promptTokens=1,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}])
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        encoder = ChunkEncoder("model", "id")
+        for text in ("a", "b", "c"):
+            yield encoder.encode(text)
+        yield encoder.finish("stop")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.ADMIN_KEY = "admin"
+    test_client = create_app(config).test_client()
+    test_client.backend = FakeBackend()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", test_client.backend)
+    return test_client
+
+
+def _complete(client, stream: bool):
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"},
+                           json={"model": "model", "messages": [], "stream": stream})
+    assert response.status_code == 200
+    return response
+
+
+def test_profiles_the_next_requests(client):
+    view = client.application.view_functions["routes.completions"]
+    assert client.post("/debug/profile", json={"requests": 2}).status_code == 401
+
+    response = client.post("/debug/profile", headers=ADMIN_HEADERS, json={"requests": 2})
+    assert response.json["active"] is True
+    assert client.application.view_functions["routes.completions"] is not view
+
+    _complete(client, stream=False)
+    assert b"data:" in _complete(client, stream=True).data
+    # the third request ends the session and restores the original view
+    _complete(client, stream=False)
+    assert client.application.view_functions["routes.completions"] is view
+
+    progress = client.get("/debug/profile?format=json", headers=ADMIN_HEADERS).json
+    assert progress["active"] is False
+    assert progress["started_requests"] == progress["finished_requests"] == 2
+
+    report = client.get("/debug/profile?sort=tottime&limit=200", headers=ADMIN_HEADERS).data.decode()
+    assert "handle_completion_request" in report
+    # the stream is profiled while it is sent
+    assert "handle_streamed_completion_request" in report
+
+    stats = marshal.loads(client.get("/debug/profile?format=pstats", headers=ADMIN_HEADERS).data)
+    assert any(function == "completions" for _, _, function in stats)
+
+
+def test_stop_profiling(client):
+    view = client.application.view_functions["routes.completions"]
+    assert client.post("/debug/profile", headers=ADMIN_HEADERS, json={"seconds": -1}).status_code == 400
+
+    client.post("/debug/profile", headers=ADMIN_HEADERS, json={"seconds": 60})
+    _complete(client, stream=False)
+    assert client.delete("/debug/profile", headers=ADMIN_HEADERS).json["finished_requests"] == 1
+    assert client.application.view_functions["routes.completions"] is view
+
+
+def test_concurrent_requests_are_profiled_one_at_a_time(client):
+    client.post("/debug/profile", headers=ADMIN_HEADERS, json={"requests": 5})
+    client.backend.release.clear()
+    responses = []
+    first = threading.Thread(target=lambda: responses.append(_complete(client.application.test_client(), False)))
+    first.start()
+    assert client.backend.entered.wait(5)
+
+    # served while the first request holds the profiler
+    assert b"data:" in _complete(client, stream=True).data
+    client.backend.release.set()
+    first.join()
+    assert len(responses) == 1
+
+    progress = client.get("/debug/profile?format=json", headers=ADMIN_HEADERS).json
+    assert progress["started_requests"] == progress["finished_requests"] == 1
+    # the profiler is free again once the request ended
+    _complete(client, stream=True)
+    assert client.get("/debug/profile?format=json", headers=ADMIN_HEADERS).json["finished_requests"] == 2
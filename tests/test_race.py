@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from app.circuit_breaker import init_circuit_breakers, get_circuit_breaker, OPEN
+from app.deadline import Deadline
+from app.models import TargetApiBackend, OpenAICompletionRequest, OpenAICompletionResponse, \
+    OpenAICompletionChunkResponse
+from app.routes import _get_circuit_breaker
+from app.services.auto_service import AutoApiBackend
+from app.services.race_service import RaceApiBackend, parse_race_groups
+
+
+class MemberBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self, delay: float, fail: bool = False):
+        super().__init__('', '', [])
+        self.delay = delay
+        self.fail = fail
+        self.cancelled = False
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("Upstream failed")
+        return OpenAICompletionResponse(
+            completion_id="id", model=completionRequest.model, completionTokens=1, promptTokens=1,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}])
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        completionRequest.deadline.on_cancel(lambda: setattr(self, "cancelled", True))
+        for delta in ({"role": "assistant"}, {"content": "a"}, {"content": "b"}):
+            time.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError("Upstream failed")
+            yield "data:" + OpenAICompletionChunkResponse(
+                completion_id=completionRequest.model, model=completionRequest.model,
+                choices=[{"index": 0, "delta": delta, "finish_reason": None}]).to_json() + "\n\n"
+        completionRequest.usage = {"prompt_tokens": 1, "completion_tokens": 2}
+
+
+def _race(members: dict[str, MemberBackend]) -> RaceApiBackend:
+    return RaceApiBackend("race-fast", list(members), members.__getitem__, lambda model_id: None)
+
+
+def _request(stream: bool = False) -> OpenAICompletionRequest:
+    completionRequest = OpenAICompletionRequest(api_key="key", model="race-fast", max_tokens=10, stream=stream,
+                                                messages=[{"role": "user", "content": "Hello"}])
+    completionRequest.deadline = Deadline(total=10)
+    return completionRequest
+
+
+def test_parse_race_groups():
+    assert parse_race_groups("a=x,y; b=z,x,y") == {"a": ["x", "y"], "b": ["z", "x", "y"]}
+    assert parse_race_groups(None) == {}
+    with pytest.raises(ValueError):
+        parse_race_groups("a=x")
+
+
+def test_first_good_response_wins():
+    race = _race({"failing": MemberBackend(0, fail=True), "slow": MemberBackend(1), "fast": MemberBackend(0.05)})
+
+    started_at = time.monotonic()
+    response = race.handle_completion_request(_request(), False)
+    assert time.monotonic() - started_at < 0.5
+    assert response.model == "fast"
+
+    stats = {member["model"]: member for member in race.stats.to_dict()["members"]}
+    assert stats["fast"]["wins"] == 1
+    assert stats["failing"]["errors"] == 1
+
+
+def test_stream_commits_to_first_token():
+    slow = MemberBackend(0.5)
+    race = _race({"slow": slow, "fast": MemberBackend(0.02), "failing": MemberBackend(0, fail=True)})
+    completionRequest = _request(stream=True)
+
+    started_at = time.monotonic()
+    frames = list(race.handle_streamed_completion_request(completionRequest, False))
+    assert time.monotonic() - started_at < 0.5
+    assert len(frames) == 3 and all('"id": "fast"' in frame for frame in frames)
+    assert completionRequest.usage == {"prompt_tokens": 1, "completion_tokens": 2}
+    # the losing stream was aborted
+    assert slow.cancelled
+
+
+def test_auto_backend_routes_race_model():
+    backend = AutoApiBackend(["anthropic", "openai"],
+                             {"race-fast": ["claude-3-haiku-20240307", "gpt-3.5-turbo"]})
+    assert "race-fast" in [model.id for model in backend.models]
+    assert isinstance(backend.get_backend("race-fast"), RaceApiBackend)
+
+
+@pytest.fixture
+def breakers():
+    init_circuit_breakers(failure_rate=0.5, min_requests=2, slow_call_seconds=0, open_seconds=30, probes=1)
+    yield
+    init_circuit_breakers(failure_rate=0, min_requests=0, slow_call_seconds=0, open_seconds=0, probes=0)
+
+
+def test_outcomes_recorded_on_member_breakers(breakers):
+    failing, fast = MemberBackend(0, fail=True), MemberBackend(0.05)
+    failing.name, fast.name = "failing", "fast"
+    race = _race({"failing": failing, "fast": fast})
+    # no breaker shared by all the race groups
+    assert _get_circuit_breaker(race, "race-fast") is None
+
+    assert race.handle_completion_request(_request(), False).model == "fast"
+    assert len(list(race.handle_streamed_completion_request(_request(stream=True), False))) == 3
+
+    assert get_circuit_breaker("failing", "completions").state == OPEN
+    assert get_circuit_breaker("fast", "completions").to_dict() == {"state": "closed", "requests": 2, "failures": 0,
+                                                                     "retry_after": None}
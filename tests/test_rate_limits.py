@@ -0,0 +1,87 @@
+import hashlib
+import json
+
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionResponse
+from app.rate_limits import ClientKeyTable, ClientLimits, hash_client_key
+
+
+class FakeBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        return OpenAICompletionResponse(
+            completion_id="id", model="model", completionTokens=10, promptTokens=5,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}])
+
+
+def test_token_limit_is_settled():
+    client = ClientLimits("client", hash_client_key("key"), tokens_per_minute=1000)
+    assert client.acquire(900) == 0
+    assert client.acquire(200) > 0
+
+    # the request only used 100 of the 900 estimated tokens
+    client.settle(900, 100)
+    assert client.acquire(800) == 0
+
+
+def test_client_key_lookup(tmp_path):
+    path = tmp_path / "clients.json"
+    path.write_text(json.dumps([{"name": "a", "key": "key-a"},
+                                {"name": "b", "key_sha256": hashlib.sha256(b"key-b").hexdigest()}]))
+    client_keys = ClientKeyTable.from_file(str(path))
+    assert client_keys.lookup("key-a").name == "a"
+    assert client_keys.lookup("key-b").name == "b"
+    assert client_keys.lookup("key-c") is None
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    path = tmp_path / "clients.json"
+    path.write_text(json.dumps([{"name": "limited", "key": "limited", "requests_per_minute": 2},
+                                {"name": "tokens", "key": "tokens", "tokens_per_minute": 1000}]))
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.CUSTOM_KEY
+    config.AUTH_KEY = "admin"
+    config.CLIENT_KEYS_FILE = str(path)
+    test_client = create_app(config).test_client()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", FakeBackend())
+    return test_client
+
+
+def _post(client, key: str, max_tokens: int = 10):
+    return client.post("/v1/chat/completions", headers={"Authorization": "Bearer " + key},
+                       json={"model": "model", "max_tokens": max_tokens,
+                             "messages": [{"role": "user", "content": "Hello"}]})
+
+
+def test_request_rate_limit(client):
+    assert _post(client, "limited").status_code == 200
+    assert _post(client, "limited").status_code == 200
+    response = _post(client, "limited")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+    # other clients and the unlimited AUTH_KEY are not affected
+    assert _post(client, "admin").status_code == 200
+    assert _post(client, "unknown").status_code == 401
+    assert _post(client, "ünknown").status_code == 401
+
+
+def test_token_rate_limit(client):
+    # the estimate of 800 max_tokens is replaced by the 15 tokens actually used
+    for _ in range(5):
+        assert _post(client, "tokens", max_tokens=800).status_code == 200
+
+    # requests larger than the limit wait until the bucket is full again
+    response = _post(client, "tokens", max_tokens=2000)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,73 @@
+import pytest
+
+import app.services.registry
+from app.models import AvailableModel
+from app.services.auto_service import AutoApiBackend
+from app.services.model_discovery import ModelRefresher
+
+
+def test_load_models_reads_catalog_once():
+    models = app.services.registry.load_models("anthropic")
+
+    assert "claude-3-haiku-20240307" in [model.id for model in models]
+    assert app.services.registry.load_models("anthropic") is models
+
+
+def test_auto_backend_routes_without_loading_backends(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(app.services.auto_service, "load_backend", lambda name: loaded.append(name) or name)
+
+    backend = AutoApiBackend(supported_backends=["anthropic", "mistral", "cohere", "openai"])
+
+    assert loaded == []
+    assert backend.get_backend("command-r") == "cohere"
+    assert loaded == ["cohere"]
+
+    with pytest.raises(ValueError):
+        backend.get_backend("unknown-model")
+
+
+def test_model_refresher_updates_routes(monkeypatch):
+    original_models = app.services.registry.load_models("cohere")
+    live_models = original_models + [AvailableModel(id="command-new", object="model", created=0, owned_by="cohere")]
+
+    class LiveBackend:
+        api_key = "key"
+
+        def list_upstream_models(self):
+            return live_models
+
+    monkeypatch.setattr(app.services.model_discovery, "load_backend", lambda name: LiveBackend())
+
+    backend = AutoApiBackend(supported_backends=["anthropic", "cohere"])
+    try:
+        ModelRefresher(["cohere"], interval=60).refresh()
+
+        assert backend.model_routes.get("command-new") is None
+        assert "command-new" in [model.id for model in backend.models]
+        assert backend.model_routes["command-new"] == "cohere"
+    finally:
+        app.services.registry.set_models("cohere", original_models)
+
+
+def test_unchanged_cohere_catalog_is_kept(monkeypatch):
+    from types import SimpleNamespace
+    from app.services import cohere_service
+
+    original_models = app.services.registry.load_models("cohere")
+    listed = SimpleNamespace(models=[SimpleNamespace(name=model.id, context_length=model.context_window)
+                                     for model in original_models], next_page_token=None)
+
+    class FakeClient:
+        def __init__(self, *args, **kwargs):
+            self.models = SimpleNamespace(list=lambda **kwargs: listed)
+
+    monkeypatch.setattr(cohere_service.cohere, "Client", FakeClient)
+    monkeypatch.setattr(app.services.model_discovery, "load_backend",
+                        lambda name: cohere_service.CohereApiBackend(api_key="key"))
+    set_models = []
+    monkeypatch.setattr(app.services.model_discovery, "set_models", lambda *args: set_models.append(args))
+
+    # the listed models keep their creation date, so the catalog (and the /v1/models ETag) does not change
+    ModelRefresher(["cohere"], interval=60).refresh()
+    assert set_models == []
@@ -0,0 +1,145 @@
+import os
+
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionResponse, OpenAICompletionRequest
+from app.response_cache import SimilarityCache, ENTRY_OVERHEAD, BUCKET_OVERHEAD, SharedMemoryCache, \
+    SHARED_CACHE_WAYS
+
+
+class FakeBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.calls = 0
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.calls += 1
+        return OpenAICompletionResponse(completion_id=f"id-{self.calls}", model=completionRequest.model, choices=[],
+                                        completionTokens=1, promptTokens=1)
+
+
+def _request(content: str, model: str = "model", temperature: float | None = None,
+             api_key: str = "key") -> OpenAICompletionRequest:
+    return OpenAICompletionRequest(api_key=api_key, model=model, max_tokens=100, temperature=temperature,
+                                   messages=[{"role": "system", "content": "You are a helpful assistant."},
+                                             {"role": "user", "content": content}])
+
+
+PROMPT = ("Request 7f3e2a10-5c4b-4d2e-9f1a-0b6c8d7e5f42 at 2024-05-01T10:00:00Z: summarize the quarterly sales "
+          "report of the northern region and list the three largest customers by revenue.")
+
+
+def test_near_duplicates_hit():
+    cache = SimilarityCache(threshold=0.9, max_bytes=1024 * 1024)
+    cache.put(_request(PROMPT), "response")
+
+    # different whitespace, case, ids and timestamps
+    similar = PROMPT.replace("7f3e2a10", "0a1b2c3d").replace("10:00:00", "11:42:17").replace(" the ", "  the ")
+    assert cache.get(_request(similar.upper())) == "response"
+
+    assert cache.get(_request("Write a poem about the sea.")) is None
+    # same messages with other parameters or another model
+    assert cache.get(_request(PROMPT, temperature=0.5)) is None
+    assert cache.get(_request(PROMPT, model="other")) is None
+    # responses are only returned to the key they were cached for
+    assert cache.get(_request(PROMPT, api_key="other")) is None
+
+
+def test_numbers_are_not_normalized():
+    cache = SimilarityCache(threshold=0.9, max_bytes=1024 * 1024)
+    cache.put(_request("What is 12 * 7?"), "84")
+    assert cache.get(_request("What is 12 * 7?")) == "84"
+    assert cache.get(_request("What is 981 * 3?")) is None
+
+
+def test_memory_budget_evicts_least_recently_used():
+    entry_size = len("response") + ENTRY_OVERHEAD + 8 * BUCKET_OVERHEAD
+    cache = SimilarityCache(threshold=0.9, max_bytes=entry_size * 2)
+    cache.put(_request("first prompt about apples and oranges"), "response")
+    cache.put(_request("second prompt about cars and trucks"), "response")
+    cache.get(_request("first prompt about apples and oranges"))
+    cache.put(_request("third prompt about rivers and lakes"), "response")
+
+    assert len(cache) == 2
+    assert cache.size <= cache.max_bytes
+    assert cache.get(_request("first prompt about apples and oranges")) is not None
+    assert cache.get(_request("second prompt about cars and trucks")) is None
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.RESPONSE_CACHE = "similarity"
+    config.RESPONSE_CACHE_KEYS = ["cached"]
+
+    backend = FakeBackend()
+    backend.client = create_app(config).test_client()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", backend)
+    return backend
+
+
+def test_completions_served_from_cache(backend):
+    body = {"model": "model", "messages": [{"role": "user", "content": PROMPT}]}
+    first = backend.client.post("/v1/chat/completions", headers={"Authorization": "Bearer cached"}, json=body)
+    second = backend.client.post("/v1/chat/completions", headers={"Authorization": "Bearer cached"}, json=body)
+
+    assert backend.calls == 1
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json["id"] == first.json["id"]
+
+    # keys that are not allowed always reach the backend
+    backend.client.post("/v1/chat/completions", headers={"Authorization": "Bearer other"}, json=body)
+    assert backend.calls == 2
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_shared_cache_between_processes(tmp_path):
+    path = str(tmp_path / "cache")
+    cache = SharedMemoryCache(path, max_bytes=1024 * 1024, slot_size=1024)
+    cache.put(_request("first"), "response")
+
+    pid = os.fork()
+    if pid == 0:
+        # a worker opening the file sees the entries of the others and shares its own
+        worker_cache = SharedMemoryCache(path, max_bytes=1024 * 1024, slot_size=1024)
+        ok = worker_cache.get(_request("first")) == "response"
+        worker_cache.put(_request("second"), "from worker")
+        os._exit(0 if ok else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    assert cache.get(_request("second")) == "from worker"
+    assert cache.get(_request("first", temperature=0.5)) is None
+    assert cache.get(_request("first ")) is None
+    assert cache.get(_request("first", api_key="other")) is None
+    cache.put(_request("What is 12 * 7?"), "84")
+    assert cache.get(_request("What is 981 * 3?")) is None
+    cache.put(_request("large"), "x" * 1024)
+    assert cache.get(_request("large")) is None
+    cache.close()
+
+
+def test_shared_cache_clock_eviction(tmp_path):
+    # a single bucket
+    cache = SharedMemoryCache(str(tmp_path / "cache"), max_bytes=SHARED_CACHE_WAYS * 256, slot_size=256)
+    for i in range(SHARED_CACHE_WAYS):
+        cache.put(_request(f"prompt {i}"), f"response {i}")
+    assert len(cache) == SHARED_CACHE_WAYS
+    cache.get(_request("prompt 0"))
+    # the hand skips the entry that was read and evicts the next ones
+    cache.put(_request("new"), "new response")
+    cache.put(_request("newer"), "newer response")
+
+    assert cache.get(_request("prompt 0")) == "response 0"
+    assert cache.get(_request("prompt 1")) is None
+    assert cache.get(_request("prompt 2")) is None
+    assert cache.get(_request("new")) == "new response"
+    assert cache.get(_request("newer")) == "newer response"
+    assert len(cache) == SHARED_CACHE_WAYS
+    cache.close()
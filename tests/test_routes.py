@@ -0,0 +1,41 @@
+import pytest
+
+import app.services.registry
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+
+
+@pytest.fixture
+def client():
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.MODEL_REFRESH_INTERVAL = 0
+
+    return create_app(config).test_client()
+
+
+def test_models_etag(client):
+    response = client.get("/v1/models")
+    assert response.status_code == 200
+    assert response.headers.get("ETag")
+    assert response.headers.get("Last-Modified")
+    assert "claude-3-haiku-20240307" in [model["id"] for model in response.json["data"]]
+
+    cached_response = client.get("/v1/models", headers={"If-None-Match": response.headers["ETag"]})
+    assert cached_response.status_code == 304
+
+
+def test_models_updated_catalog(client):
+    etag = client.get("/v1/models").headers["ETag"]
+
+    original_models = app.services.registry.load_models("anthropic")
+    try:
+        app.services.registry.set_models("anthropic", original_models[:1])
+
+        response = client.get("/v1/models", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert len(response.json["data"]) == 1
+    finally:
+        app.services.registry.set_models("anthropic", original_models)
@@ -0,0 +1,132 @@
+import time
+
+import pytest
+
+from app.circuit_breaker import init_circuit_breakers, get_circuit_breaker, OPEN
+from app.deadline import Deadline
+from app.models import TargetApiBackend, OpenAICompletionRequest, OpenAICompletionResponse, AvailableModel, \
+    OpenAICompletionChunkResponse
+from app.routes import _get_circuit_breaker
+from app.services.selector_service import SelectorApiBackend, AUTO_FAST, AUTO_CHEAP, MIN_SAMPLES
+
+
+class MemberBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self, delay: float, fail: bool = False):
+        super().__init__('', 'server-key', [])
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("Upstream failed")
+        return OpenAICompletionResponse(
+            completion_id="id", model=completionRequest.model, completionTokens=1, promptTokens=1,
+            choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}])
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        self.calls += 1
+        time.sleep(self.delay)
+        yield "data:" + OpenAICompletionChunkResponse(
+            completion_id="id", model=completionRequest.model,
+            choices=[{"index": 0, "delta": {"content": "a"}, "finish_reason": None}]).to_json() + "\n\n"
+        completionRequest.usage = {"prompt_tokens": 1, "completion_tokens": 1}
+
+
+PRICES = {"cheap": (0.25, 1.25), "mid": (0.5, 1.5), "pricey": (3, 15)}
+
+
+def _selector(members: dict[str, MemberBackend]) -> SelectorApiBackend:
+    catalog = {model_id: AvailableModel(id=model_id, object="model", created=0, owned_by="test", context_window=1000,
+                                        prompt_price=prompt_price, completion_price=completion_price)
+               for model_id, (prompt_price, completion_price) in PRICES.items()}
+    return SelectorApiBackend(list(members), members.__getitem__, catalog.get, exploration=0)
+
+
+def _request(model: str, stream: bool = False, latency_slo_ms: float | None = None) -> OpenAICompletionRequest:
+    completionRequest = OpenAICompletionRequest(api_key="key", model=model, max_tokens=10, stream=stream,
+                                                messages=[{"role": "user", "content": "Hello"}],
+                                                latency_slo_ms=latency_slo_ms)
+    completionRequest.deadline = Deadline(total=10)
+    return completionRequest
+
+
+def _warm_up(selector: SelectorApiBackend):
+    # measure every member
+    for _ in range(MIN_SAMPLES * len(selector.candidates)):
+        selector.handle_completion_request(_request(AUTO_FAST), False)
+
+
+def test_cheap_and_fast_choices():
+    selector = _selector({"cheap": MemberBackend(0.05), "mid": MemberBackend(0.02), "pricey": MemberBackend(0)})
+    _warm_up(selector)
+
+    assert selector.handle_completion_request(_request(AUTO_FAST), False).model == "pricey"
+    assert selector.handle_completion_request(_request(AUTO_CHEAP), False).model == "cheap"
+    # the cheapest model meeting the SLO
+    assert selector.handle_completion_request(_request(AUTO_CHEAP, latency_slo_ms=30), False).model == "mid"
+    assert selector.get_model(AUTO_CHEAP).context_window == 1000
+
+
+def test_traffic_shifts_away_from_slow_or_failing_models():
+    members = {"cheap": MemberBackend(0), "mid": MemberBackend(0.01)}
+    selector = _selector(members)
+    _warm_up(selector)
+    assert selector.handle_completion_request(_request(AUTO_FAST), False).model == "cheap"
+
+    members["cheap"].delay = 0.05
+    for _ in range(10):
+        selector.handle_completion_request(_request(AUTO_FAST), False)
+    assert selector.handle_completion_request(_request(AUTO_FAST), False).model == "mid"
+
+    members["cheap"].delay = 0
+    members["cheap"].fail = True
+    for _ in range(5):
+        try:
+            selector.handle_completion_request(_request(AUTO_CHEAP), False)
+        except RuntimeError:
+            pass
+    assert selector.handle_completion_request(_request(AUTO_CHEAP), False).model == "mid"
+
+
+def test_stream_records_time_to_first_token():
+    selector = _selector({"cheap": MemberBackend(0)})
+    completionRequest = _request(AUTO_CHEAP, stream=True)
+
+    frames = list(selector.handle_streamed_completion_request(completionRequest, False))
+    assert len(frames) == 1 and '"model": "cheap"' in frames[0]
+    assert completionRequest.usage == {"prompt_tokens": 1, "completion_tokens": 1}
+
+    stats = selector.to_dict()["candidates"][0]
+    assert stats["calls"] == 1 and stats["avg_ttft_ms"] is not None
+
+
+@pytest.fixture
+def breakers():
+    init_circuit_breakers(failure_rate=0.5, min_requests=2, slow_call_seconds=0, open_seconds=30, probes=1)
+    yield
+    init_circuit_breakers(failure_rate=0, min_requests=0, slow_call_seconds=0, open_seconds=0, probes=0)
+
+
+def test_outcomes_recorded_on_the_chosen_models_breaker(breakers):
+    failing, healthy = MemberBackend(0, fail=True), MemberBackend(0)
+    failing.name, healthy.name = "failing", "healthy"
+    selector = _selector({"cheap": failing, "mid": healthy})
+    # no breaker shared by all the requests to the virtual models
+    assert _get_circuit_breaker(selector, AUTO_CHEAP) is None
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            selector.handle_completion_request(_request(AUTO_CHEAP), False)
+    assert get_circuit_breaker("failing", "completions").state == OPEN
+
+    # the open circuit takes the failing model out of the choice, the healthy one keeps answering
+    failing.fail = False
+    for _ in range(3):
+        assert selector.handle_completion_request(_request(AUTO_CHEAP), False).model == "mid"
+    assert failing.calls == 2
+    assert get_circuit_breaker("healthy", "completions").to_dict()["requests"] == 3
@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionResponse, OpenAICompletionChunkResponse, ConversionCache, \
+    convert_messages, OpenAICompletionRequest
+from app.services.anthropic_service import AnthropicMessageConverter, _format_openai_messages_to_anthropic_chat
+from app.sessions import SessionStore
+
+
+class EchoBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+        self.requests = []
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.requests.append(completionRequest)
+        return OpenAICompletionResponse(
+            completion_id="id", model=completionRequest.model, completionTokens=1, promptTokens=1,
+            choices=[{"index": 0, "finish_reason": "stop",
+                      "message": {"role": "assistant", "content": f"turn {len(self.requests)}"}}])
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        self.requests.append(completionRequest)
+        for delta in ({"role": "assistant", "content": "stre"}, {"content": "amed"}):
+            yield "data:" + OpenAICompletionChunkResponse(
+                completion_id="id", model=completionRequest.model,
+                choices=[{"index": 0, "delta": delta, "finish_reason": None}]).to_json() + "\n\n"
+        completionRequest.usage = {"prompt_tokens": 1, "completion_tokens": 1}
+
+
+@pytest.fixture
+def client():
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.SSE_HEARTBEAT_INTERVAL = 0
+    return create_app(config).test_client()
+
+
+@pytest.fixture
+def backend(client, monkeypatch):
+    backend = EchoBackend()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", backend)
+    return backend
+
+
+HEADERS = {"Authorization": "Bearer key"}
+
+
+def test_session_turns_send_only_new_messages(client, backend):
+    session = client.post("/v1/sessions", headers=HEADERS, json={
+        "model": "m", "max_tokens": 50, "messages": [{"role": "system", "content": "Be brief"}]}).json
+    url = f"/v1/sessions/{session['id']}"
+
+    response = client.post(url + "/completions", headers=HEADERS,
+                           json={"messages": [{"role": "user", "content": "Hi"}]})
+    assert response.json["choices"][0]["message"]["content"] == "turn 1"
+
+    body = client.post(url + "/completions", headers=HEADERS,
+                       json={"messages": [{"role": "user", "content": "Again"}], "stream": True}).get_data()
+    assert b"amed" in body
+
+    client.post(url + "/completions", headers=HEADERS, json={"messages": [{"role": "user", "content": "Last"}]})
+    last_request = backend.requests[-1]
+    assert last_request.max_tokens == 50
+    assert [message["content"] for message in last_request.messages] == \
+        ["Be brief", "Hi", "turn 1", "Again", "streamed", "Last"]
+
+    history = client.get(url, headers=HEADERS).json
+    assert history["message_count"] == 7
+    # sessions belong to the key that started them
+    assert client.get(url, headers={"Authorization": "Bearer other"}).status_code == 404
+    assert client.delete(url, headers=HEADERS).json["deleted"]
+    assert client.post(url + "/completions", headers=HEADERS,
+                       json={"messages": [{"role": "user", "content": "Gone"}]}).status_code == 404
+
+
+def test_converted_history_is_reused():
+    messages = [{"role": "system", "content": "s"}, {"role": "user", "content": "a"},
+                {"role": "assistant", "tool_calls": [
+                    {"id": "1", "type": "function", "function": {"name": "f", "arguments": "{}"}}]},
+                {"role": "tool", "tool_call_id": "1", "content": "r"}]
+    conversions = ConversionCache()
+    completionRequest = OpenAICompletionRequest(api_key="key", model="m", max_tokens=10, messages=messages)
+    completionRequest.conversions = conversions
+
+    first = convert_messages(completionRequest, "anthropic", AnthropicMessageConverter)
+    assert first.messages == _format_openai_messages_to_anthropic_chat(messages).messages
+
+    completionRequest.messages = messages + [{"role": "user", "content": "b"}]
+    second = convert_messages(completionRequest, "anthropic", AnthropicMessageConverter)
+    assert second.messages == _format_openai_messages_to_anthropic_chat(completionRequest.messages).messages
+    assert conversions._converters["anthropic"].count == 5
+
+    # a dropped message starts over
+    completionRequest.messages = completionRequest.messages[1:]
+    third = convert_messages(completionRequest, "anthropic", AnthropicMessageConverter)
+    assert third.messages == _format_openai_messages_to_anthropic_chat(completionRequest.messages).messages
+
+
+def test_store_evicts_least_recently_used():
+    store = SessionStore(ttl=60, max_bytes=5000)
+    first = store.create("key", {}, [])
+    second = store.create("key", {}, [])
+    store.get("key", first.id)
+    store.append(second, [{"role": "user", "content": "x" * 2500}])
+    assert store.get("key", first.id) is first
+    store.append(first, [{"role": "user", "content": "x" * 2500}])
+    assert store.get("key", second.id) is None
+    assert json.dumps(store.get("key", first.id).to_dict())
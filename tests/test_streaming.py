@@ -0,0 +1,50 @@
+import json
+import time
+
+from app.models import OpenAICompletionChunkResponse
+from app.streaming import event_stream_response, HEARTBEAT_FRAME
+
+
+def _frame(delta: dict, finish_reason: str | None = None) -> str:
+    return "data:" + OpenAICompletionChunkResponse(
+        completion_id="id", model="model", choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    ).to_json() + "\n\n"
+
+
+def _frames(delay: float = 0.0):
+    yield _frame({"role": "assistant", "content": "Hel"})
+    for text in ["lo", ", ", "world"]:
+        time.sleep(delay)
+        yield _frame({"content": text})
+    yield _frame({}, "stop")
+
+
+def _events(body: bytes) -> list[dict]:
+    return [json.loads(event[5:]) for event in body.decode().split("\n\n") if event.startswith("data:")]
+
+
+def test_event_stream_headers():
+    response = event_stream_response(_frames())
+
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert len(_events(b"".join(response.response))) == 5
+
+
+def test_event_stream_coalescing():
+    response = event_stream_response(_frames(), flush_window_ms=1000)
+    writes = list(response.response)
+    events = _events(b"".join(writes))
+
+    assert len(writes) == 1
+    assert len(events) == 2
+    assert events[0]["choices"][0]["delta"] == {"role": "assistant", "content": "Hello, world"}
+    assert events[1]["choices"][0]["finish_reason"] == "stop"
+
+
+def test_event_stream_heartbeat():
+    response = event_stream_response(_frames(delay=0.05), heartbeat_interval=0.01)
+    body = b"".join(response.response)
+
+    assert HEARTBEAT_FRAME in body
+    assert "".join(event["choices"][0]["delta"].get("content", "") for event in _events(body)) == "Hello, world"
@@ -0,0 +1,111 @@
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionResponse, AvailableModel
+from app.tokens import TokenEstimator
+
+
+class FakeBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [AvailableModel("small", "model", 0, "fake", context_window=1000)])
+        self.requests = []
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        self.requests.append(completionRequest)
+        return OpenAICompletionResponse(completion_id="id", model=completionRequest.model, choices=[],
+                                        completionTokens=1, promptTokens=1)
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
+
+
+@pytest.fixture
+def client(backend, monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+
+    flask_app = create_app(config)
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", backend)
+    return flask_app.test_client()
+
+
+def _conversation(turns: int, size: int) -> list:
+    messages = [{"role": "system", "content": "Be brief."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": "q" * size})
+        messages.append({"role": "assistant", "content": None, "tool_calls": [
+            {"id": f"call_{i}", "type": "function", "function": {"name": "search", "arguments": "{}"}}]})
+        messages.append({"role": "tool", "tool_call_id": f"call_{i}", "content": "r" * size})
+    messages.append({"role": "user", "content": "last question"})
+    return messages
+
+
+def test_estimate():
+    estimator = TokenEstimator()
+    small = estimator.estimate("openai", [{"role": "user", "content": "hello"}])
+    large = estimator.estimate("openai", [{"role": "user", "content": "hello " * 1000}])
+    assert small.tokens < 10
+    assert 1400 < large.tokens < 1600
+
+    # non-latin text is counted by its UTF-8 size
+    assert estimator.estimate("openai", [{"role": "user", "content": "日本語" * 100}]).tokens > 200
+
+
+def test_calibrate():
+    estimator = TokenEstimator()
+    messages = [{"role": "user", "content": "x" * 4000}]
+    before = estimator.estimate("openai", messages)
+    for _ in range(100):
+        estimator.calibrate("openai", estimator.estimate("openai", messages), 2004)
+    assert estimator.estimate("openai", messages).tokens > before.tokens * 1.8
+
+
+def test_trim_keeps_tool_results_with_calls():
+    estimator = TokenEstimator()
+    messages = _conversation(turns=5, size=400)
+    trimmed = estimator.trim("openai", messages, None, 500)
+
+    assert trimmed[0]["role"] == "system"
+    assert trimmed[1]["role"] == "user"
+    assert trimmed[-1]["content"] == "last question"
+    assert len(trimmed) < len(messages)
+    call_ids = {call["id"] for message in trimmed for call in message.get("tool_calls") or []}
+    assert call_ids == {message["tool_call_id"] for message in trimmed if message["role"] == "tool"}
+
+    assert estimator.trim("openai", messages, None, 10) is None
+
+
+def test_oversized_request_rejected(client, backend):
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"}, json={
+        "model": "small", "max_tokens": 100, "messages": _conversation(turns=5, size=400)})
+
+    assert response.status_code == 400
+    assert "maximum context length is 1000 tokens" in response.json["error"]
+    assert backend.requests == []
+
+
+def test_oversized_request_truncated(client, backend):
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"}, json={
+        "model": "small", "max_tokens": 100, "messages": _conversation(turns=5, size=400), "truncation": "auto"})
+
+    assert response.status_code == 200
+    assert len(backend.requests[0].messages) < 17
+    assert backend.requests[0].messages[-1]["content"] == "last question"
+
+
+def test_large_max_tokens_shortened_instead_of_truncating(client, backend):
+    messages = _conversation(turns=1, size=400)
+    response = client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"}, json={
+        "model": "small", "max_tokens": 950, "messages": messages, "truncation": "auto"})
+
+    # the messages fit, only the completion is shortened to the room they leave
+    assert response.status_code == 200
+    assert backend.requests[0].messages == messages
+    assert 500 < backend.requests[0].max_tokens < 950
@@ -0,0 +1,108 @@
+import json
+import os
+
+import httpx
+import pytest
+
+import app.services.service_manager
+from app import tracing
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.services.anthropic_service import AnthropicApiBackend
+from benchmarks.stub_upstream import start_stub_upstream
+
+CLIENT_TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+CLIENT_SPAN_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+def upstream():
+    server = start_stub_upstream(tokens=3)
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def trace_path(tmp_path):
+    yield str(tmp_path / "traces.jsonl")
+    tracing.init_tracing(None, 0, 0, 0)
+
+
+def _read_spans(path: str) -> list[dict]:
+    # export the queued spans
+    tracing.get_tracer().processor.close()
+    with open(path) as f:
+        return [span for line in f for resource_spans in json.loads(line)["resourceSpans"]
+                for scope_spans in resource_spans["scopeSpans"] for span in scope_spans["spans"]]
+
+
+def test_traces_requests_and_upstream_calls(monkeypatch, upstream, trace_path):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.TRACING_EXPORT = trace_path
+    config.TRACING_SAMPLE_RATE = 0
+    client = create_app(config).test_client()
+    monkeypatch.setattr(app.services.service_manager, "current_target_api",
+                        AnthropicApiBackend(base_url=upstream, api_key="stub"))
+
+    # the client's sampled trace is continued although the sample rate is 0
+    headers = {"Authorization": "Bearer key", "traceparent": f"00-{CLIENT_TRACE_ID}-{CLIENT_SPAN_ID}-01"}
+    body = {"model": "claude-3-haiku-20240307", "messages": [{"role": "user", "content": "Hello"}]}
+    assert client.post("/v1/chat/completions", headers=headers, json=body).status_code == 200
+    assert b"tok2" in client.post("/v1/chat/completions", headers=headers, json=dict(body, stream=True)).data
+    # not sampled
+    assert client.post("/v1/chat/completions", headers={"Authorization": "Bearer key"}, json=body).status_code == 200
+
+    spans = _read_spans(trace_path)
+    assert {span["traceId"] for span in spans} == {CLIENT_TRACE_ID}
+    roots = [span for span in spans if span["name"] == "POST /v1/chat/completions"]
+    assert len(roots) == 2
+    assert all(span["parentSpanId"] == CLIENT_SPAN_ID for span in roots)
+
+    attributes = [{item["key"]: item["value"] for item in span["attributes"]} for span in roots]
+    assert attributes[0]["completion_tokens"] == {"intValue": "3"}
+    assert attributes[1]["streamed"] == {"boolValue": True}
+    assert [event["name"] for event in roots[1]["events"]] == ["first_chunk", "last_chunk"]
+
+    children = {span["name"]: span for span in spans if span["parentSpanId"] == roots[0]["spanId"]}
+    assert set(children) == {"anthropic.from_openai_request", "anthropic.make_api_request", "format_response"}
+
+
+def test_upstream_requests_carry_traceparent(trace_path):
+    tracing.init_tracing(trace_path, 1, 0, 0)
+    received = []
+    http_client = httpx.Client(transport=httpx.MockTransport(
+        lambda request: received.append(request.headers.get("traceparent")) or httpx.Response(200)))
+    tracing.instrument_client(http_client)
+
+    http_client.get("http://upstream/")
+    span = tracing.start_trace("request", None)
+    with tracing.use_span(span), tracing.start_span("call") as child:
+        http_client.get("http://upstream/")
+    span.end()
+
+    assert received == [None, child.get_traceparent()]
+    assert tracing.parse_traceparent(child.get_traceparent()) == (span.trace_id, child.span_id, True)
+    assert tracing.parse_traceparent("00-" + "0" * 32 + "-00f067aa0ba902b7-01") is None
+
+
+def test_unsampled_client_trace_is_passed_on(trace_path):
+    tracing.init_tracing(trace_path, 1, 0, 0)
+    received = []
+    http_client = httpx.Client(transport=httpx.MockTransport(
+        lambda request: received.append(request.headers.get("traceparent")) or httpx.Response(200)))
+    tracing.instrument_client(http_client)
+
+    span = tracing.start_trace("request", f"00-{CLIENT_TRACE_ID}-{CLIENT_SPAN_ID}-00")
+    assert not span.recording
+    with tracing.use_span(span), tracing.start_span("call"):
+        http_client.get("http://upstream/")
+        headers = tracing.add_trace_headers(None)
+    span.end()
+
+    assert received == [f"00-{CLIENT_TRACE_ID}-{CLIENT_SPAN_ID}-00"]
+    assert headers == {"traceparent": f"00-{CLIENT_TRACE_ID}-{CLIENT_SPAN_ID}-00"}
+    tracing.get_tracer().processor.close()
+    assert not os.path.exists(trace_path)
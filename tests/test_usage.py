@@ -0,0 +1,75 @@
+import pytest
+
+import app.services.service_manager
+from app.__main__ import create_app
+from app.config import Config, AuthMode
+from app.models import TargetApiBackend, OpenAICompletionResponse
+from app.usage import UsageLedger, UsageRecord, get_usage_ledger
+
+
+class FakeBackend(TargetApiBackend):
+    name = "fake"
+
+    def __init__(self):
+        super().__init__('', '', [])
+
+    def handle_completion_request(self, completionRequest, pass_api_key):
+        return OpenAICompletionResponse(completion_id="id", model=completionRequest.model, choices=[],
+                                        completionTokens=5, promptTokens=7)
+
+    def handle_streamed_completion_request(self, completionRequest, pass_api_key):
+        yield "data: {}\n\n"
+        completionRequest.usage = {"prompt_tokens": 3, "completion_tokens": 2}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    config = Config()
+    config.TARGET_API = "anthropic"
+    config.AUTH_MODE = AuthMode.NO_AUTH
+    config.ADMIN_KEY = "admin"
+    config.USAGE_DB_PATH = str(tmp_path / "usage.sqlite3")
+    config.USAGE_FLUSH_INTERVAL = 0.01
+
+    flask_app = create_app(config)
+    monkeypatch.setattr(app.services.service_manager, "current_target_api", FakeBackend())
+    yield flask_app.test_client()
+    get_usage_ledger().close()
+
+
+def test_ledger_summarize(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "usage.sqlite3"), flush_interval=0.01)
+    ledger.record(UsageRecord("key", "model-a", "anthropic", 10, 20, 100.0, False))
+    ledger.record(UsageRecord("key", "model-a", "anthropic", 1, 2, 300.0, True, ttft_ms=50.0))
+    ledger.record(UsageRecord("other", "model-b", "cohere", 0, 0, 10.0, False, status="error"))
+    ledger.close()
+
+    summary = {row["model"]: row for row in ledger.summarize(group_by=["model"])}
+    assert summary["model-a"]["requests"] == 2
+    assert summary["model-a"]["total_tokens"] == 33
+    assert summary["model-a"]["avg_latency_ms"] == 200.0
+    assert summary["model-a"]["avg_ttft_ms"] == 50.0
+    assert summary["model-b"]["errors"] == 1
+
+    assert ledger.summarize()[0]["requests"] == 3
+    assert ledger.summarize(since=0, until=1) == []
+
+
+def test_usage_recorded_for_requests(client):
+    headers = {"Authorization": "Bearer key"}
+    client.post("/v1/chat/completions", headers=headers, json={"model": "m", "messages": []})
+    b"".join(client.post("/v1/chat/completions", headers=headers,
+                         json={"model": "m", "messages": [], "stream": True}).response)
+    get_usage_ledger().close()
+
+    assert client.get("/admin/usage").status_code == 401
+    assert client.get("/admin/usage", headers={"Authorization": "Bearer ädmin"}).status_code == 401
+
+    response = client.get("/admin/usage?group_by=backend", headers={"Authorization": "Bearer admin"})
+    assert len(response.json["data"]) == 1
+    row = response.json["data"][0]
+    assert row["backend"] == "fake"
+    assert row["requests"] == 2
+    assert row["prompt_tokens"] == 10
+    assert row["completion_tokens"] == 7
+    assert row["avg_ttft_ms"] is not None
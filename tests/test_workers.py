@@ -0,0 +1,137 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _get(port: int, path: str, key: str = "admin") -> dict:
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", headers={"Authorization": "Bearer " + key})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def _wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise AssertionError("Condition not met in time")
+
+
+@pytest.fixture
+def server(tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    env = dict(os.environ, WORKERS="2", SERVER_PORT=str(port), TARGET_API="anthropic", AUTH_MODE="NO_AUTH",
+               ADMIN_KEY="admin", WORKER_SHUTDOWN_TIMEOUT="5")
+    log = tmp_path / "server.log"
+    with open(log, "wb") as stderr:
+        process = subprocess.Popen([sys.executable, "-m", "app"], cwd=PROJECT_ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=stderr)
+    process.port = port
+    process.log = log
+    _wait_for(lambda: all(worker["pid"] for worker in _get(port, "/admin/workers")["data"]))
+    yield process
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_workers_restart_and_shut_down(server):
+    for _ in range(10):
+        assert _get(server.port, "/v1/models")["object"] == "list"
+
+    stats = _get(server.port, "/admin/workers")
+    assert len(stats["data"]) == 2
+    assert stats["total"]["requests"] >= 11
+
+    # a crashed worker is replaced
+    crashed_pid = stats["data"][0]["pid"]
+    os.kill(crashed_pid, signal.SIGKILL)
+    _wait_for(lambda: _get(server.port, "/admin/workers")["data"][0]["pid"] not in (0, crashed_pid))
+    assert _get(server.port, "/admin/workers")["total"]["restarts"] == 1
+    assert f"(pid {crashed_pid}) was killed by SIGKILL" in server.log.read_text()
+
+    server.send_signal(signal.SIGTERM)
+    assert server.wait(timeout=15) == 0
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires UNIX domain sockets")
+def test_unix_socket_listener(tmp_path):
+    from flask import Flask
+    from app.workers import create_unix_listen_socket, create_listen_sockets, create_servers
+
+    path = str(tmp_path / "server.sock")
+    # a socket file left behind by a crashed server is replaced
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+    listen_sockets = create_listen_sockets(0, path, 0o660)
+    assert len(listen_sockets) == 1
+    assert os.stat(path).st_mode & 0o777 == 0o660
+    # but not one that is still in use, nor other files
+    with pytest.raises(OSError):
+        create_unix_listen_socket(path)
+    (tmp_path / "file").write_text("")
+    with pytest.raises(OSError):
+        create_unix_listen_socket(str(tmp_path / "file"))
+
+    app = Flask(__name__)
+    app.get("/")(lambda: "ok")
+    servers = create_servers(app, listen_sockets + [create_listen_sockets(0)[0]])
+    thread = threading.Thread(target=servers[0].run, daemon=True)
+    thread.start()
+    try:
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(path)
+            client.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            response = b""
+            while data := client.recv(4096):
+                response += data
+        assert response.startswith(b"HTTP/1.0 200") and response.endswith(b"ok")
+    finally:
+        for server in servers:
+            server.close()
+        servers[0].task_dispatcher.shutdown()
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires UNIX domain sockets")
+def test_remove_unix_socket(tmp_path):
+    from app.workers import create_unix_listen_socket, remove_unix_socket
+
+    path = str(tmp_path / "server.sock")
+    # a path this process did not create, or that is already gone, is left alone
+    remove_unix_socket(path)
+    create_unix_listen_socket(path).close()
+    os.unlink(path)
+    remove_unix_socket(path)
+
+    # a socket file replaced by another server is not removed
+    create_unix_listen_socket(path).close()
+    os.rename(path, str(tmp_path / "old.sock"))
+    other = socket.socket(socket.AF_UNIX)
+    other.bind(path)
+    other.close()
+    remove_unix_socket(path)
+    assert os.path.exists(path)
+    os.unlink(path)
+
+    create_unix_listen_socket(path).close()
+    remove_unix_socket(path)
+    assert not os.path.exists(path)